@@ -0,0 +1,659 @@
+import itertools
+
+from .PiecewiseLinearFunction import *
+from .CanonicalForm import CanonicalForm
+from .CurveIndex import UnionFind
+
+
+# A piecewise linear function stored as arrays over the index of its domain (see CurveIndex) instead of a dictionary.
+# The slopes form an integer vector indexed by the edges and then the legs of the domain, and the values at the
+# vertices form an integer (vertices x generators) matrix whose rows are coefficients of monoid elements. Arithmetic,
+# comparison, and support computations are then whole-array operations.
+class ArrayPiecewiseLinearFunction(object):
+    # domain_ should be a BasicFamily whose edge lengths are elements of its monoid
+    # slopes_ should be an integer vector indexed like domain_.index.edges followed by domain_.index.legs
+    # vertexValues_ should be an integer matrix with one row for each vertex in domain_.index.vertices and one column
+    # for each generator in domain_.index.gens. If it is not given, the values are computed from the slopes, taking the
+    # value zero at the first vertex of each connected component.
+    # validate_ may be set to False to postpone checking that the slopes and values agree until validate is called
+    def __init__(self, domain_, slopes_, vertexValues_=None, validate_=True):
+        self._domain = domain_
+        self._index = domain_.index
+        self._slopes = np.array(slopes_, dtype=np.int64)
+        if self._slopes.shape != (self._index.numEdges + self._index.numLegs,):
+            raise ValueError("There should be exactly one slope for each edge and leg of the domain.")
+
+        if vertexValues_ is None:
+            vertexValues_ = self._index.solveVertexValues(self._slopes[:self._index.numEdges])
+        self._vertexValues = np.array(vertexValues_, dtype=np.int64)
+        if self._vertexValues.shape != (self._index.numVertices, self._index.numGens):
+            raise ValueError("There should be exactly one row of values for each vertex of the domain.")
+
+        self._isValidated = False
+        if validate_:
+            self.validate()
+
+        # Pushforwards along morphisms, see getPushforwards
+        self._pushforwardCache = {}
+
+        # Variables for caching the canonical key
+        self._canonicalKeyCache = None
+
+    # Builds a function directly from its arrays, skipping all checks. Only for results that are already known to be
+    # functions, such as sums of functions. The arrays are used as they are, not copied.
+    @staticmethod
+    def _fromTrustedArrays(domain, slopes, vertexValues, isValidated=True):
+        function = ArrayPiecewiseLinearFunction.__new__(ArrayPiecewiseLinearFunction)
+        function._domain = domain
+        function._index = domain.index
+        function._slopes = slopes
+        function._vertexValues = vertexValues
+        function._isValidated = isValidated
+        function._pushforwardCache = {}
+        function._canonicalKeyCache = None
+        return function
+
+    # Builds the array version of a PiecewiseLinearFunction
+    @staticmethod
+    def fromFunction(function):
+        domain = function.domain
+        index = domain.index
+
+        slopes = [function.functionValues[x] for x in index.edges + index.legs]
+        if any(s != int(s) for s in slopes):
+            raise ValueError("Slopes must be integers.")
+
+        values, denominators = domain.monoid.to_array([function.functionValues[v] for v in index.vertices],
+                                                      index.gens)
+        if np.any(denominators != 1):
+            raise ValueError("Function values must have denominator one.")
+
+        return ArrayPiecewiseLinearFunction(domain, [int(s) for s in slopes], values)
+
+    # Builds the dictionary version of self
+    def toFunction(self):
+        functionValues = {}
+        for x in self.index.edges + self.index.legs:
+            functionValues[x] = self.slopeAt(x)
+        for v in self.index.vertices:
+            functionValues[v] = self.valueAt(v)
+        return PiecewiseLinearFunction._fromTrustedValues(self.domain, functionValues, self.isValidated)
+
+    # Make the domain and the arrays read only
+    @property
+    def domain(self):
+        return self._domain
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def slopes(self):
+        return self._slopes
+
+    @property
+    def edgeSlopes(self):
+        return self._slopes[:self.index.numEdges]
+
+    @property
+    def legSlopes(self):
+        return self._slopes[self.index.numEdges:]
+
+    @property
+    def vertexValues(self):
+        return self._vertexValues
+
+    # Whether the slopes and values are known to agree
+    @property
+    def isValidated(self):
+        return self._isValidated
+
+    # Checks that the slopes and values agree, unless that is already known
+    def validate(self):
+        if not self._isValidated:
+            self.assertIsWellDefined()
+            self._isValidated = True
+        return self
+
+    # Returns the slope of the function on an edge or leg of the domain
+    def slopeAt(self, x):
+        return int(self.slopes[self.index.slopeIndex(x)])
+
+    # Returns the value of the function at a vertex of the domain as a monoid element
+    def valueAt(self, v):
+        row = self.vertexValues[self.index.vertexIndex[v]]
+        return self.domain.monoid.from_array([row], gens=self.index.gens)[0]
+
+    # Along every edge, the change in value must be the slope times the length
+    def assertIsWellDefined(self):
+        index = self.index
+        rise = self.vertexValues[index.edgeVert2] - self.vertexValues[index.edgeVert1]
+        assert self.domain.monoid.iszero_many(rise - self.edgeSlopes[:, None] * index.lengths, index.gens).all(), \
+            "The slopes and vertex values do not define a function."
+
+    # Linear combinations of functions are functions, so they are not validated again. A result is only marked as
+    # validated if all of the operands are.
+    def __add__(self, other):
+        assert other.domain == self.domain
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(self.domain, self.slopes + other.slopes,
+                                                               self.vertexValues + other.vertexValues,
+                                                               self.isValidated and other.isValidated)
+
+    def __sub__(self, other):
+        assert other.domain == self.domain
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(self.domain, self.slopes - other.slopes,
+                                                               self.vertexValues - other.vertexValues,
+                                                               self.isValidated and other.isValidated)
+
+    def __iadd__(self, other):
+        assert other.domain == self.domain
+        self._slopes += other.slopes
+        self._vertexValues += other.vertexValues
+        self._isValidated = self.isValidated and other.isValidated
+        self._pushforwardCache = {}
+        self._canonicalKeyCache = None
+        return self
+
+    def __isub__(self, other):
+        assert other.domain == self.domain
+        self._slopes -= other.slopes
+        self._vertexValues -= other.vertexValues
+        self._isValidated = self.isValidated and other.isValidated
+        self._pushforwardCache = {}
+        self._canonicalKeyCache = None
+        return self
+
+    def __neg__(self):
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(self.domain, -self.slopes, -self.vertexValues,
+                                                               self.isValidated)
+
+    def __rmul__(self, n):
+        assert isinstance(n, int)
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(self.domain, n * self.slopes, n * self.vertexValues,
+                                                               self.isValidated)
+
+    # Returns the sum of coefficients[i] * functions[i], where the coefficients are integers and the functions share a
+    # domain, with one product of the coefficients against the stacked arrays
+    @staticmethod
+    def linearCombination(coefficients, functions):
+        functions = list(functions)
+        weights = np.array(list(coefficients), dtype=np.int64)
+        assert len(weights) == len(functions) > 0
+        domain = functions[0].domain
+        assert all(f.domain == domain for f in functions)
+
+        slopes = weights @ np.stack([f.slopes for f in functions])
+        vertexValues = np.tensordot(weights, np.stack([f.vertexValues for f in functions]), axes=1)
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(domain, slopes, vertexValues,
+                                                               all(f.isValidated for f in functions))
+
+    def __eq__(self, other):
+        if not isinstance(other, ArrayPiecewiseLinearFunction):
+            return False
+
+        if self.domain != other.domain:
+            return False
+
+        if not np.array_equal(self.slopes, other.slopes):
+            return False
+
+        return bool(self.domain.monoid.iszero_many(self.vertexValues - other.vertexValues, self.index.gens).all())
+
+    # The divisor of self as an integer vector over the vertices of the index: the sum of the outgoing slopes along the
+    # edges and legs at each vertex
+    @property
+    def divisor(self):
+        return self.index.getDivisors(self.slopes)
+
+    # Returns the divisors of functions on the same domain as a (functions x vertices) integer matrix, computed with a
+    # single product of their stacked slopes against the incidence matrix of the domain
+    @staticmethod
+    def getDivisors(functions):
+        functions = list(functions)
+        assert len(functions) > 0
+        domain = functions[0].domain
+        assert all(f.domain == domain for f in functions)
+        return domain.index.getDivisors(np.stack([f.slopes for f in functions]))
+
+    # A hashable key of the pair (domain, self) that is the same for two functions exactly when some isomorphism of their
+    # domains (see CurveIndex.canonicalKey) carries the slopes of one to the slopes of the other, and the vertices where
+    # one vanishes to the vertices where the other does. Functions that only differ by an automorphism of the domain
+    # get the same key, so large sets of functions can be deduplicated with a dictionary or a set.
+    @property
+    def canonicalKey(self):
+        if self._canonicalKeyCache is None:
+            index = self.index
+            isZero = self.domain.monoid.iszero_many(self.vertexValues, index.gens)
+            legSlopes = [[] for _ in range(index.numVertices)]
+            for root, slope in zip(index.legRoots.tolist(), self.legSlopes.tolist()):
+                legSlopes[root].append(slope)
+
+            vertexLabels = [(v.genus, tuple(sorted(legSlopes[i])), bool(isZero[i]))
+                            for i, v in enumerate(index.vertices)]
+            # The slope of an edge read from vert2 to vert1 is the negative of its slope
+            edges = [(v1, v2, s, -s) for v1, v2, s in
+                     zip(index.edgeVert1.tolist(), index.edgeVert2.tolist(), self.edgeSlopes.tolist())]
+            self._canonicalKeyCache = CanonicalForm(vertexLabels, edges).key
+        return self._canonicalKeyCache
+
+    # Returns a pair of boolean masks (edgeMask, vertexMask) over the edges and vertices of the index. A vertex is in
+    # the special support if the function is nonzero there, and an edge is if either of its endpoints is.
+    @property
+    def specialSupportMasks(self):
+        vertexMask = ~self.domain.monoid.iszero_many(self.vertexValues, self.index.gens)
+        edgeMask = vertexMask[self.index.edgeVert1] | vertexMask[self.index.edgeVert2]
+        return edgeMask, vertexMask
+
+    # Same as PiecewiseLinearFunction.getSpecialSupport
+    def getSpecialSupport(self):
+        edgeMask, vertexMask = self.specialSupportMasks
+        supportEdges = {self.index.edges[i] for i in np.flatnonzero(edgeMask)}
+        supportVertices = {self.index.vertices[i] for i in np.flatnonzero(vertexMask)}
+        return supportEdges, supportVertices
+
+    # Returns the FunctionContraction of self to the contraction of its domain by the given edges
+    def getContraction(self, edges):
+        contraction = FunctionContraction.ofFunction(self)
+        for e in edges:
+            contraction = contraction.contract(self.index.edgeIndex[e])
+        return contraction
+
+    # Returns a dictionary whose keys are the edges of the domain, and whose values are the FunctionContractions of
+    # self to the contractions by single edges
+    def getEdgeContractions(self):
+        trivial = FunctionContraction.ofFunction(self)
+        return {e: trivial.contract(i) for i, e in enumerate(self.index.edges)}
+
+    # Returns a dictionary whose keys are all frozensets of edges of the domain (the faces of the cone of the domain),
+    # and whose values are the FunctionContractions of self to the contractions by those edges. Each contraction is
+    # obtained from a smaller one by contracting a single edge, so work on shared edges is only done once.
+    def getFaceContractions(self):
+        edges = self.index.edges
+        contractions = {frozenset(): FunctionContraction.ofFunction(self)}
+
+        # Visit the subsets by size, so that removing the last edge of a subset always gives one that is done
+        for size in range(1, len(edges) + 1):
+            for subset in itertools.combinations(range(len(edges)), size):
+                smaller = contractions[frozenset(edges[i] for i in subset[:-1])]
+                contractions[frozenset(edges[i] for i in subset)] = smaller.contract(subset[-1])
+
+        return contractions
+
+    # Returns the pushforward of self along a BasicFamilyMorphism, see getPushforwards. Fails if the pushforward is not
+    # well defined.
+    def getPushforward(self, morphism):
+        pushforward = self.getPushforwards([morphism])[0]
+        assert pushforward is not None, "The pushforward is not well defined."
+        return pushforward
+
+    # Returns the pushforwards of self along each of the given BasicFamilyMorphisms out of its domain, as a list. The
+    # pushforward along a morphism is a function on its codomain if it is surjective, and on morphism.imageCurve
+    # otherwise. Entries are None where the pushforward is not well defined, meaning that two edges, legs, or vertices
+    # with the same image disagree.
+    def getPushforwards(self, morphisms):
+        pushforwards = []
+        for morphism, arrays in zip(morphisms, self._getPushforwardArrays(morphisms)):
+            entry = self._pushforwardCache[morphism]
+            if arrays is None:
+                pushforwards.append(None)
+                continue
+
+            if entry[4] is None:
+                entry[4] = self._buildPushforward(morphism, *arrays)
+            pushforwards.append(entry[4])
+        return pushforwards
+
+    # Checks, for each morphism, whether the pushforward of self is well defined and agrees with the corresponding
+    # function on the codomain of that morphism, everywhere on the image. Returns a list of booleans.
+    def pushesForwardTo(self, morphisms, functions):
+        morphisms = list(morphisms)
+        results = []
+        for morphism, function, arrays in zip(morphisms, functions, self._getPushforwardArrays(morphisms)):
+            assert function.domain == morphism.codomain, "The functions should be defined on the codomains."
+            if arrays is None:
+                results.append(False)
+                continue
+
+            results.append(ArrayPiecewiseLinearFunction._agreesOnImage(arrays, function.slopes, function.vertexValues,
+                                                                       function.domain.monoid, function.index.gens))
+        return results
+
+    # Checks if the pushforward arrays (see _getPushforwardArrays) agree with the given slopes and vertex values of a
+    # function on the codomain, on the image of the morphism
+    @staticmethod
+    def _agreesOnImage(arrays, slopes, vertexValues, monoid, gens):
+        pushforwardSlopes, pushforwardValues, slopeIsHit, vertexIsHit = arrays
+        difference = pushforwardValues[vertexIsHit] - vertexValues[vertexIsHit]
+        return bool(np.array_equal(pushforwardSlopes[slopeIsHit], slopes[slopeIsHit]) and
+                    monoid.iszero_many(difference, gens).all())
+
+    # Computes the pushforwards of self along the morphisms as arrays over the indices of their codomains, in a list of
+    # tuples (slopes, vertexValues, slopeIsHit, vertexIsHit), where the masks say which slopes and vertices lie in the
+    # image. Entries are None where the pushforward is not well defined. The values along all morphisms that are not
+    # cached yet are computed with a single product against their stacked value matrices (see
+    # BasicFamilyMorphism.valueMatrix); everything else is moving entries around with the index maps.
+    def _getPushforwardArrays(self, morphisms):
+        morphisms = list(morphisms)
+        for morphism in morphisms:
+            assert morphism.domain == self.domain, "morphism and self should have the same domain."
+
+        # Cache entries are [domain index, codomain index, morphism revision, arrays, function], and only valid for the
+        # indices and the revision of the morphism (see BasicFamilyMorphism.revision) they were computed with
+        missing = []
+        for morphism in morphisms:
+            entry = self._pushforwardCache.get(morphism)
+            if entry is None or entry[0] is not morphism.domain.index or entry[1] is not morphism.codomain.index or \
+                    entry[2] != morphism.revision:
+                if morphism not in missing:
+                    missing.append(morphism)
+
+        if missing:
+            matrices = [morphism.valueMatrix for morphism in missing]
+            splits = np.cumsum([len(matrix) for matrix, _ in matrices])[:-1]
+            allValues = self.vertexValues @ np.concatenate([matrix for matrix, _ in matrices]).T
+
+            for morphism, (_, denom), values in zip(missing, matrices, np.split(allValues, splits, axis=1)):
+                if denom != 1:
+                    if np.any(values % denom != 0):
+                        raise ValueError("Function values must have denominator one.")
+                    values = values // denom
+                arrays = self._scatterPushforward(morphism, values)
+                self._pushforwardCache[morphism] = [morphism.domain.index, morphism.codomain.index, morphism.revision,
+                                                    arrays, None]
+
+        return [self._pushforwardCache[morphism][3] for morphism in morphisms]
+
+    # Returns what getPushforwardArraysFromPayload needs to push self forward along the morphism, as a picklable tuple
+    # of arrays that does not refer to the function, the morphism, or their monoids: the slopes and vertex values of
+    # self, the index maps and value matrix of the morphism (see BasicFamilyMorphism), the numbers of vertices, edges,
+    # and legs of the codomain, and the relations of the codomain monoid as a RelationArray
+    def getPushforwardPayload(self, morphism):
+        assert morphism.domain == self.domain, "morphism and self should have the same domain."
+        codomainIndex = morphism.codomain.index
+        matrix, denom = morphism.valueMatrix
+        return (self.slopes, self.vertexValues, morphism.indexMaps, matrix, denom,
+                (codomainIndex.numVertices, codomainIndex.numEdges, codomainIndex.numLegs),
+                morphism.codomain.monoid.relation_array(codomainIndex.gens))
+
+    # Computes the pushforward arrays (see _getPushforwardArrays) out of a payload of getPushforwardPayload, so that it
+    # can run in a worker process. Returns None if the pushforward is not well defined.
+    @staticmethod
+    def getPushforwardArraysFromPayload(payload):
+        slopes, vertexValues, indexMaps, matrix, denom, codomainSizes, relations = payload
+        values = vertexValues @ matrix.T
+        if denom != 1:
+            if np.any(values % denom != 0):
+                raise ValueError("Function values must have denominator one.")
+            values = values // denom
+
+        # The relations stand in for the codomain monoid, which is only needed to compare values
+        return ArrayPiecewiseLinearFunction._scatterArrays(indexMaps, codomainSizes, slopes, values, relations, None)
+
+    # Returns the pushforward of self along the morphism out of the arrays computed by getPushforwardArraysFromPayload,
+    # and caches it as if getPushforward had computed it
+    def getPushforwardFromArrays(self, morphism, arrays):
+        assert arrays is not None, "The pushforward is not well defined."
+        pushforward = self._buildPushforward(morphism, *arrays)
+        self._pushforwardCache[morphism] = [morphism.domain.index, morphism.codomain.index, morphism.revision, arrays,
+                                            pushforward]
+        return pushforward
+
+    # Moves the slopes of self and the given pushed forward values to the indices of their images under the morphism
+    def _scatterPushforward(self, morphism, values):
+        codomainIndex = morphism.codomain.index
+        codomainSizes = (codomainIndex.numVertices, codomainIndex.numEdges, codomainIndex.numLegs)
+        return ArrayPiecewiseLinearFunction._scatterArrays(morphism.indexMaps, codomainSizes, self.slopes, values,
+                                                           morphism.codomain.monoid, codomainIndex.gens)
+
+    # Same as _scatterPushforward, but only using arrays: indexMaps as in BasicFamilyMorphism.indexMaps, codomainSizes
+    # the numbers of vertices, edges, and legs of the codomain, slopes the slopes of the function, and values its
+    # pushed forward values (vertices x codomain generators). The monoid and its generators are only used to compare
+    # values.
+    @staticmethod
+    def _scatterArrays(indexMaps, codomainSizes, slopes, values, monoid, gens):
+        vertexMap, edgeMap, edgeSigns, legMap = indexMaps
+        numCodomainVertices, numCodomainEdges, numCodomainLegs = codomainSizes
+        numEdges = len(edgeMap)
+
+        # Vertices with the same image must have the same value
+        vertexValues = np.zeros((numCodomainVertices, values.shape[1]), dtype=np.int64)
+        vertexValues[vertexMap] = values
+        if not monoid.iszero_many(vertexValues[vertexMap] - values, gens).all():
+            return None
+        vertexIsHit = np.zeros(numCodomainVertices, dtype=bool)
+        vertexIsHit[vertexMap] = True
+
+        # Edges and legs with the same image must have the same slope, once the orientations agree
+        kept = edgeMap >= 0
+        targets = np.concatenate([edgeMap[kept], numCodomainEdges + legMap])
+        sources = np.concatenate([edgeSigns[kept] * slopes[:numEdges][kept], slopes[numEdges:]])
+        pushforwardSlopes = np.zeros(numCodomainEdges + numCodomainLegs, dtype=np.int64)
+        pushforwardSlopes[targets] = sources
+        if not np.array_equal(pushforwardSlopes[targets], sources):
+            return None
+        slopeIsHit = np.zeros(len(pushforwardSlopes), dtype=bool)
+        slopeIsHit[targets] = True
+
+        return pushforwardSlopes, vertexValues, slopeIsHit, vertexIsHit
+
+    # Builds the pushforward function out of its arrays over the index of the codomain
+    def _buildPushforward(self, morphism, slopes, vertexValues, slopeIsHit, vertexIsHit):
+        if slopeIsHit.all() and vertexIsHit.all():
+            return ArrayPiecewiseLinearFunction._fromTrustedArrays(morphism.codomain, slopes, vertexValues,
+                                                                   self.isValidated)
+
+        # Otherwise, restrict to the image of the morphism
+        codomainIndex = morphism.codomain.index
+        image = morphism.imageCurve
+        imageIndex = image.index
+        slopePositions = [codomainIndex.slopeIndex(x) for x in imageIndex.edges + imageIndex.legs]
+        vertexPositions = [codomainIndex.vertexIndex[v] for v in imageIndex.vertices]
+        generatorPositions = [codomainIndex.gens.index(gen) for gen in imageIndex.gens]
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(image, slopes[slopePositions],
+                                                               vertexValues[vertexPositions][:, generatorPositions],
+                                                               self.isValidated)
+
+    # Same as PiecewiseLinearFunction.mesaTest
+    @property
+    def mesaTest(self):
+        return ArrayPiecewiseLinearFunction.isMesa(self.domain, self.slopes, self.vertexValues)
+
+    # Performs the checks of PiecewiseLinearFunction.mesaTest on the function with the given slopes and vertex values
+    # (indexed like domain.index) without building a function object. The slopes and values are assumed to be
+    # compatible.
+    @staticmethod
+    def isMesa(domain, slopes, vertexValues):
+        index = domain.index
+        monoid = domain.monoid
+        gens = index.gens
+        lengths = index.lengths
+        edgeVert1 = index.edgeVert1
+        edgeVert2 = index.edgeVert2
+
+        # A mesa must have slope and value zero on all legs
+        isZero = monoid.iszero_many(vertexValues, gens)
+        if np.any(slopes[index.numEdges:] != 0) or not isZero[index.legRoots].all():
+            return False
+
+        supportMask = ~isZero
+        vertexLabels, edgeLabels = index.getComponentLabels(supportMask)
+
+        # The change of the function along each edge, from vert1 to vert2
+        rises = vertexValues[edgeVert2] - vertexValues[edgeVert1]
+        riseIsZero = monoid.iszero_many(rises, gens)
+
+        # The rest of the checks must hold for each connected component of the support
+        for label in range(int(vertexLabels.max()) + 1 if vertexLabels.size else 0):
+            componentVertices = np.flatnonzero(vertexLabels == label)
+            componentEdges = np.flatnonzero(edgeLabels == label)
+            support = BasicFamilyView(domain, [index.vertices[v] for v in componentVertices],
+                                      [index.edges[e] for e in componentEdges], name_="support")
+
+            # Each component of the support must have genus 1
+            if support.genus != 1:
+                return False
+
+            # The function must be constant over the core
+            supportCore = support.core
+            coreMask = index.getVertexMask(supportCore.vertices)
+            coreValues = vertexValues[coreMask]
+            if not monoid.iszero_many(coreValues - coreValues[0], gens).all():
+                return False
+
+            # Every vertex of the support must lie on a path from the core to a vertex outside of the support
+            if not index.getVerticesBetween(coreMask, isZero)[componentVertices].all():
+                return False
+
+            # The function must have slope 0 or 1 on every edge out of the core, oriented towards the core
+            edgesToCheck = componentEdges[~index.getEdgeMask(supportCore.edges)[componentEdges]]
+            vert1IsNearer = index.getVert1IsNearer(coreMask & supportMask)[edgesToCheck]
+            risesTowardsCore = np.where(vert1IsNearer[:, None], -rises[edgesToCheck], rises[edgesToCheck])
+            if not (riseIsZero[edgesToCheck] |
+                    monoid.iszero_many(risesTowardsCore - lengths[edgesToCheck], gens)).all():
+                return False
+
+            # Some edge adjacent to the core must have nonzero slope
+            adjacentToCore = coreMask[edgeVert1[componentEdges]] != coreMask[edgeVert2[componentEdges]]
+            if not np.any(adjacentToCore & ~riseIsZero[componentEdges]):
+                return False
+
+        return True
+
+
+# A piecewise linear function pushed down to the contraction of its domain by a set of edges, computed from the arrays
+# of an ArrayPiecewiseLinearFunction without building the contracted curve (see getCurve and toFunction for that).
+#
+# The vertices of the contraction are classes of vertices of the domain, numbered in order of their first vertex. The
+# remaining edges keep their slopes and lengths. The contraction of a function is only defined if its slopes still
+# integrate to zero around every loop of the contracted curve, which is reported by isWellDefined. When it is defined,
+# the values agree with the original function on the class of the first vertex of each connected component.
+class FunctionContraction(object):
+    # function_ should be the ArrayPiecewiseLinearFunction being contracted
+    # contractedEdges_ should be a frozenset of indices of the contracted edges
+    # vertexClasses_ should be an integer vector taking each vertex index of the domain to the index of its class
+    # edges_ should be the sorted list of indices of the edges that were not contracted
+    # slopes_ and vertexValues_ should be the slopes on the remaining edges and the legs, and the values at the classes,
+    # or None if the contraction is not well defined
+    def __init__(self, function_, contractedEdges_, vertexClasses_, edges_, slopes_, vertexValues_):
+        self.function = function_
+        self.contractedEdges = contractedEdges_
+        self.vertexClasses = vertexClasses_
+        self.edges = edges_
+        self.slopes = slopes_
+        self.vertexValues = vertexValues_
+
+    # The contraction by no edges
+    @staticmethod
+    def ofFunction(function):
+        index = function.index
+        return FunctionContraction(function, frozenset(), np.arange(index.numVertices), list(range(index.numEdges)),
+                                   function.slopes, function.vertexValues)
+
+    @property
+    def isWellDefined(self):
+        return self.vertexValues is not None
+
+    @property
+    def numClasses(self):
+        return int(self.vertexClasses.max()) + 1 if self.vertexClasses.size else 0
+
+    # Returns the contraction of self by one more edge, given by its index in the domain
+    def contract(self, e):
+        assert e in self.edges, "The edge should not be contracted yet."
+        index = self.function.index
+        a = int(self.vertexClasses[index.edgeVert1[e]])
+        b = int(self.vertexClasses[index.edgeVert2[e]])
+        position = self.edges.index(e)
+        remainingEdges = self.edges[:position] + self.edges[position + 1:]
+
+        # Merge the class of the second endpoint into the class of the first, and renumber the classes in order
+        keep = np.ones(self.numClasses, dtype=bool)
+        newClass = np.arange(self.numClasses)
+        if a != b:
+            keep[max(a, b)] = False
+            newClass[max(a, b)] = min(a, b)
+            newClass = np.cumsum(keep)[newClass] - 1
+        vertexClasses = newClass[self.vertexClasses]
+
+        if not self.isWellDefined:
+            return FunctionContraction(self.function, self.contractedEdges | {e}, vertexClasses, remainingEdges,
+                                       None, None)
+
+        monoid = index.monoid
+        values = self.vertexValues
+        rise = values[b] - values[a]
+        if a != b and not monoid.iszero_many(rise, index.gens):
+            # The endpoints have different values. If they are joined by a path of remaining edges, then contracting e
+            # closes a loop whose integral is the rise along e, and the contraction is not defined. Otherwise, e is a
+            # bridge, and the values on the side of b are shifted to agree with a.
+            unionFind = UnionFind(self.numClasses)
+            for f in remainingEdges:
+                unionFind.union(int(self.vertexClasses[index.edgeVert1[f]]),
+                                int(self.vertexClasses[index.edgeVert2[f]]))
+            if unionFind.find(a) == unionFind.find(b):
+                return FunctionContraction(self.function, self.contractedEdges | {e}, vertexClasses, remainingEdges,
+                                           None, None)
+
+            # The side holding the first class of the component keeps its values
+            roots = np.array([unionFind.find(c) for c in range(self.numClasses)])
+            sideA = roots == unionFind.find(a)
+            sideB = roots == unionFind.find(b)
+            values = values.copy()
+            if np.flatnonzero(sideB)[0] < np.flatnonzero(sideA)[0]:
+                values[sideA] += rise
+            else:
+                values[sideB] -= rise
+
+        slopes = np.delete(self.slopes, position)
+        return FunctionContraction(self.function, self.contractedEdges | {e}, vertexClasses, remainingEdges,
+                                   slopes, values[keep])
+
+    # Builds the contracted curve. Returns the curve along with lists of its vertices (one for each class), edges (one
+    # for each remaining edge), and legs, in order. Vertex genera are computed like BasicFamily.contract does.
+    def getCurve(self):
+        function = self.function
+        index = function.index
+        domain = function.domain
+        monoidCopy = domain.monoid.copy()
+
+        classGenera = np.zeros(self.numClasses, dtype=np.int64)
+        np.add.at(classGenera, self.vertexClasses, [v.genus - 1 for v in index.vertices])
+        np.add.at(classGenera, self.vertexClasses[index.edgeVert1[sorted(self.contractedEdges)]], 1)
+        classGenera += 1
+
+        classNames = [[] for _ in range(self.numClasses)]
+        for v, c in zip(index.vertices, self.vertexClasses.tolist()):
+            classNames[c].append(v.name)
+        vertices = [Vertex(names[0] if len(names) == 1 else "(Contraction of " + ", ".join(names) + ")", int(genus))
+                    for names, genus in zip(classNames, classGenera)]
+
+        edges = []
+        for f in self.edges:
+            e = index.edges[f]
+            length = monoidCopy.Element(dict(e.length.coeffs), e.length.denom)
+            edges.append(Edge(e.name, length, vertices[self.vertexClasses[index.edgeVert1[f]]],
+                              vertices[self.vertexClasses[index.edgeVert2[f]]]))
+        legs = [Leg(nextLeg.name, vertices[self.vertexClasses[index.legRoots[i]]])
+                for i, nextLeg in enumerate(index.legs)]
+
+        curve = BasicFamily(domain.name + " / {" + ", ".join(index.edges[f].name
+                                                             for f in sorted(self.contractedEdges)) + "}")
+        curve.addEdges(edges)
+        curve.addLegs(legs)
+        curve.addVertices(vertices)
+        curve.monoid = monoidCopy
+        return curve, vertices, edges, legs
+
+    # Builds the contracted curve and the contracted function on it, as an ArrayPiecewiseLinearFunction
+    def toFunction(self):
+        assert self.isWellDefined, "The contraction of the function is not well defined."
+        curve, vertices, edges, legs = self.getCurve()
+        index = curve.index
+
+        slopeOrder = np.argsort([index.edgeIndex[e] for e in edges] +
+                                [index.numEdges + index.legIndex[nextLeg] for nextLeg in legs])
+        vertexOrder = np.argsort([index.vertexIndex[v] for v in vertices])
+        return ArrayPiecewiseLinearFunction._fromTrustedArrays(curve, self.slopes[slopeOrder],
+                                                               self.vertexValues[vertexOrder],
+                                                               self.function.isValidated)
@@ -2,6 +2,8 @@ import numpy as np
 from .GraphIsoHelper import *
 from .RPC import *
 
+from .BasicFamilyView import BasicFamilyView
+from .CurveIndex import CurveIndex
 from .Edge import Edge
 from .Leg import Leg
 from .Vertex import Vertex
@@ -33,11 +35,16 @@ class BasicFamily(object):
         self._coreCacheValid = False
         self._coreCache = None
 
+        # Variables for caching the integer index of the curve
+        self._indexCacheValid = False
+        self._indexCache = None
+
     def invalidateCaches(self):
         self._vertexCacheValid = False
         self._genusCacheValid = False
         self._vertexCharacteristicCacheValid = False
         self._coreCacheValid = False
+        self._indexCacheValid = False
 
     # The set of vertices is a read only property computed upon access, unless a valid cache is available
     # It is the collection of vertices that are endpoints of edges or roots of legs
@@ -175,6 +182,21 @@ class BasicFamily(object):
     def numEdgesWithVertices(self):
         return len(self.edgesWithVertices)
 
+    # An integer indexing of the curve used by array based computations. See CurveIndex.
+    @property
+    def index(self):
+        # Adding generators to the monoid does not invalidate the caches of the curve, so check for that here
+        if not self._indexCacheValid or self._indexCache.monoid is not self.monoid or \
+                self._indexCache.gens != self.monoid.gens:
+            self._indexCache = CurveIndex(self)
+            self._indexCacheValid = True
+        return self._indexCache
+
+    # A hashable key that two curves share exactly when they are isomorphic, see CurveIndex.canonicalKey
+    @property
+    def canonicalKey(self):
+        return self.index.canonicalKey
+
     # The Betti number is a read only property computed upon access
     @property
     def bettiNumber(self):
@@ -216,11 +238,18 @@ class BasicFamily(object):
             if returnCopyInfo:
                 copyInfo[v] = vCopy
 
+        # The copy gets its own monoid so that adding generators to one curve does not affect the other
+        monoidCopy = self.monoid.copy()
+
         # Next, copy edges and legs
         edgeCopies = set()
         for nextEdge in self.edges:
-            # Keep the same name and length, but use the new versions of endpoints
-            nextEdgeCopy = Edge(nextEdge.name, nextEdge.length,
+            # Keep the same name and length, but use the new versions of endpoints. Lengths are moved over to the
+            # monoid of the copy.
+            length = nextEdge.length
+            if isinstance(length, self.monoid.Element):
+                length = monoidCopy.Element(dict(length.coeffs), length.denom)
+            nextEdgeCopy = Edge(nextEdge.name, length,
                                 vertexCopyDict[nextEdge.vert1], vertexCopyDict[nextEdge.vert2])
             edgeCopies.add(nextEdgeCopy)
 
@@ -240,7 +269,7 @@ class BasicFamily(object):
         curveCopy = BasicFamily(self.name)
         curveCopy.addEdges(edgeCopies)
         curveCopy.addLegs(legCopies)
-        curveCopy.monoid = copy.copy(self.monoid)
+        curveCopy.monoid = monoidCopy
 
         if returnCopyInfo:
             return curveCopy, copyInfo
@@ -289,6 +318,32 @@ class BasicFamily(object):
         else:
             return contraction
 
+    # Returns the BasicFamilyMorphism from self to its contraction by e, which collapses e to the new vertex and keeps
+    # every other edge and leg. The length of e must only involve generators of the monoid that no other edge uses; the
+    # monoid morphism sends those to zero and every other generator to itself.
+    def getContractionMorphism(self, e):
+        contraction, copyInfo = self.getContraction(e, True)
+
+        # The new vertex is the only vertex of the contraction that is not the copy of a vertex of self
+        contractedVertex = (contraction.vertices - {copyInfo[v] for v in self.vertices}).pop()
+
+        curveMorphismDict = {}
+        for v in self.vertices:
+            curveMorphismDict[v] = contractedVertex if v in e.vertices else copyInfo[v]
+        for nextEdge in self.edges:
+            curveMorphismDict[nextEdge] = contractedVertex if nextEdge == e else copyInfo[nextEdge]
+        for nextLeg in self.legs:
+            curveMorphismDict[nextLeg] = copyInfo[nextLeg]
+
+        collapsedGens = set(e.length.coeffs)
+        assert not any(collapsedGens & set(nextEdge.length.coeffs) for nextEdge in self.edges - {e}), \
+            "The length of the contracted edge should not share generators with other edges."
+        gens = list(self.monoid.gens)
+        matrix = np.diag([0 if gen in collapsedGens else 1 for gen in gens]).astype(np.int64)
+        monoidMorphism = MonoidHomomorphism(self.monoid, contraction.monoid, matrix)
+
+        return BasicFamilyMorphism(self, contraction, curveMorphismDict, monoidMorphism, validate=False)
+
     # v should be a vertex
     # Returns the set of all elements of the form (e, n), where e is an edge or leg, n is 1 or 2,
     # and the n^th endpoint of e is v
@@ -391,6 +446,34 @@ class BasicFamily(object):
     def isIsomorphicTo(self, other):
         return GraphIsoHelper.isIsomorphicTo(self, other)
 
+    # Returns an isomorphism from self to other, in the sense of isIsomorphicTo, as a dictionary sending the vertices,
+    # edges, and legs of self to those of other, or None if there is none. The vertices are matched through the
+    # canonical orders of the two curves (see CurveIndex.canonicalForm); edges with the same endpoints, and legs with
+    # the same root, are then interchangeable and are matched in an arbitrary order.
+    def getIsomorphismTo(self, other):
+        index = self.index
+        otherIndex = other.index
+        if index.canonicalKey != otherIndex.canonicalKey:
+            return None
+
+        isomorphism = {}
+        for i, j in zip(index.canonicalForm.order, otherIndex.canonicalForm.order):
+            isomorphism[index.vertices[i]] = otherIndex.vertices[j]
+
+        otherEdges = {}
+        for nextEdge in other.edges:
+            otherEdges.setdefault(frozenset(nextEdge.vertices), []).append(nextEdge)
+        for nextEdge in self.edges:
+            isomorphism[nextEdge] = otherEdges[frozenset(isomorphism[v] for v in nextEdge.vertices)].pop()
+
+        otherLegs = {}
+        for nextLeg in other.legs:
+            otherLegs.setdefault(nextLeg.root, []).append(nextLeg)
+        for nextLeg in self.legs:
+            isomorphism[nextLeg] = otherLegs[isomorphism[nextLeg.root]].pop()
+
+        return isomorphism
+
     # Simplifies names of vertices, edges, and legs in place.
     def simplifyNames(self):
         orderedVertices = list(self.vertices)
@@ -681,7 +764,10 @@ class BasicFamily(object):
 
 
 class BasicFamilyMorphism(object):
-    def __init__(self, domain, codomain, curveMorphismDict, monoidMorphism):
+    # validate may be set to False to skip the checks that curveMorphismDict and monoidMorphism define a morphism of
+    # basic families until validate is called. This is meant for morphisms built by code that knows they are valid,
+    # such as getContractionMorphism.
+    def __init__(self, domain, codomain, curveMorphismDict, monoidMorphism, validate=True):
 
         # Type checking
         assert isinstance(domain, BasicFamily), "The domain of a basic family morphism should be a BasicFamily."
@@ -696,78 +782,270 @@ class BasicFamilyMorphism(object):
 
         self.domain = domain
         self.codomain = codomain
-        self.curveMorphismDict = curveMorphismDict
-        self.monoidMorphism = monoidMorphism
+        self._curveMorphismDict = curveMorphismDict
+        self._monoidMorphism = monoidMorphism
+
+        # Counts the changes to the morphism, so that results cached elsewhere (such as pushforwards, see
+        # ArrayPiecewiseLinearFunction.getPushforwards) can tell whether they are still valid
+        self.revision = 0
+
+        self.invalidateCaches()
+        if validate:
+            self.validate()
+
+    # Returns the morphism with the given curveMorphismDict whose monoid morphism sends the generator of the length of
+    # each edge of the domain to the length of its image, or to zero if the edge is collapsed, and every other
+    # generator to zero. The length of every edge of the domain should be its own generator of the monoid, as in the
+    # curves of a moduli space; otherwise a ValueError is raised.
+    @staticmethod
+    def fromCurveMorphism(domain, codomain, curveMorphismDict, validate=True):
+        images = {gen: codomain.monoid.zero() for gen in domain.monoid.gens}
+        edgeGens = set()
+        for nextEdge in domain.edges:
+            coeffs = nextEdge.length.coeffs
+            if len(coeffs) != 1 or set(coeffs.values()) != {1} or nextEdge.length.denom != 1 or \
+                    coeffs.keys() & edgeGens:
+                raise ValueError("The length of every edge should be its own generator of the monoid.")
+            gen = next(iter(coeffs))
+            edgeGens.add(gen)
+            image = curveMorphismDict[nextEdge]
+            if image in codomain.edges:
+                images[gen] = image.length
+
+        monoidMorphism = MonoidHomomorphism(domain.monoid, codomain.monoid, images, validate=False)
+        return BasicFamilyMorphism(domain, codomain, curveMorphismDict, monoidMorphism, validate)
+
+    @property
+    def curveMorphismDict(self):
+        return self._curveMorphismDict
+
+    # Replacing curveMorphismDict or monoidMorphism changes the morphism, so everything computed from it is dropped and
+    # it has to be validated again
+    @curveMorphismDict.setter
+    def curveMorphismDict(self, curveMorphismDict_):
+        self._curveMorphismDict = curveMorphismDict_
+        self.invalidateCaches()
+
+    @property
+    def monoidMorphism(self):
+        return self._monoidMorphism
+
+    @monoidMorphism.setter
+    def monoidMorphism(self, monoidMorphism_):
+        self._monoidMorphism = monoidMorphism_
+        self.invalidateCaches()
+
+    # Drops the inverse map, the image and preimages, the index maps, and the value matrix, forgets that the morphism
+    # was validated, and increases revision. This happens whenever curveMorphismDict or monoidMorphism is replaced, and
+    # should be called after changing curveMorphismDict in place.
+    def invalidateCaches(self):
+        self._isValidated = False
+        self.revision += 1
+
+        # Variables for caching the inverse of curveMorphismDict
+        self._inverseMapCache = None
+
+        # Variables for caching the image and preimages (see image and preimage)
+        self._imageCache = None
+        self._imageCurveCache = None
+        self._preimageCache = {}
+
+        # Variables for caching the array forms of the morphism
+        self._indexMapsCache = None
+        self._valueMatrixCache = None
+
+    # Whether the morphism is known to be a morphism of basic families
+    @property
+    def isValidated(self):
+        return self._isValidated
+
+    # Checks that curveMorphismDict and monoidMorphism define a morphism of basic families, unless that is already
+    # known. Everything is checked in a single pass over the domain: the preimages of the codomain vertices are only
+    # counted, and the edge lengths are all mapped with one product against the matrix of monoidMorphism.
+    def validate(self):
+        if self._isValidated:
+            return self
+
+        domain = self.domain
+        codomain = self.codomain
+        curveMorphismDict = self.curveMorphismDict
+        codomainVertices = codomain.vertices
+        codomainEdges = codomain.edges
+        codomainLegs = codomain.legs
 
         # Make sure that the given curveMorphismDict is actually a function from domain to codomain...
-        assert set(curveMorphismDict.keys()) == domain.vertices | domain.edges | domain.legs, \
+        assert curveMorphismDict.keys() == domain.vertices | domain.edges | domain.legs, \
             "The keys of curveMorphismDict should be the vertices, edges, and legs of the domain curve."
+
+        # The preimage of a codomain vertex is a curve, so its genus is its number of edges, minus its number of
+        # vertices, plus one, plus the genera of its vertices. These are accumulated in preimageGenus.
+        preimageGenus = {vert: 1 for vert in codomainVertices}
         for vert in domain.vertices:
-            assert curveMorphismDict[vert] in codomain.vertices, \
-                "curveMorphismDict should map vertices to vertices of the codomain curve."
-        for nextEdge in domain.edges:
-            assert curveMorphismDict[nextEdge] in codomain.vertices | codomain.edges, \
-                "curveMorphismDict should map edges to vertices or edges of the codomain curve."
-        for nextLeg in domain.legs:
-            assert curveMorphismDict[nextLeg] in codomain.legs, \
-                "curveMorphismDict should map legs to legs of the codomain curve."
+            image = curveMorphismDict[vert]
+            assert image in codomainVertices, "curveMorphismDict should map vertices to vertices of the codomain curve."
+            preimageGenus[image] += vert.genus - 1
 
         # Make sure that the given curveMorphismDict is actually a homomorphism...
         for nextLeg in domain.legs:
-            assert curveMorphismDict[nextLeg.root] == curveMorphismDict[nextLeg].root, \
-                "curveMorphismDict should preserve leg roots."
+            image = curveMorphismDict[nextLeg]
+            assert image in codomainLegs, "curveMorphismDict should map legs to legs of the codomain curve."
+            assert curveMorphismDict[nextLeg.root] == image.root, "curveMorphismDict should preserve leg roots."
+
+        lengths = []
+        imageLengths = []
         for nextEdge in domain.edges:
-            if curveMorphismDict[nextEdge] in codomain.edges:
-                assert set(map(lambda v: curveMorphismDict[v], nextEdge.vertices)) == curveMorphismDict[nextEdge].vertices, \
+            image = curveMorphismDict[nextEdge]
+            if image in codomainEdges:
+                assert {curveMorphismDict[v] for v in nextEdge.vertices} == image.vertices, \
                     "curveMorphismDict should preserve endpoints of non-collapsed edges."
-                assert monoidMorphism(nextEdge.length) == curveMorphismDict[nextEdge].length, \
-                    "curveMorphismDict and monoidMorphism should be compatible on edge lengths."
-            if curveMorphismDict[nextEdge] in codomain.vertices:
-                assert curveMorphismDict[nextEdge] == curveMorphismDict[nextEdge.vert1] and \
-                    curveMorphismDict[nextEdge] == curveMorphismDict[nextEdge.vert2], \
+                imageLengths.append(image.length)
+            elif image in codomainVertices:
+                assert curveMorphismDict[nextEdge.vert1] == image and curveMorphismDict[nextEdge.vert2] == image, \
                     "curveMorphismDict should preserve endpoints of collapsed edges."
-                assert monoidMorphism(nextEdge.length) == codomain.monoid.zero(), \
-                    "curveMorphismDict and monoidMorphism should be compatible on edge lengths."
-        for vert in codomain.vertices:
-            assert self.preimage(vert).genus == vert.genus, \
-                "curveMorphismDict should preserve genus."
-
-    # Returns the preimage of the given vertex as a BasicFamily
+                preimageGenus[image] += 1
+                imageLengths.append(codomain.monoid.zero())
+            else:
+                raise AssertionError("curveMorphismDict should map edges to vertices or edges of the codomain curve.")
+            lengths.append(nextEdge.length)
+
+        assert self._mapsLengthsTo(lengths, imageLengths), \
+            "curveMorphismDict and monoidMorphism should be compatible on edge lengths."
+        assert all(preimageGenus[vert] == vert.genus for vert in codomainVertices), \
+            "curveMorphismDict should preserve genus."
+
+        self._isValidated = True
+        return self
+
+    # Checks if monoidMorphism maps each of the given lengths to the corresponding image length
+    def _mapsLengthsTo(self, lengths, imageLengths):
+        if not lengths:
+            return True
+        F = self.monoidMorphism
+        A, d = self.domain.monoid.to_array(lengths, F.domaingens)
+        images, imageDenominators = F.apply_array(A, d)
+        targets, targetDenominators = self.codomain.monoid.to_array(imageLengths, F.codomaingens)
+
+        # Compare the fractions images / imageDenominators and targets / targetDenominators
+        difference = images * targetDenominators[:, None] - targets * imageDenominators[:, None]
+        return bool(self.codomain.monoid.iszero_many(difference, F.codomaingens).all())
+
+    # The inverse of curveMorphismDict: a dictionary whose keys are the vertices, edges, and legs of the codomain, and
+    # whose values are the sets of vertices, edges, and legs of the domain that are mapped to them
+    @property
+    def inverseMap(self):
+        if self._inverseMapCache is None:
+            inverseMap = {x: set() for x in self.codomain.vertices | self.codomain.edges | self.codomain.legs}
+            for x, image in self.curveMorphismDict.items():
+                inverseMap.setdefault(image, set()).add(x)
+            self._inverseMapCache = inverseMap
+        return self._inverseMapCache
+
+    # Returns the composition self o other, which first applies other and then self (like MonoidHomomorphism.compose).
+    # A composition of validated morphisms is a morphism, so it is not validated again.
+    def compose(self, other):
+        assert isinstance(other, BasicFamilyMorphism), "other should be a morphism of basic families."
+        assert other.codomain == self.domain, "The codomain of other should be the domain of self."
+
+        curveMorphismDict = {x: self.curveMorphismDict[image] for x, image in other.curveMorphismDict.items()}
+        monoidMorphism = self.monoidMorphism.compose(other.monoidMorphism)
+        composition = BasicFamilyMorphism(other.domain, self.codomain, curveMorphismDict, monoidMorphism,
+                                          validate=False)
+        composition._isValidated = self.isValidated and other.isValidated
+        return composition
+
+    # A hashable key that two morphisms share exactly when they have the same domain and codomain, send every vertex,
+    # edge, and leg to the same place, and have the same monoid homomorphism (compared over the generators of the
+    # domain and codomain indices, as a reduced fraction)
+    @property
+    def comparisonKey(self):
+        matrix, denom = self.valueMatrix
+        divisor = int(np.gcd.reduce(matrix.ravel(), initial=denom))
+        return (id(self.domain), id(self.codomain), frozenset(self.curveMorphismDict.items()),
+                matrix.shape, (matrix // divisor).tobytes(), denom // divisor)
+
+    # Integer versions of curveMorphismDict over the indices of the domain and codomain (see CurveIndex), as a tuple
+    # (vertexMap, edgeMap, edgeSigns, legMap) of integer vectors. vertexMap[v] is the index of the image of vertex v.
+    # edgeMap[e] is the index of the image of edge e, or -1 if e is collapsed, and edgeSigns[e] is -1 if the image
+    # runs the other way around (and 1 otherwise). legMap[l] is the index of the image of leg l. The maps are rebuilt
+    # whenever the index of the domain or codomain changes.
+    @property
+    def indexMaps(self):
+        domainIndex = self.domain.index
+        codomainIndex = self.codomain.index
+        if self._indexMapsCache is None or self._indexMapsCache[0] is not domainIndex or \
+                self._indexMapsCache[1] is not codomainIndex:
+            vertexMap = np.array([codomainIndex.vertexIndex[self.curveMorphismDict[v]] for v in domainIndex.vertices],
+                                 dtype=np.int64)
+            edgeMap = np.array([codomainIndex.edgeIndex.get(self.curveMorphismDict[e], -1) for e in domainIndex.edges],
+                               dtype=np.int64)
+            legMap = np.array([codomainIndex.legIndex[self.curveMorphismDict[nextLeg]] for nextLeg in domainIndex.legs],
+                              dtype=np.int64)
+
+            kept = edgeMap >= 0
+            edgeSigns = np.ones(domainIndex.numEdges, dtype=np.int64)
+            edgeSigns[kept] = np.where(vertexMap[domainIndex.edgeVert1[kept]] == codomainIndex.edgeVert1[edgeMap[kept]],
+                                       1, -1)
+
+            self._indexMapsCache = (domainIndex, codomainIndex, (vertexMap, edgeMap, edgeSigns, legMap))
+        return self._indexMapsCache[2]
+
+    # The matrix of monoidMorphism with rows and columns in the order of the generators of the codomain and domain
+    # indices, and its denominator, as a pair. The values of a function (one row per vertex, as in
+    # ArrayPiecewiseLinearFunction) are pushed forward by multiplying with the transpose and dividing by the
+    # denominator.
+    @property
+    def valueMatrix(self):
+        domainIndex = self.domain.index
+        codomainIndex = self.codomain.index
+        if self._valueMatrixCache is None or self._valueMatrixCache[0] is not domainIndex or \
+                self._valueMatrixCache[1] is not codomainIndex:
+            F = self.monoidMorphism
+            codomainRows = {gen: i for i, gen in enumerate(F.codomaingens)}
+            rows = [codomainRows[gen] for gen in codomainIndex.gens]
+            columns = [F.domainindex[gen] for gen in domainIndex.gens]
+            self._valueMatrixCache = (domainIndex, codomainIndex, (F.array[rows][:, columns], F.denom))
+        return self._valueMatrixCache[2]
+
+    # Returns the preimage of the given codomain vertex: the vertices and collapsed edges of the domain that are mapped
+    # to it, as a BasicFamilyView of the domain. Each preimage is built once, when it is first asked for, and kept
+    # until the morphism changes.
     def preimage(self, vert):
         assert vert in self.codomain.vertices, "vert should be a codomain vertex"
 
-        preimageVertices = {v for v in self.domain.vertices if self.curveMorphismDict[v] == vert}
-        preimageEdges = {e for e in self.domain.edges if self.curveMorphismDict[e] == vert}
-
-        preimage = BasicFamily("Preimage of " + vert.name)
-        preimage.addEdges(preimageEdges)
-        preimage.addVertices(preimageVertices)
+        if vert not in self._preimageCache:
+            preimageVertices = [v for v in self.inverseMap[vert] if isinstance(v, Vertex)]
+            preimageEdges = [e for e in self.inverseMap[vert] if isinstance(e, Edge)]
+            self._preimageCache[vert] = BasicFamilyView(self.domain, preimageVertices, preimageEdges,
+                                                        name_="Preimage of " + vert.name)
 
-        return preimage
+        return self._preimageCache[vert]
 
-    # Returns the image of the morphism as a BasicFamily
+    # Returns the image of the morphism as a BasicFamilyView of the codomain, which is kept until the morphism changes.
+    # Its monoid is the whole codomain monoid. Another option is to take the image of self.monoidMorphism, but this has
+    # not yet been implemented.
     def image(self):
+        if self._imageCache is None:
+            # Note that we don't need to worry about edges that collapse to a vertex - their endpoints go to the same
+            # place.
+            imageVertices = [self(v) for v in self.domain.vertices]
 
-        # Note that we don't need to worry about edges that collapse to a vertex - their endpoints go to the same place.
-        imageVertices = {self(v) for v in self.domain.vertices}
+            # Only take edges that are not collapsed
+            imageEdges = [self(e) for e in self.domain.edges if self(e) in self.codomain.edges]
 
-        # Only take edges that are not collapsed
-        imageEdges = {self(e) for e in self.domain.edges if self(e) in self.codomain.edges}
+            imageLegs = [self(nextLeg) for nextLeg in self.domain.legs]
 
-        imageLegs = {self(nextLeg) for nextLeg in self.domain.legs}
+            self._imageCache = BasicFamilyView(self.codomain, imageVertices, imageEdges, imageLegs,
+                                               name_="Image curve")
 
-        # Keep the whole codomain monoid. Another option is to take the image of self.monoidMorphism, but this has not
-        # yet been implemented.
-        imageMonoid = self.codomain.monoid
+        return self._imageCache
 
-        image = BasicFamily("Image curve")
-
-        image.addVertices(imageVertices)
-        image.addEdges(imageEdges)
-        image.addLegs(imageLegs)
-        image.monoid = imageMonoid
-        
-        return image
+    # The image of the morphism as a BasicFamily, for functions that live on the image, such as pushforwards along a
+    # morphism that is not surjective. It is built from image() once, so every such function is on the same curve.
+    @property
+    def imageCurve(self):
+        if self._imageCurveCache is None:
+            self._imageCurveCache = self.image().toBasicFamily()
+        return self._imageCurveCache
 
     def __call__(self, x):
         if isinstance(x, Vertex):
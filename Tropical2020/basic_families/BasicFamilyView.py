@@ -0,0 +1,163 @@
+from .CurveIndex import UnionFind
+
+
+# A read only view of some of the vertices, edges, and legs of a BasicFamily. Nothing is copied: the view refers to the
+# elements of the underlying curve, and answers the same genus, degree, connectivity, and core questions that a
+# BasicFamily built from those elements would. A view does not notice later changes to the underlying curve.
+class BasicFamilyView(object):
+    # curve_ should be the BasicFamily that is viewed
+    # vertices_, edges_, and legs_ should be collections of its vertices, edges, and legs. The endpoints of the edges
+    # and the roots of the legs are added to the vertices, just like BasicFamily.addEdge and addLeg do.
+    def __init__(self, curve_, vertices_=(), edges_=(), legs_=(), name_="View"):
+        self.name = name_
+        self.curve = curve_
+        self._edges = frozenset(edges_)
+        self._legs = frozenset(legs_)
+
+        vertices = set(vertices_)
+        for e in self._edges:
+            vertices.update(e.vertices)
+        for nextLeg in self._legs:
+            vertices.add(nextLeg.root)
+        self._vertices = frozenset(vertices)
+
+        # Variables for caching degrees
+        self._edgeDegreeCache = None
+        self._legDegreeCache = None
+
+        # Variables for caching genus
+        self._genusCacheValid = False
+        self._genusCache = 0
+
+        # Variables for caching the core
+        self._coreCacheValid = False
+        self._coreCache = None
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @property
+    def edges(self):
+        return self._edges
+
+    @property
+    def legs(self):
+        return self._legs
+
+    @property
+    def monoid(self):
+        return self.curve.monoid
+
+    @property
+    def numVertices(self):
+        return len(self.vertices)
+
+    @property
+    def numEdges(self):
+        return len(self.edges)
+
+    @property
+    def bettiNumber(self):
+        return self.numEdges - self.numVertices + 1
+
+    @property
+    def genus(self):
+        if not self._genusCacheValid:
+            self._genusCache = self.bettiNumber + sum(v.genus for v in self.vertices)
+            self._genusCacheValid = True
+        return self._genusCache
+
+    # Counts the endpoints of edges and roots of legs at every vertex of the view, once
+    def _computeDegrees(self):
+        self._edgeDegreeCache = {v: 0 for v in self.vertices}
+        self._legDegreeCache = {v: 0 for v in self.vertices}
+        for e in self.edges:
+            self._edgeDegreeCache[e.vert1] += 1
+            self._edgeDegreeCache[e.vert2] += 1
+        for nextLeg in self.legs:
+            self._legDegreeCache[nextLeg.root] += 1
+
+    def edgeDegree(self, v):
+        if self._edgeDegreeCache is None:
+            self._computeDegrees()
+        return self._edgeDegreeCache.get(v, 0)
+
+    def legDegree(self, v):
+        if self._legDegreeCache is None:
+            self._computeDegrees()
+        return self._legDegreeCache.get(v, 0)
+
+    def degree(self, v):
+        return self.edgeDegree(v) + self.legDegree(v)
+
+    # Same convention as BasicFamily.isConnected: a view without vertices is not connected
+    @property
+    def isConnected(self):
+        if self.numVertices == 0:
+            return False
+
+        vertexList = list(self.vertices)
+        position = {v: i for i, v in enumerate(vertexList)}
+        unionFind = UnionFind(len(vertexList))
+        numComponents = len(vertexList)
+        for e in self.edges:
+            if unionFind.union(position[e.vert1], position[e.vert2]):
+                numComponents -= 1
+
+        return numComponents == 1
+
+    # The core is computed like BasicFamily.core, by repeatedly pruning genus zero vertices with fewer than two
+    # endpoints of edges, but each vertex and edge is visited a bounded number of times. The result is again a view.
+    @property
+    def core(self):
+        if not self._coreCacheValid:
+
+            # Only allow the core to be requested from curves where the core is defined.
+            if not self.genus > 0:
+                raise ValueError("The core is only defined for curves of positive genus.")
+            if not self.isConnected:
+                raise ValueError("The core is only defined for connected curves.")
+
+            incidentEdges = {v: [] for v in self.vertices}
+            for e in self.edges:
+                incidentEdges[e.vert1].append(e)
+                if e.vert2 != e.vert1:
+                    incidentEdges[e.vert2].append(e)
+
+            # The core does not have legs, so only endpoints of edges count
+            degree = {v: self.edgeDegree(v) for v in self.vertices}
+            remainingVertices = set(self.vertices)
+            remainingEdges = set(self.edges)
+
+            leaves = [v for v in self.vertices if v.genus == 0 and degree[v] < 2]
+            while leaves:
+                v = leaves.pop()
+                if v not in remainingVertices:
+                    continue
+                remainingVertices.remove(v)
+
+                # Removing a vertex removes its edges, which lowers the degree of their other endpoints
+                for e in incidentEdges[v]:
+                    if e in remainingEdges:
+                        remainingEdges.remove(e)
+                        other = e.vert2 if e.vert1 == v else e.vert1
+                        degree[other] -= 1
+                        if other in remainingVertices and other.genus == 0 and degree[other] < 2:
+                            leaves.append(other)
+
+            self._coreCache = BasicFamilyView(self.curve, remainingVertices, remainingEdges,
+                                              name_="(Core of " + self.name + ")")
+            self._coreCacheValid = True
+
+        return self._coreCache
+
+    # Builds an actual BasicFamily out of the view. The vertices, edges, and legs are shared, not copied.
+    def toBasicFamily(self):
+        from .BasicFamily import BasicFamily
+        curve = BasicFamily(self.name)
+        curve.addEdges(self.edges)
+        curve.addLegs(self.legs)
+        curve.addVertices(self.vertices)
+        curve.monoid = self.monoid
+        return curve
@@ -0,0 +1,152 @@
+# Canonical forms of decorated multigraphs, used to compare curves (and functions on them) up to isomorphism by hashing
+# instead of searching for bijections.
+#
+# A graph is given by a label for each vertex and a list of edges (i, j, forwardLabel, backwardLabel), where
+# forwardLabel decorates the edge when it is read from vertex i to vertex j, and backwardLabel when it is read from j to
+# i. Labels may be anything that can be sorted and hashed, such as integers or tuples of integers.
+#
+# The vertices are first partitioned by color refinement: a vertex is told apart from another if their labels differ, or
+# if they see a different number of edges with some label to vertices of some color. Whenever this does not separate all
+# vertices, each vertex of the first largest class is singled out in turn and the refinement is repeated. Every discrete
+# partition reached this way orders the vertices, and the key is the smallest description of the graph over all of those
+# orders, where branches that an automorphism of the graph sends to branches that were already searched are skipped.
+# Since the classes and their order only depend on the labels and the edges, and not on how the vertices are numbered,
+# two graphs get the same key exactly when they are isomorphic. The order that gives the key is kept as well: matching
+# the vertices of two graphs with the same key position by position is an isomorphism.
+class CanonicalForm(object):
+    # vertexLabels should be a list with one label for each vertex
+    # edges should be a list of tuples (i, j, forwardLabel, backwardLabel) of vertex positions and edge labels
+    def __init__(self, vertexLabels, edges):
+        self.numVertices = len(vertexLabels)
+        self.vertexLabels = list(vertexLabels)
+
+        # arcs[i] maps each neighbour j of vertex i to the sorted labels of the edges between them, read from i to j.
+        # For a self loop, both readings are kept.
+        arcs = [{} for _ in range(self.numVertices)]
+        for i, j, forwardLabel, backwardLabel in edges:
+            arcs[i].setdefault(j, []).append(forwardLabel)
+            arcs[j].setdefault(i, []).append(backwardLabel)
+        self.arcs = [{j: tuple(sorted(labels)) for j, labels in neighbours.items()} for neighbours in arcs]
+
+        # Variables for caching the key and the order of the vertices that gives it
+        self._keyCacheValid = False
+        self._keyCache = None
+        self._orderCache = None
+
+    # The canonical key of the graph, a nested tuple that can be compared and hashed
+    @property
+    def key(self):
+        if not self._keyCacheValid:
+            self._computeKey()
+        return self._keyCache
+
+    # The positions of the vertices, listed in the order used by the key
+    @property
+    def order(self):
+        if not self._keyCacheValid:
+            self._computeKey()
+        return self._orderCache
+
+    def _computeKey(self):
+        self._keyCache, self._orderCache = self._search(self._refine(self._rank(self.vertexLabels)))
+        self._keyCacheValid = True
+
+    # Replaces the given values by their positions in the sorted list of distinct values
+    @staticmethod
+    def _rank(values):
+        ranks = {value: i for i, value in enumerate(sorted(set(values)))}
+        return [ranks[value] for value in values]
+
+    # Splits the classes of the coloring until every vertex of a class sees the same numbers of edges of each label to
+    # each class. A vertex keeps its old color as the first entry of its signature, so the order of the classes is
+    # refined, never reshuffled.
+    def _refine(self, colors):
+        numColors = len(set(colors))
+        while True:
+            signatures = [(colors[i], tuple(sorted((colors[j], labels) for j, labels in self.arcs[i].items())))
+                          for i in range(self.numVertices)]
+            colors = CanonicalForm._rank(signatures)
+            newNumColors = len(set(colors))
+            if newNumColors == numColors:
+                return colors
+            numColors = newNumColors
+
+    # Returns the smallest description of the graph over all discrete refinements of the coloring, together with the
+    # order of the vertices that gives it
+    def _search(self, colors):
+        # best is [description, order, path] of the smallest description found so far, where path lists the vertices
+        # that were singled out to reach it. automorphisms lists the automorphisms found along the way, as lists that
+        # send each vertex to its image.
+        best = [None, None, None]
+        automorphisms = []
+        self._searchFrom(colors, (), best, automorphisms)
+        return best[0], best[1]
+
+    # Searches the discrete refinements below the coloring reached by singling out the vertices of path. Two leaves
+    # with the same description give an automorphism of the graph. An automorphism that fixes path sends the branch of
+    # one vertex of the class to the branch of its image, which then has the same descriptions and is skipped. Returns
+    # None, or the depth of the branch that the search should go back to because the rest of the current branch is the
+    # image of one that was already searched.
+    def _searchFrom(self, colors, path, best, automorphisms):
+        cells = {}
+        for i, color in enumerate(colors):
+            cells.setdefault(color, []).append(i)
+
+        if len(cells) == self.numVertices:
+            description, order = self._describe(colors)
+            if best[0] is None or description < best[0]:
+                best[:] = [description, order, path]
+                return None
+            if description == best[0]:
+                automorphism = [0] * self.numVertices
+                for i, j in zip(best[1], order):
+                    automorphism[i] = j
+                automorphisms.append(automorphism)
+
+                # The automorphism fixes the common start of the two paths and sends the next vertex of the path of
+                # best to the next vertex of path, so the branch where they part ways has been searched already
+                depth = 0
+                while best[2][depth] == path[depth]:
+                    depth += 1
+                return depth
+            return None
+
+        # Single out each vertex of the first largest class in turn. It keeps the color of the class, and the rest of
+        # the class moves up by one, so the colors stay comparable between the branches.
+        largest = max(len(cell) for cell in cells.values())
+        color = min(c for c, cell in cells.items() if len(cell) == largest)
+        searched = set()
+        for chosen in cells[color]:
+            fixing = [g for g in automorphisms if all(g[v] == v for v in path)]
+            if chosen in CanonicalForm._orbit(searched, fixing):
+                continue
+            searched.add(chosen)
+
+            individualized = [2 * c + (1 if c == color and i != chosen else 0) for i, c in enumerate(colors)]
+            depth = self._searchFrom(self._refine(CanonicalForm._rank(individualized)), path + (chosen,), best,
+                                     automorphisms)
+            if depth is not None and depth < len(path):
+                return depth
+        return None
+
+    # Returns the vertices that the given automorphisms send the given vertices to, applied any number of times
+    @staticmethod
+    def _orbit(vertices, automorphisms):
+        orbit = set(vertices)
+        stack = list(vertices)
+        while stack:
+            v = stack.pop()
+            for g in automorphisms:
+                if g[v] not in orbit:
+                    orbit.add(g[v])
+                    stack.append(g[v])
+        return orbit
+
+    # Describes the graph with the vertices ordered by their (distinct) colors. Returns the description and the order.
+    def _describe(self, colors):
+        order = sorted(range(self.numVertices), key=lambda i: colors[i])
+        position = {i: p for p, i in enumerate(order)}
+        labels = tuple(self.vertexLabels[i] for i in order)
+        arcs = tuple(tuple(sorted((position[j], edgeLabels) for j, edgeLabels in self.arcs[i].items()))
+                     for i in order)
+        return (labels, arcs), tuple(order)
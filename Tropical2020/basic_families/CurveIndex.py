@@ -0,0 +1,427 @@
+import numpy as np
+
+from .CanonicalForm import CanonicalForm
+
+
+# A disjoint set forest on the integers 0, ..., n - 1, with union by size and path halving
+class UnionFind(object):
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    # Merges the sets containing x and y. Returns True if they were different sets.
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return False
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+        return True
+
+
+# A spanning forest of a curve in breadth first order, with one tree for each connected component. All arrays are
+# indexed by vertex index.
+class SpanningForest(object):
+    def __init__(self, order_, parent_, parentEdge_, parentSign_, component_):
+        # The vertices in breadth first order. Every vertex comes after its parent.
+        self.order = order_
+        # parent[v] is the parent of v in its tree, or -1 if v is the root
+        self.parent = parent_
+        # parentEdge[v] is the index of the edge connecting v to its parent, or -1 if v is the root
+        self.parentEdge = parentEdge_
+        # parentSign[v] is 1 if the parent edge runs from the parent to v (i.e., the parent is vert1), and -1 otherwise
+        self.parentSign = parentSign_
+        # component[v] is the number of the tree containing v
+        self.component = component_
+
+    @property
+    def roots(self):
+        return self.order[self.parentEdge[self.order] < 0]
+
+    @property
+    def numComponents(self):
+        return len(self.roots)
+
+
+# An integer indexing of the vertices, edges, and legs of a BasicFamily, along with arrays describing how they are
+# attached to each other. An index is a snapshot of the curve: BasicFamily.index builds a new one whenever the curve
+# changes, so an index should not be kept around while the curve is being modified.
+class CurveIndex(object):
+    # curve_ should be a BasicFamily whose edges all have both endpoints
+    def __init__(self, curve_):
+        self.curve = curve_
+
+        # Fix an order of the vertices, edges, and legs
+        self.vertices = list(curve_.vertices)
+        self.edges = list(curve_.edges)
+        self.legs = list(curve_.legs)
+
+        # Inverse lookups: vertexIndex[v] is the position of v in self.vertices, etc.
+        self.vertexIndex = {v: i for i, v in enumerate(self.vertices)}
+        self.edgeIndex = {e: i for i, e in enumerate(self.edges)}
+        self.legIndex = {nextLeg: i for i, nextLeg in enumerate(self.legs)}
+
+        # edgeVert1[i] and edgeVert2[i] are the indices of the endpoints of self.edges[i]
+        self.edgeVert1 = np.array([self.vertexIndex[e.vert1] for e in self.edges], dtype=np.int64)
+        self.edgeVert2 = np.array([self.vertexIndex[e.vert2] for e in self.edges], dtype=np.int64)
+
+        # legRoots[i] is the index of the root of self.legs[i]
+        self.legRoots = np.array([self.vertexIndex[nextLeg.root] for nextLeg in self.legs], dtype=np.int64)
+
+        # The monoid of the curve and its generators at the time the index was built. Columns of value matrices follow
+        # the order of the generators.
+        self.monoid = curve_.monoid
+        self.gens = list(curve_.monoid.gens)
+
+        # Variables for caching the edge length matrix
+        self._lengthsCacheValid = False
+        self._lengthsCache = None
+        self._lengthDenominatorCache = 1
+
+        # Variables for caching the adjacency lists
+        self._adjacencyCacheValid = False
+        self._adjacencyCache = None
+
+        # Variables for caching the default spanning forest
+        self._spanningForestCacheValid = False
+        self._spanningForestCache = None
+
+        # Variables for caching the cycle matrix
+        self._cycleMatrixCacheValid = False
+        self._cycleMatrixCache = None
+
+        # Variables for caching the incidence matrix
+        self._incidenceMatrixCacheValid = False
+        self._incidenceMatrixCache = None
+
+        # Variables for caching the canonical form
+        self._canonicalFormCacheValid = False
+        self._canonicalFormCache = None
+
+    @property
+    def numVertices(self):
+        return len(self.vertices)
+
+    @property
+    def numEdges(self):
+        return len(self.edges)
+
+    @property
+    def numLegs(self):
+        return len(self.legs)
+
+    @property
+    def numGens(self):
+        return len(self.gens)
+
+    # Slopes are stored in a single vector indexed by the edges followed by the legs. This returns the position of an
+    # edge or a leg in such a vector.
+    def slopeIndex(self, x):
+        if x in self.edgeIndex:
+            return self.edgeIndex[x]
+        return self.numEdges + self.legIndex[x]
+
+    # The (edges x generators) integer matrix whose rows are the lengths of the edges. Raises a ValueError if some
+    # length has a denominator; see scaledLengths for curves with rational lengths.
+    @property
+    def lengths(self):
+        lengths, denominator = self.scaledLengths
+        if denominator != 1:
+            raise ValueError("Edge lengths must have denominator one.")
+        return lengths
+
+    # The lengths of the edges as a pair (lengths, denominator) of an (edges x generators) integer matrix and a positive
+    # integer, such that the length of each edge is its row divided by the denominator. The denominator is the least
+    # common multiple of the denominators of the lengths, so it is 1 when every length is integral.
+    @property
+    def scaledLengths(self):
+        if not self._lengthsCacheValid:
+            monoid = self.monoid
+            if not all(isinstance(e.length, monoid.Element) for e in self.edges):
+                raise ValueError("Edge lengths must be elements of the monoid of the curve.")
+            lengths, denominators = monoid.to_array([e.length for e in self.edges], self.gens)
+            denominator = int(np.lcm.reduce(np.abs(denominators))) if len(denominators) else 1
+            self._lengthsCache = lengths * (denominator // denominators)[:, None]
+            self._lengthDenominatorCache = denominator
+            self._lengthsCacheValid = True
+        return self._lengthsCache, self._lengthDenominatorCache
+
+    # Returns the given slopes as an integer array, and raises a ValueError if some slope is not an integer rather than
+    # rounding it
+    @staticmethod
+    def asIntegerSlopes(slopes):
+        slopes = np.asarray(slopes)
+        integerSlopes = slopes.astype(np.int64)
+        if not np.array_equal(integerSlopes, slopes):
+            raise ValueError("Slopes must be integers.")
+        return integerSlopes
+
+    # adjacency[v] is a list of triples (e, w, sign), one for each end of an edge at vertex v, where e is the index of
+    # the edge, w is the index of its other endpoint, and sign is 1 if the edge runs from v to w and -1 otherwise.
+    # Self loops appear twice.
+    @property
+    def adjacency(self):
+        if not self._adjacencyCacheValid:
+            adjacency = [[] for _ in range(self.numVertices)]
+            for e in range(self.numEdges):
+                v1, v2 = int(self.edgeVert1[e]), int(self.edgeVert2[e])
+                adjacency[v1].append((e, v2, 1))
+                adjacency[v2].append((e, v1, -1))
+            self._adjacencyCache = adjacency
+            self._adjacencyCacheValid = True
+        return self._adjacencyCache
+
+    # Returns a boolean mask over the vertices of the index that is True exactly at the given vertices. Vertices that
+    # do not belong to the curve are ignored.
+    def getVertexMask(self, vertices):
+        mask = np.zeros(self.numVertices, dtype=bool)
+        for v in vertices:
+            if v in self.vertexIndex:
+                mask[self.vertexIndex[v]] = True
+        return mask
+
+    # Same as getVertexMask, but over the edges
+    def getEdgeMask(self, edges):
+        mask = np.zeros(self.numEdges, dtype=bool)
+        for e in edges:
+            if e in self.edgeIndex:
+                mask[self.edgeIndex[e]] = True
+        return mask
+
+    # Returns the number of edges on a shortest path from the given sources to each vertex, or -1 for vertices that
+    # cannot be reached. sources and allowed are boolean masks over the vertices, and paths may only pass through
+    # allowed vertices (all vertices are allowed by default).
+    def getDistancesFrom(self, sources, allowed=None):
+        if allowed is None:
+            allowed = np.ones(self.numVertices, dtype=bool)
+        adjacency = self.adjacency
+        isAllowed = allowed.tolist()
+
+        # Multi-source breadth first search. The queue is never popped, so it ends up listing the reached vertices.
+        queue = np.flatnonzero(sources & allowed).tolist()
+        distances = [-1] * self.numVertices
+        for v in queue:
+            distances[v] = 0
+        head = 0
+        while head < len(queue):
+            v = queue[head]
+            head += 1
+            for e, w, sign in adjacency[v]:
+                if distances[w] < 0 and isAllowed[w]:
+                    distances[w] = distances[v] + 1
+                    queue.append(w)
+
+        return np.array(distances, dtype=np.int64)
+
+    # Returns a boolean mask of the vertices that can be reached from the sources. See getDistancesFrom.
+    def getReachableFrom(self, sources, allowed=None):
+        return self.getDistancesFrom(sources, allowed) >= 0
+
+    # Returns a boolean mask of the vertices that lie on a path from a vertex of S to a vertex of T, i.e., that can be
+    # reached from both S and T. S, T, and allowed are boolean masks over the vertices.
+    def getVerticesBetween(self, S, T, allowed=None):
+        return self.getReachableFrom(S, allowed) & self.getReachableFrom(T, allowed)
+
+    # Returns a boolean mask over the edges that is True at the edges whose first endpoint can reach the sources
+    # without passing through the second endpoint, as in PiecewiseLinearFunction.floodfillVertices. For a bridge this
+    # says that vert1 is the endpoint on the side of the sources. On a cycle both endpoints may reach the sources
+    # this way, so the edge can be True even if vert2 is closer to them. A self loop is always False.
+    def getVert1IsNearer(self, sources, allowed=None):
+        if allowed is None:
+            allowed = np.ones(self.numVertices, dtype=bool)
+
+        # One search for each vertex that is the second endpoint of an edge, with that vertex removed
+        vert1IsNearer = np.zeros(self.numEdges, dtype=bool)
+        for w in np.unique(self.edgeVert2).tolist():
+            edges = self.edgeVert2 == w
+            withoutW = allowed.copy()
+            withoutW[w] = False
+            vert1IsNearer[edges] = self.getReachableFrom(sources, withoutW)[self.edgeVert1[edges]]
+        return vert1IsNearer
+
+    # Partitions a subset of the vertices (given as a boolean mask) into the pieces that are connected through edges
+    # between two of its vertices. Returns a pair (vertexLabels, edgeLabels) of integer arrays. vertexLabels[v] is the
+    # number of the piece containing v, or -1 if v is not in the subset. edgeLabels[e] is the number of the piece
+    # containing an endpoint of e, or -1 if neither endpoint is in the subset. Pieces are numbered in the order of
+    # their first vertices.
+    def getComponentLabels(self, vertexMask):
+        unionFind = UnionFind(self.numVertices)
+        inSubset = vertexMask.tolist()
+        for v1, v2 in zip(self.edgeVert1.tolist(), self.edgeVert2.tolist()):
+            if inSubset[v1] and inSubset[v2]:
+                unionFind.union(v1, v2)
+
+        vertexLabels = np.full(self.numVertices, -1, dtype=np.int64)
+        labelOfRoot = {}
+        for v in np.flatnonzero(vertexMask).tolist():
+            vertexLabels[v] = labelOfRoot.setdefault(unionFind.find(v), len(labelOfRoot))
+
+        edgeLabels = np.maximum(vertexLabels[self.edgeVert1], vertexLabels[self.edgeVert2])
+        return vertexLabels, edgeLabels
+
+    # Returns a breadth first SpanningForest of the curve. Each connected component is rooted at the first vertex of
+    # preferredRoots that it contains, or at its first vertex if it contains none of them.
+    def getSpanningForest(self, preferredRoots=()):
+        n = self.numVertices
+        adjacency = self.adjacency
+
+        order = []
+        parent = np.full(n, -1, dtype=np.int64)
+        parentEdge = np.full(n, -1, dtype=np.int64)
+        parentSign = np.zeros(n, dtype=np.int64)
+        component = np.full(n, -1, dtype=np.int64)
+
+        numComponents = 0
+        for root in list(preferredRoots) + list(range(n)):
+            if component[root] >= 0:
+                continue
+
+            # Breadth first search from root. The order list doubles as the queue.
+            component[root] = numComponents
+            head = len(order)
+            order.append(root)
+            while head < len(order):
+                v = order[head]
+                head += 1
+                for e, w, sign in adjacency[v]:
+                    if component[w] < 0:
+                        component[w] = numComponents
+                        parent[w] = v
+                        parentEdge[w] = e
+                        parentSign[w] = sign
+                        order.append(w)
+
+            numComponents += 1
+
+        return SpanningForest(np.array(order, dtype=np.int64), parent, parentEdge, parentSign, component)
+
+    # The spanning forest rooted at the first vertex of each component
+    @property
+    def spanningForest(self):
+        if not self._spanningForestCacheValid:
+            self._spanningForestCache = self.getSpanningForest()
+            self._spanningForestCacheValid = True
+        return self._spanningForestCache
+
+    # The (cycles x edges) integer matrix of a basis of the cycle space of the curve. There is one row for each edge
+    # outside of the spanning forest (including every self loop): the fundamental cycle that crosses that edge from
+    # vert1 to vert2 and returns through the forest. An entry is 1 or -1 if the cycle crosses the edge from vert1 to
+    # vert2 or the other way around, and 0 if it does not cross the edge.
+    @property
+    def cycleMatrix(self):
+        if not self._cycleMatrixCacheValid:
+            forest = self.spanningForest
+
+            # paths[v] is the signed path from the root of the tree containing v to v
+            paths = np.zeros((self.numVertices, self.numEdges), dtype=np.int64)
+            for v in forest.order:
+                e = forest.parentEdge[v]
+                if e >= 0:
+                    paths[v] = paths[forest.parent[v]]
+                    paths[v, e] += forest.parentSign[v]
+
+            treeEdges = set(forest.parentEdge[forest.parentEdge >= 0])
+            cycles = []
+            for e in range(self.numEdges):
+                if e not in treeEdges:
+                    cycle = paths[self.edgeVert1[e]] - paths[self.edgeVert2[e]]
+                    cycle[e] += 1
+                    cycles.append(cycle)
+
+            self._cycleMatrixCache = np.array(cycles, dtype=np.int64).reshape(len(cycles), self.numEdges)
+            self._cycleMatrixCacheValid = True
+        return self._cycleMatrixCache
+
+    # The signed (vertices x (edges + legs)) incidence matrix of the curve. The column of an edge is 1 at vert1 and -1
+    # at vert2, which cancel for a self loop, and the column of a leg is 1 at its root. Multiplying it with a vector
+    # of slopes (indexed like slopeIndex) sums the outgoing slopes at every vertex.
+    @property
+    def incidenceMatrix(self):
+        if not self._incidenceMatrixCacheValid:
+            incidence = np.zeros((self.numVertices, self.numEdges + self.numLegs), dtype=np.int64)
+            edgeColumns = np.arange(self.numEdges)
+            np.add.at(incidence, (self.edgeVert1, edgeColumns), 1)
+            np.add.at(incidence, (self.edgeVert2, edgeColumns), -1)
+            incidence[self.legRoots, self.numEdges + np.arange(self.numLegs)] = 1
+            self._incidenceMatrixCache = incidence
+            self._incidenceMatrixCacheValid = True
+        return self._incidenceMatrixCache
+
+    # Returns the orders at the vertices of the divisor of the function with the given slopes (indexed like
+    # slopeIndex), which are the sums of the outgoing slopes along the edges and legs at each vertex. slopes may also
+    # be a (k x (edges + legs)) matrix of the slopes of k functions, in which case a (k x vertices) matrix is returned.
+    def getDivisors(self, slopes):
+        slopes = CurveIndex.asIntegerSlopes(slopes)
+        return slopes @ self.incidenceMatrix.T
+
+    # A hashable key of the curve that is the same for two curves exactly when they are isomorphic in the sense of
+    # BasicFamily.isIsomorphicTo: vertices are labelled by their genus and number of legs, and edge lengths are not
+    # compared. See CanonicalForm.
+    @property
+    def canonicalKey(self):
+        return self.canonicalForm.key
+
+    # The CanonicalForm of the curve that canonicalKey comes from. Its order lists the positions of the vertices in a
+    # canonical order, so the vertices of two isomorphic curves in that order correspond to each other.
+    @property
+    def canonicalForm(self):
+        if not self._canonicalFormCacheValid:
+            legCounts = np.bincount(self.legRoots, minlength=self.numVertices)
+            vertexLabels = [(v.genus, int(legCounts[i])) for i, v in enumerate(self.vertices)]
+            edges = [(v1, v2, 0, 0) for v1, v2 in zip(self.edgeVert1.tolist(), self.edgeVert2.tolist())]
+            self._canonicalFormCache = CanonicalForm(vertexLabels, edges)
+            self._canonicalFormCacheValid = True
+        return self._canonicalFormCache
+
+    # Checks if the given edge slopes define a function, i.e., if the integral of the slopes around every cycle of the
+    # curve is zero. edgeSlopes may also be a (k x edges) matrix of the slopes of k functions, in which case a boolean
+    # mask saying which of them are well defined is returned. The edge lengths may be rational.
+    def slopesAreWellDefined(self, edgeSlopes):
+        edgeSlopes = CurveIndex.asIntegerSlopes(edgeSlopes)
+
+        # integrals[..., c, :] is the integral around cycle c, times the common denominator of the lengths
+        lengths, _ = self.scaledLengths
+        integrals = np.einsum("ce,...e,eg->...cg", self.cycleMatrix, edgeSlopes, lengths)
+        wellDefined = self.monoid.iszero_many(integrals, self.gens).all(axis=-1)
+
+        if wellDefined.ndim == 0:
+            return bool(wellDefined)
+        return wellDefined
+
+    # Returns the values at the vertices of the function with the given edge slopes, as an integer matrix with a row
+    # for each vertex and a column for each generator. baseValues is a dictionary from vertex indices to rows of
+    # values. Every connected component takes the value given at one of its vertices in baseValues (the others are
+    # ignored), or the value zero at its first vertex if none is given.
+    # edgeSlopes may also be a (k x edges) matrix of slopes of k functions, in which case a (k x vertices x
+    # generators) array is returned and the rows of baseValues apply to all of the functions.
+    def solveVertexValues(self, edgeSlopes, baseValues=None):
+        if baseValues is None:
+            baseValues = {}
+        edgeSlopes = CurveIndex.asIntegerSlopes(edgeSlopes)
+        batchShape = edgeSlopes.shape[:-1]
+
+        forest = self.getSpanningForest(baseValues.keys()) if baseValues else self.spanningForest
+
+        # rises[..., e, :] is the change of the function along edge e, from vert1 to vert2
+        rises = edgeSlopes[..., :, None] * self.lengths
+        values = np.zeros(batchShape + (self.numVertices, self.numGens), dtype=np.int64)
+
+        for v in forest.order:
+            e = forest.parentEdge[v]
+            if e < 0:
+                if v in baseValues:
+                    values[..., v, :] = baseValues[v]
+            else:
+                values[..., v, :] = values[..., forest.parent[v], :] + forest.parentSign[v] * rises[..., e, :]
+
+        return values
@@ -0,0 +1,246 @@
+import itertools
+
+from .ArrayPiecewiseLinearFunction import *
+from .CurveIndex import UnionFind
+
+
+# Enumerates the piecewise linear functions on a curve whose slopes lie in a given range, or only those that are mesas.
+#
+# Each connected component of the curve is searched separately, depth first, along a breadth first spanning tree:
+# choosing the slope of the tree edge to a vertex determines the value of the function there, and as soon as both
+# endpoints of an edge outside of the tree have values, the slope of that edge is forced because the integral around
+# its loop must vanish. Assignments that do not close up are therefore never extended. When searching for mesas,
+# partial assignments are also discarded as soon as a leg condition fails or a component of the support is known to
+# have genus at least two, and the remaining candidates are checked with ArrayPiecewiseLinearFunction.isMesa.
+#
+# Results are returned as a pair (slopes, vertexValues) of arrays holding k functions, indexed like curve.index (see
+# ArrayPiecewiseLinearFunction): slopes is (k x (edges + legs)) and vertexValues is (k x vertices x generators).
+class MesaEnumerator(object):
+    # curve_ should be a BasicFamily whose edge lengths are elements of its monoid
+    # minSlope_ and maxSlope_ bound the slopes allowed on edges and legs (both inclusive)
+    def __init__(self, curve_, minSlope_=-1, maxSlope_=1):
+        if minSlope_ > maxSlope_:
+            raise ValueError("The minimum slope cannot be larger than the maximum slope.")
+
+        self.curve = curve_
+        self.index = curve_.index
+        self.candidateSlopes = np.arange(minSlope_, maxSlope_ + 1, dtype=np.int64)
+
+        index = self.index
+        self._lengths = index.lengths
+        self._edgeVert1 = index.edgeVert1.tolist()
+        self._edgeVert2 = index.edgeVert2.tolist()
+        self._genera = [v.genus for v in index.vertices]
+
+        self._selfLoops = [0] * index.numVertices
+        for v1, v2 in zip(self._edgeVert1, self._edgeVert2):
+            if v1 == v2:
+                self._selfLoops[v1] += 1
+
+        self._legRoots = set(index.legRoots.tolist())
+
+    @property
+    def numSlopes(self):
+        return self.index.numEdges + self.index.numLegs
+
+    # Yields every function with slopes in the range as a pair (slopes, vertexValues) of arrays. Functions are
+    # normalized to take the value zero at the root of a leg on each connected component of the curve that has legs
+    # (as mesas do), and at the first vertex of the other components.
+    def iterFunctions(self):
+        index = self.index
+        forest = index.getSpanningForest(index.legRoots.tolist())
+
+        componentResults = [list(self._searchComponent(forest, c, False))
+                            for c in range(forest.numComponents)]
+
+        # The slopes on the legs are not constrained at all
+        for legSlopes in itertools.product(self.candidateSlopes.tolist(), repeat=index.numLegs):
+            for slopes, values in self._combineComponents(componentResults):
+                slopes[index.numEdges:] = legSlopes
+                yield slopes, values
+
+    # Yields every mesa with slopes in the range as a pair (slopes, vertexValues) of arrays
+    def iterMesas(self):
+        index = self.index
+        componentResults = []
+
+        for c in range(index.spanningForest.numComponents):
+            componentVertices = np.flatnonzero(index.spanningForest.component == c).tolist()
+            legRoots = [v for v in componentVertices if v in self._legRoots]
+
+            # A mesa vanishes at the roots of the legs. On components without legs, it must still vanish somewhere
+            # (otherwise no vertex of the support lies on a path to a vertex outside of the support), so the search is
+            # repeated with each vertex as the first vertex where the function vanishes.
+            if legRoots:
+                anchors = [legRoots[0]]
+            else:
+                anchors = componentVertices
+
+            results = []
+            for anchor in anchors:
+                forest = index.getSpanningForest([anchor])
+                results.extend(self._searchMesas(forest, forest.component[anchor], not legRoots))
+
+            componentResults.append(results)
+
+        # The mesa conditions only involve one component of the curve at a time
+        yield from self._combineComponents(componentResults)
+
+    # Yields the mesas on one component of the curve that vanish at the root of the given spanning forest. If
+    # rootIsFirstZero is set, only mesas that do not vanish at any vertex before the root (by index) are returned, so
+    # that every mesa is found for exactly one root.
+    def _searchMesas(self, forest, component, rootIsFirstZero):
+        for slopes, values in self._searchComponent(forest, component, True, rootIsFirstZero):
+            if ArrayPiecewiseLinearFunction.isMesa(self.curve, slopes, values):
+                yield slopes, values
+
+    # Returns all functions with slopes in the range as a pair of arrays
+    def enumerateFunctions(self):
+        return self._stack(self.iterFunctions())
+
+    # Returns all mesas with slopes in the range as a pair of arrays
+    def enumerateMesas(self):
+        return self._stack(self.iterMesas())
+
+    def countMesas(self):
+        return sum(1 for _ in self.iterMesas())
+
+    def _stack(self, functions):
+        index = self.index
+        slopes = np.zeros((0, self.numSlopes), dtype=np.int64)
+        values = np.zeros((0, index.numVertices, index.numGens), dtype=np.int64)
+
+        functions = list(functions)
+        if functions:
+            slopes = np.stack([f[0] for f in functions])
+            values = np.stack([f[1] for f in functions])
+        return slopes, values
+
+    # The functions on the whole curve are sums of functions on its components, which vanish off of their components
+    def _combineComponents(self, componentResults):
+        for choice in itertools.product(*componentResults):
+            slopes = np.zeros(self.numSlopes, dtype=np.int64)
+            values = np.zeros((self.index.numVertices, self.index.numGens), dtype=np.int64)
+            for componentSlopes, componentValues in choice:
+                slopes += componentSlopes
+                values += componentValues
+            yield slopes, values
+
+    # Yields the functions on one component of the curve, with value zero at the root of the given spanning forest. If
+    # mesasOnly is set, the slopes on the legs are zero, the function vanishes at the roots of legs, and no component
+    # of the support has genus larger than one. If rootIsFirstZero is also set, the function does not vanish at any
+    # vertex before the root (by index).
+    def _searchComponent(self, forest, component, mesasOnly, rootIsFirstZero=False):
+        index = self.index
+        monoid = index.monoid
+        gens = index.gens
+        lengths = self._lengths
+        candidates = self.candidateSlopes
+
+        order = [v for v in forest.order.tolist() if forest.component[v] == component]
+        position = {v: i for i, v in enumerate(order)}
+        root = order[0]
+
+        # closingEdges[i] lists the edges outside of the tree whose later endpoint is order[i]
+        treeEdges = set(forest.parentEdge[order].tolist())
+        closingEdges = [[] for _ in order]
+        for e, (v1, v2) in enumerate(zip(self._edgeVert1, self._edgeVert2)):
+            if e not in treeEdges and v1 in position:
+                closingEdges[max(position[v1], position[v2])].append(e)
+
+        # The state of the search, restored when backtracking
+        slopes = np.zeros(self.numSlopes, dtype=np.int64)
+        values = np.zeros((index.numVertices, index.numGens), dtype=np.int64)
+        isSupport = [False] * index.numVertices
+        assignedEdges = []
+
+        def search(i):
+            if i == len(order):
+                yield slopes.copy(), values.copy()
+                return
+
+            v = order[i]
+            e = forest.parentEdge[v]
+
+            # The possible values at v, one for each candidate slope on the edge to its parent
+            if e < 0:
+                edgeChoices = [None]
+                valueChoices = np.zeros((1, index.numGens), dtype=np.int64)
+            else:
+                edgeChoices = candidates.tolist()
+                valueChoices = values[forest.parent[v]] + forest.parentSign[v] * candidates[:, None] * lengths[e]
+            valueIsZero = monoid.iszero_many(valueChoices, gens)
+
+            keep = np.ones(len(edgeChoices), dtype=bool)
+            if mesasOnly:
+                if v in self._legRoots:
+                    keep &= valueIsZero
+                if rootIsFirstZero and v < root:
+                    keep &= ~valueIsZero
+                if self._genera[v] + self._selfLoops[v] >= 2:
+                    keep &= valueIsZero
+
+            for choice in np.flatnonzero(keep).tolist():
+                values[v] = valueChoices[choice]
+                isSupport[v] = not valueIsZero[choice]
+                if e >= 0:
+                    slopes[e] = edgeChoices[choice]
+                    assignedEdges.append(e)
+
+                yield from closeEdges(i, 0)
+
+                if e >= 0:
+                    assignedEdges.pop()
+            values[v] = 0
+            isSupport[v] = False
+
+        # Assigns the forced slopes of the edges closed by order[i], starting with closingEdges[i][j]
+        def closeEdges(i, j):
+            if j == len(closingEdges[i]):
+                if not mesasOnly or self._supportGenusIsAtMostOne(assignedEdges, isSupport):
+                    yield from search(i + 1)
+                return
+
+            e = closingEdges[i][j]
+            rise = values[self._edgeVert2[e]] - values[self._edgeVert1[e]]
+            forced = monoid.iszero_many(rise - candidates[:, None] * lengths[e], gens)
+
+            for slope in candidates[forced].tolist():
+                slopes[e] = slope
+                assignedEdges.append(e)
+                yield from closeEdges(i, j + 1)
+                assignedEdges.pop()
+            slopes[e] = 0
+
+        yield from search(0)
+
+    # Checks that every connected component of the support of a partially assigned function, restricted to the edges
+    # assigned so far, has genus at most one. Components only grow as more of the function is assigned, so if this
+    # fails, some component of the support of every extension has genus at least two.
+    def _supportGenusIsAtMostOne(self, assignedEdges, isSupport):
+        edgeVert1 = self._edgeVert1
+        edgeVert2 = self._edgeVert2
+        supportEdges = [e for e in assignedEdges if isSupport[edgeVert1[e]] or isSupport[edgeVert2[e]]]
+        if not supportEdges:
+            return True
+
+        unionFind = UnionFind(len(isSupport))
+        for e in supportEdges:
+            if isSupport[edgeVert1[e]] and isSupport[edgeVert2[e]]:
+                unionFind.union(edgeVert1[e], edgeVert2[e])
+
+        # Components are named by the representative of their support vertices. Vertices outside of the support belong
+        # to every component that they are attached to.
+        genus = {}
+        componentVertices = set()
+        for e in supportEdges:
+            v1 = edgeVert1[e]
+            v2 = edgeVert2[e]
+            c = unionFind.find(v1 if isSupport[v1] else v2)
+            genus[c] = genus.get(c, 1) + 1
+            for v in (v1, v2):
+                if (c, v) not in componentVertices:
+                    componentVertices.add((c, v))
+                    genus[c] += self._genera[v] - 1
+
+        return all(g <= 1 for g in genus.values())
@@ -0,0 +1,224 @@
+import itertools
+import math
+
+from .BasicFamily import *
+from .CurveIndex import UnionFind
+
+
+# Enumerates the contraction morphisms from one curve to another: the morphisms of basic families that collapse some
+# edges of the domain to vertices, map the other edges and the legs bijectively to the edges and legs of the codomain,
+# and map the vertices onto the vertices of the codomain, so that the preimage of every codomain vertex is connected and
+# has its genus.
+#
+# The vertices of the domain are given images one at a time, depth first, along a breadth first spanning forest. As
+# soon as both endpoints of an edge have images, the edge is either counted against the edges of the codomain between
+# the two images, or, if the images agree, possibly collapsed instead. A partial assignment is abandoned as soon as
+#   - some pair of codomain vertices receives more edges than the codomain has between them (this also bounds their
+#     degrees), or more edges are collapsed than the difference of the numbers of edges,
+#   - some codomain vertex receives more legs than it has,
+#   - the preimage of some codomain vertex already has too much genus: the genera of its vertices plus the number of
+#     edges collapsed into it, minus its number of vertices, plus one, is at most the genera of its vertices plus its
+#     number of independent cycles, which only grows as the preimage grows and ends up as the genus of the codomain
+#     vertex,
+#   - there are fewer domain vertices left than codomain vertices without a preimage.
+# Once every vertex has an image, the preimages are checked to be connected, which with the counts above is the check
+# that BasicFamilyMorphism.validate makes. The vertex map then identifies the codomain with the contraction of the
+# domain by the collapsed edges. Each such assignment gives one morphism for every way of matching the parallel edges,
+# and the legs at a vertex, with those of the codomain.
+#
+# The monoid morphisms are those of BasicFamilyMorphism.fromCurveMorphism, so the length of every edge of the domain
+# should be its own generator.
+class MorphismEnumerator(object):
+    # domain_ and codomain_ should be BasicFamily objects
+    def __init__(self, domain_, codomain_):
+        self.domain = domain_
+        self.codomain = codomain_
+
+        domainIndex = domain_.index
+        codomainIndex = codomain_.index
+        self.domainIndex = domainIndex
+        self.codomainIndex = codomainIndex
+
+        self._edgeVert1 = domainIndex.edgeVert1.tolist()
+        self._edgeVert2 = domainIndex.edgeVert2.tolist()
+        self._genera = [v.genus for v in domainIndex.vertices]
+        self._legCounts = np.bincount(domainIndex.legRoots, minlength=domainIndex.numVertices).tolist()
+        self._numCollapsed = domainIndex.numEdges - codomainIndex.numEdges
+
+        self._codomainGenera = [v.genus for v in codomainIndex.vertices]
+        self._codomainLegCounts = np.bincount(codomainIndex.legRoots, minlength=codomainIndex.numVertices).tolist()
+
+        # _codomainEdges[(w1, w2)] lists the edges of the codomain between w1 and w2, for w1 <= w2
+        self._codomainEdges = {}
+        for e, (w1, w2) in enumerate(zip(codomainIndex.edgeVert1.tolist(), codomainIndex.edgeVert2.tolist())):
+            self._codomainEdges.setdefault((min(w1, w2), max(w1, w2)), []).append(e)
+
+        # The vertices in breadth first order, and closingEdges[i] lists the edges whose later endpoint is order[i]
+        self._order = domainIndex.spanningForest.order.tolist()
+        position = {v: i for i, v in enumerate(self._order)}
+        self._closingEdges = [[] for _ in self._order]
+        for e, (v1, v2) in enumerate(zip(self._edgeVert1, self._edgeVert2)):
+            self._closingEdges[max(position[v1], position[v2])].append(e)
+
+    # Yields every contraction morphism from the domain to the codomain as a BasicFamilyMorphism (not validated again)
+    def iterMorphisms(self):
+        domainIndex = self.domainIndex
+        codomainIndex = self.codomainIndex
+
+        # The legs of the codomain at each of its vertices, and its edges between each pair of vertices
+        codomainLegs = [[] for _ in range(codomainIndex.numVertices)]
+        for nextLeg, w in zip(codomainIndex.legs, codomainIndex.legRoots.tolist()):
+            codomainLegs[w].append(nextLeg)
+        codomainEdges = {pair: [codomainIndex.edges[e] for e in edges] for pair, edges in self._codomainEdges.items()}
+
+        for image, edgeImages in self.iterAssignments():
+            curveMorphismDict = {}
+            for v, w in enumerate(image):
+                curveMorphismDict[domainIndex.vertices[v]] = codomainIndex.vertices[w]
+
+            # Group the edges and legs that have to be matched with the same edges and legs of the codomain
+            groups = {}
+            for e, pair in enumerate(edgeImages):
+                if pair is None:
+                    w = image[self._edgeVert1[e]]
+                    curveMorphismDict[domainIndex.edges[e]] = codomainIndex.vertices[w]
+                else:
+                    groups.setdefault(pair, []).append(domainIndex.edges[e])
+            legGroups = {}
+            for nextLeg, v in zip(domainIndex.legs, domainIndex.legRoots.tolist()):
+                legGroups.setdefault(image[v], []).append(nextLeg)
+
+            sources = list(groups.values()) + list(legGroups.values())
+            targets = [codomainEdges[pair] for pair in groups] + [codomainLegs[w] for w in legGroups]
+            for matching in itertools.product(*(itertools.permutations(target) for target in targets)):
+                for source, target in zip(sources, matching):
+                    curveMorphismDict.update(zip(source, target))
+                yield BasicFamilyMorphism.fromCurveMorphism(self.domain, self.codomain, dict(curveMorphismDict),
+                                                            validate=False)
+
+    # Returns a list of all contraction morphisms from the domain to the codomain
+    def enumerateMorphisms(self):
+        return list(self.iterMorphisms())
+
+    # Counts the contraction morphisms without building them. Every assignment of iterAssignments matches each group of
+    # parallel edges and each group of legs with a group of the codomain of the same size.
+    def countMorphisms(self):
+        matchings = 1
+        for edges in self._codomainEdges.values():
+            matchings *= math.factorial(len(edges))
+        for numLegs in self._codomainLegCounts:
+            matchings *= math.factorial(numLegs)
+        return matchings * sum(1 for _ in self.iterAssignments())
+
+    # Whether the numbers of legs and edges and the genera of the curves allow a contraction morphism at all. If no edge
+    # is collapsed, the morphisms are isomorphisms, so the canonical keys of the curves have to agree.
+    def _isPossible(self):
+        domainIndex = self.domainIndex
+        codomainIndex = self.codomainIndex
+        if domainIndex.numLegs != codomainIndex.numLegs or self._numCollapsed < 0 or \
+                domainIndex.numVertices < codomainIndex.numVertices or self.domain.genus != self.codomain.genus:
+            return False
+        return self._numCollapsed > 0 or domainIndex.canonicalKey == codomainIndex.canonicalKey
+
+    # Yields the contraction morphisms up to the matching of parallel edges and of legs, as pairs (image, edgeImages).
+    # image[v] is the position of the codomain vertex that the domain vertex at position v is mapped to, and
+    # edgeImages[e] is None if the edge at position e is collapsed, and otherwise the pair (w1, w2), with w1 <= w2, of
+    # codomain vertex positions that it is mapped to an edge between.
+    def iterAssignments(self):
+        if not self._isPossible():
+            return
+
+        numVertices = self.domainIndex.numVertices
+        numCodomainVertices = self.codomainIndex.numVertices
+        edgeVert1 = self._edgeVert1
+        edgeVert2 = self._edgeVert2
+        genera = self._genera
+        legCounts = self._legCounts
+        order = self._order
+        closingEdges = self._closingEdges
+        codomainEdges = self._codomainEdges
+        codomainGenera = self._codomainGenera
+        codomainLegCounts = self._codomainLegCounts
+
+        # The state of the search, restored when backtracking. excess[w] is the genera of the vertices of the preimage
+        # of w, plus its number of collapsed edges, minus its number of vertices, plus one.
+        image = [-1] * numVertices
+        edgeImages = [None] * len(edgeVert1)
+        preimageSizes = [0] * numCodomainVertices
+        excess = [1] * numCodomainVertices
+        receivedLegs = [0] * numCodomainVertices
+        receivedEdges = {pair: 0 for pair in codomainEdges}
+        state = {"uncovered": numCodomainVertices, "collapsed": 0}
+
+        def search(i):
+            if i == numVertices:
+                if self._preimagesAreConnected(image, edgeImages):
+                    yield list(image), list(edgeImages)
+                return
+
+            v = order[i]
+            for w in range(numCodomainVertices):
+                # Every codomain vertex without a preimage still needs one of the remaining domain vertices
+                uncovered = state["uncovered"] - (preimageSizes[w] == 0)
+                if uncovered > numVertices - i - 1 or receivedLegs[w] + legCounts[v] > codomainLegCounts[w]:
+                    continue
+                if excess[w] + genera[v] - 1 > codomainGenera[w]:
+                    continue
+
+                image[v] = w
+                preimageSizes[w] += 1
+                excess[w] += genera[v] - 1
+                receivedLegs[w] += legCounts[v]
+                state["uncovered"], uncovered = uncovered, state["uncovered"]
+
+                yield from closeEdges(i, 0)
+
+                state["uncovered"] = uncovered
+                receivedLegs[w] -= legCounts[v]
+                excess[w] -= genera[v] - 1
+                preimageSizes[w] -= 1
+                image[v] = -1
+
+        # Decides the images of the edges closed by order[i], starting with closingEdges[i][j]
+        def closeEdges(i, j):
+            if j == len(closingEdges[i]):
+                yield from search(i + 1)
+                return
+
+            e = closingEdges[i][j]
+            w1 = image[edgeVert1[e]]
+            w2 = image[edgeVert2[e]]
+            pair = (min(w1, w2), max(w1, w2))
+
+            # Map e to an edge of the codomain between the images of its endpoints
+            if pair in codomainEdges and receivedEdges[pair] < len(codomainEdges[pair]):
+                receivedEdges[pair] += 1
+                edgeImages[e] = pair
+                yield from closeEdges(i, j + 1)
+                edgeImages[e] = None
+                receivedEdges[pair] -= 1
+
+            # Collapse e, which adds to the genus of the preimage of its image
+            if w1 == w2 and state["collapsed"] < self._numCollapsed and excess[w1] < codomainGenera[w1]:
+                state["collapsed"] += 1
+                excess[w1] += 1
+                yield from closeEdges(i, j + 1)
+                excess[w1] -= 1
+                state["collapsed"] -= 1
+
+        yield from search(0)
+
+    # Checks that the collapsed edges connect the preimage of every codomain vertex. The genus and the numbers of edges
+    # and legs are already right when every vertex has an image: each of them is bounded above during the search, and
+    # their totals agree for the domain and codomain.
+    def _preimagesAreConnected(self, image, edgeImages):
+        unionFind = UnionFind(len(image))
+        for e, pair in enumerate(edgeImages):
+            if pair is None:
+                unionFind.union(self._edgeVert1[e], self._edgeVert2[e])
+
+        representatives = {}
+        for v, w in enumerate(image):
+            if representatives.setdefault(w, unionFind.find(v)) != unionFind.find(v):
+                return False
+        return True
@@ -1,16 +1,32 @@
 from .BasicFamily import *
+from .BasicFamilyView import BasicFamilyView
 
 
 class PiecewiseLinearFunction(object):
     # domain_ should be a BasicFamily representing the domain of the function
     # functionValues_ should be a dictionary with vertex/leg keys and non-negative double values
-    def __init__(self, domain_, functionValues_):
+    # validate_ may be set to False to postpone checking that the slopes define a function until validate is called
+    def __init__(self, domain_, functionValues_, validate_=True):
         self._domain = domain_
         self._functionValues = functionValues_
-        self.assertIsWellDefined()
+        self._isValidated = False
+        self._arrayFunctionCache = None
+        if validate_:
+            self.validate()
         self.generateVertexValues()
         # self.assertIsAffineLinear()
 
+    # Builds a function from a dictionary holding every slope and every vertex value, skipping validation and the
+    # computation of values. Only for results that are already known to be functions, such as sums of functions.
+    @staticmethod
+    def _fromTrustedValues(domain, functionValues, isValidated=True):
+        function = PiecewiseLinearFunction.__new__(PiecewiseLinearFunction)
+        function._domain = domain
+        function._functionValues = functionValues
+        function._isValidated = isValidated
+        function._arrayFunctionCache = None
+        return function
+
     # Make the domain read only
     @property
     def domain(self):
@@ -22,34 +38,47 @@ class PiecewiseLinearFunction(object):
     def functionValues(self):
         return self._functionValues
 
-    def propogateVertexValues(self, tree):
-        for child, connectingEdge in tree.children:
-
-            if connectingEdge.vert1 == tree.value:
-                orientation = 1
-            else:
-                orientation = -1
-
-            self.functionValues[child.value] = self.functionValues[tree.value] + \
-                                               (orientation * self.functionValues[connectingEdge]) * connectingEdge.length
-            self.propogateVertexValues(child)
+    # Whether the slopes are known to define a function
+    @property
+    def isValidated(self):
+        return self._isValidated
 
-    # Todo - Figure out how to handle a disconnected domain
+    # The ArrayPiecewiseLinearFunction version of self, built once and kept until self is changed in place. Raises a
+    # ValueError if a slope is not an integer or a value has a denominator.
+    @property
+    def arrayFunction(self):
+        from .ArrayPiecewiseLinearFunction import ArrayPiecewiseLinearFunction
+
+        if self._arrayFunctionCache is None:
+            self._arrayFunctionCache = ArrayPiecewiseLinearFunction.fromFunction(self)
+        return self._arrayFunctionCache
+
+    # Checks that the slopes define a function, unless that is already known
+    def validate(self):
+        if not self._isValidated:
+            self.assertIsWellDefined()
+            self._isValidated = True
+        return self
+
+    # Computes the values of the function at the vertices from its slopes in a single pass over a breadth first
+    # spanning forest of the domain. Each connected component is based at a vertex whose value was given, if there is
+    # one (any other given values in that component are overwritten), and otherwise at a vertex of value zero.
     def generateVertexValues(self):
-        if len(self.domain.vertices) <= 0:
-            return
-
-        # Get any domain vertex
-
-        if len(self.domain.vertices.intersection(self._functionValues.keys())) > 0:
-            baseVert = self.domain.vertices.intersection(self._functionValues.keys()).pop()
-            tree = self.domain.getSpanningTree(baseVert)
-            self.propogateVertexValues(tree)
-        else:
-            baseVert = list(self.domain.vertices)[0]
-            tree = self.domain.getSpanningTree(baseVert)
-            self.functionValues[tree.value] = self.domain.monoid.zero()
-            self.propogateVertexValues(tree)
+        index = self.domain.index
+        givenVertices = [i for i, v in enumerate(index.vertices) if v in self._functionValues]
+        forest = index.getSpanningForest(givenVertices)
+
+        for i in forest.order:
+            v = index.vertices[i]
+            if forest.parentEdge[i] < 0:
+                if v not in self._functionValues:
+                    self._functionValues[v] = self.domain.monoid.zero()
+            else:
+                parent = index.vertices[forest.parent[i]]
+                connectingEdge = index.edges[forest.parentEdge[i]]
+                orientation = int(forest.parentSign[i])
+                self._functionValues[v] = self._functionValues[parent] + \
+                    (orientation * self._functionValues[connectingEdge]) * connectingEdge.length
 
     def assertIsAffineLinear(self):
         # Assert Non-Negativity at every iteration of the loop!
@@ -66,6 +95,14 @@ class PiecewiseLinearFunction(object):
                 # Ensure the function has integer slope
                 ((self.functionValues[e.vert1] - self.functionValues[e.vert2]) / e.length).is_integer()
 
+    # Checks that the function is non-negative at every vertex. All values are tested against the dual cone at once.
+    @property
+    def isNonNegative(self):
+        vertexValues = [self.functionValues[v] for v in self.domain.vertices]
+        return bool(self.domain.monoid.isgeqzero_many(vertexValues).all())
+
+    # Sums and differences of functions are functions, so they are not validated again. A result is only marked as
+    # validated if both operands are.
     def __add__(self, other):
         assert other.domain == self.domain
 
@@ -73,7 +110,8 @@ class PiecewiseLinearFunction(object):
         for key in self.functionValues.keys():
             newFunctionValues[key] = self.functionValues[key] + other.functionValues[key]
 
-        return PiecewiseLinearFunction(self.domain, newFunctionValues)
+        return PiecewiseLinearFunction._fromTrustedValues(self.domain, newFunctionValues,
+                                                          self.isValidated and other.isValidated)
 
     def __sub__(self, other):
         assert other.domain == self.domain
@@ -82,14 +120,69 @@ class PiecewiseLinearFunction(object):
         for key in self.functionValues.keys():
             newFunctionValues[key] = self.functionValues[key] - other.functionValues[key]
 
-        return PiecewiseLinearFunction(self.domain, newFunctionValues)
+        return PiecewiseLinearFunction._fromTrustedValues(self.domain, newFunctionValues,
+                                                          self.isValidated and other.isValidated)
+
+    def __iadd__(self, other):
+        assert other.domain == self.domain
+
+        for key in self.functionValues.keys():
+            self._functionValues[key] = self.functionValues[key] + other.functionValues[key]
+        self._isValidated = self.isValidated and other.isValidated
+        self._arrayFunctionCache = None
+
+        return self
+
+    def __isub__(self, other):
+        assert other.domain == self.domain
+
+        for key in self.functionValues.keys():
+            self._functionValues[key] = self.functionValues[key] - other.functionValues[key]
+        self._isValidated = self.isValidated and other.isValidated
+        self._arrayFunctionCache = None
+
+        return self
+
+    # Returns the sum of coefficients[i] * functions[i], where the coefficients are integers and the functions share a
+    # domain. If every value is a monoid element with denominator one, the sum is computed on the arrays of all of the
+    # functions at once.
+    @staticmethod
+    def linearCombination(coefficients, functions):
+        coefficients = list(coefficients)
+        functions = list(functions)
+        assert len(coefficients) == len(functions) > 0
+        domain = functions[0].domain
+        assert all(f.domain == domain for f in functions)
+
+        isValidated = all(f.isValidated for f in functions)
+        monoid = domain.monoid
+        slopeKeys = list(domain.edges) + list(domain.legs)
+        vertices = list(domain.vertices)
+
+        vertexValues = [f.functionValues[v] for f in functions for v in vertices]
+        if all(isinstance(value, monoid.Element) for value in vertexValues):
+            values, denominators = monoid.to_array(vertexValues)
+            if np.all(denominators == 1):
+                weights = np.array(coefficients, dtype=np.int64)
+                values = np.tensordot(weights, values.reshape(len(functions), len(vertices), -1), axes=1)
+                slopes = weights @ np.array([[f.functionValues[x] for x in slopeKeys] for f in functions])
+
+                newFunctionValues = dict(zip(vertices, monoid.from_array(values)))
+                newFunctionValues.update(zip(slopeKeys, slopes.tolist()))
+                return PiecewiseLinearFunction._fromTrustedValues(domain, newFunctionValues, isValidated)
+
+        newFunctionValues = {}
+        for key in functions[0].functionValues.keys():
+            newFunctionValues[key] = sum((c * f.functionValues[key] for c, f in zip(coefficients, functions[1:])),
+                                         coefficients[0] * functions[0].functionValues[key])
+        return PiecewiseLinearFunction._fromTrustedValues(domain, newFunctionValues, isValidated)
 
     def __eq__(self, other):
         if not isinstance(other, PiecewiseLinearFunction):
             print("Wrong types")
             return False
 
-        if not self.domain != other.domain:
+        if self.domain != other.domain:
             print("Different domains")
             return False
 
@@ -100,6 +193,36 @@ class PiecewiseLinearFunction(object):
 
         return True
 
+    # The divisor of self, as a dictionary whose keys are the vertices of the domain and whose values are the sums of
+    # the outgoing slopes along the edges and legs at those vertices
+    @property
+    def divisor(self):
+        return PiecewiseLinearFunction.getDivisors([self])[0]
+
+    # Returns the divisors of functions on the same domain as a list of dictionaries (see divisor). The slopes of all
+    # of the functions are multiplied with the incidence matrix of the domain at once.
+    @staticmethod
+    def getDivisors(functions):
+        functions = list(functions)
+        assert len(functions) > 0
+        domain = functions[0].domain
+        assert all(f.domain == domain for f in functions)
+
+        index = domain.index
+        slopeKeys = index.edges + index.legs
+        slopes = np.array([[f.functionValues[x] for x in slopeKeys] for f in functions]).reshape(len(functions), -1)
+        if np.any(slopes != np.round(slopes)):
+            raise ValueError("Slopes must be integers.")
+
+        divisors = index.getDivisors(slopes.astype(np.int64))
+        return [dict(zip(index.vertices, divisor.tolist())) for divisor in divisors]
+
+    # A hashable key of the pair (domain, self) that is invariant under isomorphisms of the domain, see
+    # ArrayPiecewiseLinearFunction.canonicalKey
+    @property
+    def canonicalKey(self):
+        return self.arrayFunction.canonicalKey
+
     def printSelf(self):
         for v in self.domain.vertices:
             print(v.name, self.functionValues[v].coeffs)
@@ -109,37 +232,22 @@ class PiecewiseLinearFunction(object):
         for l in self.domain.legs:
             print(l.name, self.functionValues[l])
 
+    # Checks if the connected component of vert (using only allowedVertices) contains a vertex of S and a vertex of T
     def floodfillVertices(self, vert, S, T, allowedVertices=None):
+        index = self.domain.index
 
-        if allowedVertices is None:
-            allowedVertices = self.domain.vertices
-
-        edgesToCheck = {e for e in self.domain.edges if (vert in e.vertices and vert in allowedVertices)}
-
-        edgesVisited = set()
-
-        foundAnSVertex = False
-        foundATVertex = False
-        while len(edgesToCheck) > 0:
-            nextEdge = edgesToCheck.pop()
-            edgesVisited = edgesVisited | {nextEdge}
-            # Check something here
-            if (nextEdge.vert1 in T and nextEdge.vert1 in allowedVertices) or (
-                    nextEdge.vert2 in T and nextEdge.vert2 in allowedVertices):
-                foundATVertex = True
-            if (nextEdge.vert1 in S and nextEdge.vert1 in allowedVertices) or (
-                    nextEdge.vert2 in S and nextEdge.vert2 in allowedVertices):
-                foundAnSVertex = True
-            if foundATVertex and foundAnSVertex:
-                return True
+        allowed = None
+        if allowedVertices is not None:
+            allowed = index.getVertexMask(allowedVertices)
+            if not allowed[index.vertexIndex[vert]]:
+                return False
 
-            edgesToCheck = edgesToCheck | ({e for e in self.domain.edges if (
-                    nextEdge.vert1 in e.vertices and e.vert1 in allowedVertices and e.vert2 in allowedVertices)} - edgesVisited)
-            edgesToCheck = edgesToCheck | ({e for e in self.domain.edges if (
-                    nextEdge.vert2 in e.vertices and e.vert1 in allowedVertices and e.vert2 in allowedVertices)} - edgesVisited)
+        # Nothing is found from a vertex without any edges
+        if len(index.adjacency[index.vertexIndex[vert]]) == 0:
+            return False
 
-        # print("S:", foundAnSVertex, "T:", foundATVertex)
-        return False
+        reachable = index.getReachableFrom(index.getVertexMask({vert}), allowed)
+        return bool((reachable & index.getVertexMask(S)).any() and (reachable & index.getVertexMask(T)).any())
 
     # Returns twice the integral of self over the supplied path
     def doubleIntegrateOverLoop(self, loop):
@@ -192,53 +300,65 @@ class PiecewiseLinearFunction(object):
 
         return integral
 
+    # The slopes define a function iff their integral around every loop is zero. The integrals around a basis of loops
+    # are computed at once from the cycle matrix of the domain.
     def assertIsWellDefined(self):
-        for l in self.domain.loops:
-            assert self.doubleIntegrateOverLoop(l) == self.domain.monoid.zero()
+        index = self.domain.index
+        edgeSlopes = [self.functionValues[e] for e in index.edges]
+        assert index.slopesAreWellDefined(edgeSlopes), "The slopes do not integrate to zero around every loop."
 
     def getSpecialSupport(self):
 
-        supportEdges = set()
-        supportVertices = set()
+        zero = self.domain.monoid.zero()
+        supportVertices = {v for v in self.domain.vertices if self.functionValues[v] != zero}
 
-        for x in self.domain.edges:
-            if x.vert1 != None and x.vert2 != None:
-                if self.functionValues[x.vert1] != self.domain.monoid.zero() or self.functionValues[x.vert2] != self.domain.monoid.zero():
-                    supportEdges = supportEdges | {x}
-
-        for i in self.domain.vertices:
-            if self.functionValues[i] != self.domain.monoid.zero():
-                supportVertices = supportVertices | {i}
+        # An edge is in the special support if either of its endpoints is
+        supportEdges = {e for e in self.domain.edges
+                        if e.vert1 != None and e.vert2 != None and
+                        (e.vert1 in supportVertices or e.vert2 in supportVertices)}
 
         return (supportEdges, supportVertices)
 
+    # Returns a list of sets, one for each connected component of the special support, containing the edges of that
+    # component. The components are found with one union-find pass over the edges of the domain.
     def getSpecialSupportPartition(self):
+        index = self.domain.index
+        vertexLabels, edgeLabels = self._getSpecialSupportLabels()
 
-        supportEdges, supportVertices = self.getSpecialSupport()
-        connectedComponents = []
-        supportVerticesNeedingComponent = list(supportVertices)
-        while supportVerticesNeedingComponent != []:
-            v = supportVerticesNeedingComponent[0]
-            verticesToCheck = [v]
-            supportComponentEdges = set()
-            while verticesToCheck != []:
-                currentVertex = verticesToCheck[0]
-                for e in supportEdges - supportComponentEdges:
-                    if currentVertex in e.vertices:
-                        supportComponentEdges = supportComponentEdges | {e}
-                        if e.vert1 in supportVertices:
-                            verticesToCheck = verticesToCheck + [e.vert1]
-                        if e.vert2 in supportVertices:
-                            verticesToCheck = verticesToCheck + [e.vert2]
-
-                verticesToCheck.remove(currentVertex)
-                if currentVertex in supportVerticesNeedingComponent:
-                    supportVerticesNeedingComponent.remove(currentVertex)
-
-            connectedComponents.append(supportComponentEdges)
+        connectedComponents = [set() for _ in range(int(vertexLabels.max()) + 1 if vertexLabels.size else 0)]
+        for e, label in zip(index.edges, edgeLabels.tolist()):
+            if label >= 0:
+                connectedComponents[label].add(e)
 
         return connectedComponents
 
+    # Returns the connected components of the special support as BasicFamilyView objects. Each view contains the support
+    # vertices of its component together with all edges touching them, including their endpoints outside the support.
+    def getSpecialSupportComponents(self):
+        index = self.domain.index
+        vertexLabels, edgeLabels = self._getSpecialSupportLabels()
+
+        numComponents = int(vertexLabels.max()) + 1 if vertexLabels.size else 0
+        componentVertices = [[] for _ in range(numComponents)]
+        componentEdges = [[] for _ in range(numComponents)]
+        for v, label in zip(index.vertices, vertexLabels.tolist()):
+            if label >= 0:
+                componentVertices[label].append(v)
+        for e, label in zip(index.edges, edgeLabels.tolist()):
+            if label >= 0:
+                componentEdges[label].append(e)
+
+        return [BasicFamilyView(self.domain, componentVertices[i], componentEdges[i], name_="support")
+                for i in range(numComponents)]
+
+    # Labels the vertices and edges of the domain by the connected component of the special support containing them
+    # (see CurveIndex.getComponentLabels)
+    def _getSpecialSupportLabels(self):
+        index = self.domain.index
+        zero = self.domain.monoid.zero()
+        vertexMask = np.array([self.functionValues[v] != zero for v in index.vertices], dtype=bool)
+        return index.getComponentLabels(vertexMask)
+
     @property
     def mesaTest(self):
 
@@ -251,19 +371,17 @@ class PiecewiseLinearFunction(object):
             if self.functionValues[i.root] != self.domain.monoid.zero():
                 return False
 
-        # specialSupports contains a list of sets. Each set in the list contains the edges of one of the connected
-        # components of the support. These edges may contain vertices out of the support.
-        specialSupports = self.getSpecialSupportPartition()
-
-        # The rest of the checks must hold for each connected component of the support.
-        for j in specialSupports:
+        # specialSupports contains a view of each connected component of the support. These views contain every edge
+        # touching the component, so they may contain vertices out of the support.
+        specialSupports = self.getSpecialSupportComponents()
 
-            # Support component realized as a Combinatorial Curve
-            support = BasicFamily("support")
-            support.addEdges(j)
+        # Reachability questions are answered over the index of the domain
+        index = self.domain.index
+        allSupportVertices = {v for v in self.domain.vertices if self.functionValues[v] != self.domain.monoid.zero()}
+        outsideSupport = ~index.getVertexMask(allSupportVertices)
 
-            # Core of the support realized as a Combinatorial Curve
-            supportCore = support.core
+        # The rest of the checks must hold for each connected component of the support.
+        for support in specialSupports:
 
             assert support.isConnected
 
@@ -273,6 +391,10 @@ class PiecewiseLinearFunction(object):
                 print("Not Genus 1")
                 return False
 
+            # Core of the support, again as a view of the domain. It is only defined now that the genus is known to be
+            # positive.
+            supportCore = support.core
+
             # Check that the function is constant over the core of associated support:
 
             # Get a random function value from the support-core vertices
@@ -284,30 +406,26 @@ class PiecewiseLinearFunction(object):
                     return False
 
             # Every vertex of the support must lie on a path from the core of the support component to a vertex outside
-            # of the support
-            allSupportVertices = {v for v in self.domain.vertices if self.functionValues[v] != self.domain.monoid.zero()}
+            # of the support. All such vertices are found with one search from each side.
             thisComponentSupportVertices = allSupportVertices.intersection(support.vertices)
-
-            S = supportCore.vertices
-            T = self.domain.vertices - allSupportVertices
+            onSomePath = index.getVerticesBetween(index.getVertexMask(supportCore.vertices), outsideSupport)
 
             for v in thisComponentSupportVertices:
 
-                if not self.floodfillVertices(v, S, T):
+                if not onSomePath[index.vertexIndex[v]]:
                     print(v.name, v.genus, "Failed Part 4")
                     return False
 
             # Check that the function has slope 0 or 1 on every edge out of the core (oriented towards the core)
             edgesToCheck = support.edges - supportCore.edges
 
-            for nextEdge in edgesToCheck:
-                # Search for the vertices of the core that actually belong to the support
-                P = supportCore.vertices.intersection(allSupportVertices)
+            # For every edge at once, find which endpoint is nearer to the vertices of the core that actually belong
+            # to the support. That endpoint is the side of the edge closest to the core.
+            P = supportCore.vertices.intersection(allSupportVertices)
+            vert1IsNearer = index.getVert1IsNearer(index.getVertexMask(P))
 
-                # Check if a vertex from P can be reached from vert1 of nextEdge if we do not allow ourselves to
-                # travel over vert2 of nextEdge. If this can be done, then vert1 is the side of nextEdge that is
-                # closest to the core. Otherwise, it's vert2.
-                vert1TowardsCore = self.floodfillVertices(nextEdge.vert1, P, P, self.domain.vertices - {nextEdge.vert2})
+            for nextEdge in edgesToCheck:
+                vert1TowardsCore = vert1IsNearer[index.edgeIndex[nextEdge]]
 
                 # Calculate the rise of the function with respect to orientation towards the core.
                 if vert1TowardsCore:
@@ -339,19 +457,34 @@ class PiecewiseLinearFunction(object):
         # print("A Mesa I Am")
         return True
 
-    # Computes the pushforward of self along the given morphism
+    # Computes the pushforward of self along the given morphism. This is a function on the codomain if the morphism is
+    # surjective, and on morphism.imageCurve otherwise. Whenever possible, it is computed from arrayFunction, which
+    # keeps the pushforward along each morphism (see ArrayPiecewiseLinearFunction.getPushforwards).
     def getPushforward(self, morphism):
         assert isinstance(morphism, BasicFamilyMorphism), "morphism should be a morphism of basic families."
         assert morphism.domain == self.domain, "morphism and self should have the same domain."
 
-        # The domain of the pushforward is the image of the morphism
-        pushforwardDomain = morphism.image()
+        try:
+            arrayFunction = self.arrayFunction
+        except ValueError:
+            arrayFunction = None
+        if arrayFunction is not None:
+            return arrayFunction.getPushforward(morphism).toFunction()
+
+        # The domain of the pushforward is the codomain if the morphism is surjective, and its image otherwise
+        image = morphism.image()
+        codomain = morphism.codomain
+        isSurjective = (len(image.vertices) == len(codomain.vertices) and len(image.edges) == len(codomain.edges)
+                        and len(image.legs) == len(codomain.legs))
+        pushforwardDomain = codomain if isSurjective else morphism.imageCurve
 
         pushforwardFunctionValues = {}
         for nextEdge in self.domain.edges:
-            # If the edge does not collapse, then keep its slope.
-            if morphism(nextEdge) in morphism.codomain.edges:
-                pushforwardFunctionValues[morphism(nextEdge)] = self.functionValues[nextEdge]
+            # If the edge does not collapse, then keep its slope, flipping the sign if its image runs the other way.
+            imageEdge = morphism(nextEdge)
+            if imageEdge in codomain.edges:
+                sign = 1 if morphism(nextEdge.vert1) == imageEdge.vert1 else -1
+                pushforwardFunctionValues[imageEdge] = sign * self.functionValues[nextEdge]
         for nextVert in self.domain.vertices:
             pushforwardFunctionValues[morphism(nextVert)] = morphism(self.functionValues[nextVert])
         for nextLeg in self.domain.legs:
@@ -359,34 +492,17 @@ class PiecewiseLinearFunction(object):
 
         return PiecewiseLinearFunction(pushforwardDomain, pushforwardFunctionValues)
 
-    # functionContractions will return a dictionary of curves as keys with SPLFs as values.
+    # functionContractions returns a dictionary whose keys are the edges of the domain, and whose values are the
+    # functions on the contractions of the domain by those edges. Edges where the contracted function is not well
+    # defined are left out; ArrayPiecewiseLinearFunction.getEdgeContractions reports them explicitly. The contractions
+    # are computed from the arrays of self, and only the curves of the well defined ones are built.
     def functionContractions(self):
+        from .ArrayPiecewiseLinearFunction import ArrayPiecewiseLinearFunction
 
         dictOfContractedFunctions = {}
 
-        for e in self.domain.edges:
-            contraction, copyInfo = self.domain.getContraction(e, True)
-
-            newFunctionValues = {}
-
-            for i in self.domain.edges:
-                if copyInfo[i] in contraction.edges:
-                    newFunctionValues[copyInfo[i]] = self.functionValues[i] 
-            
-            for l in self.domain.legs:
-                newFunctionValues[copyInfo[l]] = self.functionValues[l]
-
-            try:
-
-                #for f in newFunctionValues:
-                #    print(f.name, newFunctionValues[f])
-
-                #contraction.printSelf()
-                function = PiecewiseLinearFunction(contraction, newFunctionValues)
-                function.assertIsWellDefined()
-                dictOfContractedFunctions[e] = function
-            except:
-                #print("ERROR: In initializing function for " + contraction.name)
-                pass
+        for e, contraction in ArrayPiecewiseLinearFunction.fromFunction(self).getEdgeContractions().items():
+            if contraction.isWellDefined:
+                dictOfContractedFunctions[e] = contraction.toFunction().toFunction()
 
-        return dictOfContractedFunctions
\ No newline at end of file
+        return dictOfContractedFunctions
@@ -3,6 +3,8 @@ import math
 import itertools
 import copy
 
+import numpy as np
+
 def gcd( a, b ):
 	while a:
 		a, b = b, a % b
@@ -11,20 +13,61 @@ def gcd( a, b ):
 def lcm( a, b ):
 	return a*b/gcd(a,b)
 
+class GeneratorRegistry( object ):
+	# hands out integer generator ids that are shared by many monoids, for
+	# example the edge length monoids of all the curves of a moduli space,
+	# and remembers a label for each id
+	def __init__( R ):
+		R.labels = []
+		R.released = []		# ids given back with release, handed out again
+							# before new ids are made
+		R.base = None		# the free monoid on every id, built with the
+							# first view; its Element class is shared by
+							# all of the views
+
+	def __len__( R ):
+		return len( R.labels )
+
+	def register( R, label=None ):
+		if R.released:
+			gen = R.released.pop()
+			R.labels[gen] = label
+			return gen
+		R.labels.append( label )
+		if R.base != None: R.base.gens = range( len( R.labels ) )
+		return len( R.labels ) - 1
+
+	# gives back ids that are no longer used by any monoid, for example
+	# the generators of a curve that turned out to be a duplicate
+	def release( R, gens ):
+		for gen in gens:
+			R.labels[gen] = None
+			R.released.append( gen )
+
+	def label( R, gen ):
+		return R.labels[gen]
+
+	# a new monoid whose generators are ids issued by this registry
+	def view( R, gens=[] ):
+		if R.base == None:
+			R.base = Monoid( registry=R )
+			R.base.gens = range( len( R.labels ) )
+		return MonoidView( R, gens )
+
 class Monoid( object ):
-	def __init__( m, gens=[], rels={} ):
+	def __init__( m, gens=[], rels={}, registry=None ):
 		m.gens = list( gens )		# must store as a list so iterations 
 									# are always in the same order
 									# this should be changd to a tuple
 
 		m.rels = { }
 
-		m.dual = None
+		m.registry = registry		# if not None, the generators are ids
+									# issued by this GeneratorRegistry
 
-		for R in rels:
-			m.addrel( R )
-
-		m.compute_dual()
+		m.dual = None
+		m.dualmatrix = None	# rows are the functions in m.dual evaluated
+							# on the generators, in the order of m.gens
 
 		class Element( object ):
 			# elements here mean elements of the associated group
@@ -91,13 +134,39 @@ class Monoid( object ):
 			
 		m.Element = Element
 
+		for R in rels:
+			m.addrel( R )
+
+		m.compute_dual()
+
 	def zero( self ):
 		return self.Element( { } )
 
+	# returns a monoid with the same generators and relations that can be
+	# changed without affecting self; elements of self are not elements of
+	# the copy, but can be moved over with copy.Element( x.coeffs, x.denom )
+	def copy( self ):
+		c = Monoid( registry=self.registry )
+		c.gens = list( self.gens )
+		c.rels = { x : c.Element( dict( r.coeffs ), r.denom ) 
+					for x, r in self.rels.items() }
+		c.dual = None
+		return c
+
 
 	def addgen( self, gen ):			# this should be removed;
 										# just make this part of __init__
 		self.gens.append( gen )
+		self.dual = None		# the dual is stale now; it is recomputed
+								# the next time it is needed
+
+	# adds a new generator and returns it. if the monoid has a registry, the
+	# generator is a fresh id from the registry and label is recorded there;
+	# otherwise the label itself is the generator
+	def newgen( self, label ):
+		gen = label if self.registry == None else self.registry.register( label )
+		self.addgen( gen )
+		return gen
 
 	def addrel( self, rel ):
 		for x in self.gens:
@@ -120,6 +189,8 @@ class Monoid( object ):
 
 	def compute_dual( M ):
 		M.dual = set()
+		dualrows = []
+		M.dualmatrix = np.zeros( ( 0, len(M.gens) ), dtype=np.int64 )
 
 		basis = [ x for x in M.gens if x not in M.rels.keys() ]
 		dim = len(basis)
@@ -151,10 +222,17 @@ class Monoid( object ):
 
 				return w[lastcol] if w.denom >= 0 else -w[lastcol]
 
-			if all( [ F(M.Element({x:1})) >= 0 for x in M.gens ] ):
+			# F is linear, so its values on the generators determine it
+			row = [ F(M.Element({x:1})) for x in M.gens ]
+			if all( [ c >= 0 for c in row ] ):
 				M.dual.add( F )
-			elif all( [ F(M.Element({x:1})) <= 0 for x in M.gens ]):
-				M.dual.add( lambda v : -F( v ) )
+				dualrows.append( row )
+			elif all( [ c <= 0 for c in row ] ):
+				M.dual.add( lambda v, F=F : -F( v ) )
+				dualrows.append( [ -c for c in row ] )
+
+		if dualrows:
+			M.dualmatrix = np.array( dualrows, dtype=np.int64 )
 
 
 	def add( self, x, y ):
@@ -188,7 +266,8 @@ class Monoid( object ):
 		
 	def scale( self, n, x ):
 		assert isinstance(n, int) and isinstance( x, self.Element )
-		return self.Element( { k : n * x.coeffs[k] for k in x.coeffs.keys() } )
+		return self.Element( { k : n * x.coeffs[k] for k in x.coeffs.keys() },
+							 x.denom )
 
 	def iscale( self, n, x ):
 		for k in x.coeffs.keys():
@@ -220,6 +299,25 @@ class Monoid( object ):
 			z.denom *= rels[w][w]
 		return z
 
+	def reduce_array( M, A, gens=None ):
+		# scalereduce applied to every row of A at once; the rows are the
+		# coefficients of elements in the order of gens
+		return M.relation_array( gens ).reduce_array( A )
+
+	def iszero_many( M, A, gens=None ):
+		# returns a boolean mask saying which rows of A are relations, that
+		# is, which rows are equal to zero in the monoid
+		if len( M.rels ) == 0:
+			return ~np.any( np.asarray( A ) != 0, axis=-1 )
+		return M.relation_array( gens ).iszero_many( A )
+
+	def relation_array( M, gens=None ):
+		# the relations as a RelationArray, with columns in the order of gens
+		if gens == None: gens = M.gens
+		index = { x : i for i, x in enumerate( gens ) }
+		rows, d = M.to_array( [ M.rels[w] for w in M.rels.keys() ], gens )
+		return RelationArray( rows, [ index[w] for w in M.rels.keys() ] )
+
 	def eq( self, x, y ):
 		# we use Gaussian elimination to determine whether x - y is a relation
 		# we work with saturated monoids here, so we can do Gaussian elimination
@@ -231,27 +329,179 @@ class Monoid( object ):
 		return not any(z.coeffs.values())
 
 	def isgeqzero( M, x ):
+		if M.dual == None: M.compute_dual()
 		return all( [ F(x) >= 0 for F in M.dual ] )
 
+	def to_array( M, elements, gens=None ):
+		# stacks the coefficients of the given elements into an integer
+		# matrix with one row per element and one column per generator
+		# the denominators are returned separately as a vector
+		if gens == None: gens = M.gens
+		index = { x : i for i, x in enumerate( gens ) }
+		elements = list( elements )
+		A = np.zeros( ( len(elements), len(gens) ), dtype=np.int64 )
+		d = np.ones( len(elements), dtype=np.int64 )
+		for i, x in enumerate( elements ):
+			for k, c in x.coeffs.items():
+				A[i, index[k]] = c
+			d[i] = x.denom
+		return A, d
+
+	def from_array( M, A, d=None, gens=None ):
+		# inverse of to_array: turns the rows of A back into elements
+		if gens == None: gens = M.gens
+		A = np.asarray( A )
+		if d is None: d = np.ones( len(A), dtype=np.int64 )
+		return [ M.Element( { gens[j] : int(row[j]) for j in np.flatnonzero(row) },
+							int(d[i]) )
+				 for i, row in enumerate( A ) ]
+
+	def isgeqzero_many( M, elements ):
+		# batch version of isgeqzero: returns a boolean mask saying which of
+		# the given elements are >= 0 with respect to every function in the
+		# dual, using the matrix of the dual in place of the closures
+		if M.dual == None: M.compute_dual()
+		A, d = M.to_array( elements )
+		if len( M.dualmatrix ) == 0:
+			return np.ones( len(A), dtype=bool )
+
+		values = A @ M.dualmatrix.T
+		# the dual functions take the sign of the denominator into account
+		values *= np.sign( d )[:, None]
+		return np.all( values >= 0, axis=1 )
+
 	def matrix_vector_mult( M, A, x ):
 		return sum( ( x[z] * A[z] for z in x.coeffs ), M.zero() )
 
+class RelationArray( object ):
+	# the relations of a monoid as plain integer arrays: one row of
+	# coefficients per relation, and the column of the generator that each
+	# relation eliminates. it compares values the way the monoid does, but
+	# is cheap to build and can be sent to other processes
+	def __init__( R, rows, pivots ):
+		R.rows = np.asarray( rows, dtype=np.int64 )
+		R.pivots = list( pivots )
+
+	def reduce_array( R, A ):
+		A = np.array( A, dtype=np.int64 )
+		for rel, p in zip( R.rows, R.pivots ):
+			a = A[:, p].copy()
+			A *= rel[p]
+			A -= a[:, None] * rel
+		return A
+
+	# gens is accepted, and ignored, so that this can stand in for a monoid
+	# whose generators are in the order of the columns
+	def iszero_many( R, A, gens=None ):
+		A = np.asarray( A )
+		if len( R.pivots ) == 0:
+			return ~np.any( A != 0, axis=-1 )
+		shape = A.shape
+		A = R.reduce_array( A.reshape( -1, shape[-1] ) )
+		return ~np.any( A != 0, axis=-1 ).reshape( shape[:-1] )
+
+class MonoidView( Monoid ):
+	# a free monoid on some of the ids issued by a GeneratorRegistry. all
+	# views of a registry share the Element class of its base monoid, so a
+	# view only keeps its own list of generators, and its dual is computed
+	# the first time it is needed. elements of one view can be used in
+	# another view of the same registry
+	def __init__( m, registry, gens=[] ):
+		m.gens = list( gens )
+		m.rels = { }
+		m.registry = registry
+		m.dual = None
+		m.dualmatrix = None
+		m.Element = registry.base.Element
+
+	def copy( self ):
+		return MonoidView( self.registry, self.gens )
+
+	def addrel( self, rel ):
+		raise ValueError( "a view of a generator registry is a free monoid" )
+
 class MonoidHomomorphism( object ):
-	def __init__( F, domain, codomain, matrix ):
+	# matrix is either a dict sending each generator of the domain to an
+	# element of the codomain, or an integer array whose columns are the
+	# coefficients of those images (in the order of domain.gens and
+	# codomain.gens), all divided by denom
+	# with validate=False the checks are deferred until validate() is called;
+	# this is meant for morphisms built by code that knows they are valid
+	def __init__( F, domain, codomain, matrix, denom=1, validate=True ):
 		assert isinstance( domain, Monoid )
 		assert isinstance( codomain, Monoid )
-		assert isinstance( matrix, dict )
-		assert set( matrix.keys() ) == set( domain.gens )
-		assert all( ( isinstance( matrix[x], codomain.Element ) 
-						for x in domain.gens ) )
-		assert all( ( codomain.isgeqzero( matrix[x] )
-						for x in domain.gens ) )
-		assert all( ( codomain.matrix_vector_mult( matrix, domain.rels[x] ) 
-													== codomain.zero() 
-						for x in domain.rels ) ), "Not a well-defined function!"
 		F.domain = domain
 		F.codomain = codomain
-		F.matrix = matrix
+
+		# the generators are fixed now, so later calls to addgen on either
+		# monoid do not change the meaning of the rows and columns
+		F.domaingens = list( domain.gens )
+		F.codomaingens = list( codomain.gens )
+		F.domainindex = { x : j for j, x in enumerate( F.domaingens ) }
+
+		if isinstance( matrix, dict ):
+			assert set( matrix.keys() ) == set( domain.gens )
+			assert all( ( isinstance( matrix[x], codomain.Element ) 
+							for x in domain.gens ) )
+			A, d = codomain.to_array( [ matrix[x] for x in domain.gens ] )
+			# put every column over a common denominator
+			denom = int( np.lcm.reduce( d ) ) if len( d ) else 1
+			F.array = A.T * ( denom // d )
+			F.denom = denom
+			F._matrix = matrix
+		else:
+			F.array = np.asarray( matrix, dtype=np.int64 )
+			assert F.array.shape == ( len(F.codomaingens), len(F.domaingens) )
+			F.denom = denom
+			F._matrix = None
+
+		F.validated = False
+		if validate:
+			F.validate()
+
+	# the images of the generators as a dict, built from the array if needed
+	@property
+	def matrix( F ):
+		if F._matrix == None:
+			images = F.codomain.from_array( F.array.T,
+						[ F.denom ] * len( F.domaingens ), F.codomaingens )
+			F._matrix = dict( zip( F.domaingens, images ) )
+		return F._matrix
+
+	def validate( F ):
+		images = F.codomain.from_array( F.array.T,
+						[ F.denom ] * len( F.domaingens ), F.codomaingens )
+		assert all( F.codomain.isgeqzero_many( images ) )
+		assert all( ( F( F.domain.rels[x] ) == F.codomain.zero()
+						for x in F.domain.rels ) ), "Not a well-defined function!"
+		F.validated = True
 
 	def __call__( F, x ):
-		return F.codomain.matrix_vector_mult( F.matrix, x )
+		cols = [ F.domainindex[k] for k in x.coeffs ]
+		y = F.array[ :, cols ] @ np.array( list( x.coeffs.values() ), dtype=np.int64 )
+		return F.codomain.Element( { F.codomaingens[i] : int( y[i] ) 
+										for i in np.flatnonzero( y ) },
+								   x.denom * F.denom )
+
+	# applies F to the rows of A (coefficients in the order of domaingens)
+	# and returns the coefficients and denominators of the images
+	def apply_array( F, A, d=None ):
+		A = np.asarray( A, dtype=np.int64 )
+		if d is None: d = np.ones( len(A), dtype=np.int64 )
+		return A @ F.array.T, np.asarray( d ) * F.denom
+
+	def apply_many( F, elements ):
+		A, d = F.domain.to_array( elements, F.domaingens )
+		B, e = F.apply_array( A, d )
+		return F.codomain.from_array( B, e, F.codomaingens )
+
+	# returns the composition F o G, which first applies G and then F
+	def compose( F, G ):
+		assert isinstance( G, MonoidHomomorphism )
+		assert G.codomain is F.domain
+		assert G.codomaingens == F.domaingens
+		H = MonoidHomomorphism( G.domain, F.codomain, F.array @ G.array,
+								F.denom * G.denom, validate=False )
+		# a composition of valid homomorphisms is valid
+		H.validated = F.validated and G.validated
+		return H
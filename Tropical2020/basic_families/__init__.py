@@ -4,3 +4,9 @@ from .Edge import *
 from .BasicFamily import *
 from .PiecewiseLinearFunction import *
 from .RPC import *
+from .CanonicalForm import *
+from .CurveIndex import *
+from .BasicFamilyView import *
+from .ArrayPiecewiseLinearFunction import *
+from .MesaEnumerator import *
+from .MorphismEnumerator import *
@@ -1,4 +1,6 @@
 from ..basic_families.PiecewiseLinearFunction import *
+from .ModuliSpace import TropicalModuliSpace
+import multiprocessing
 
 
 class Family(object):
@@ -10,13 +12,100 @@ class Family(object):
         if not isinstance(morphisms, set):
             raise ValueError("morphisms must be a Set[BasicFamilyMorphism]")
 
-        # Ensure that the morphisms actually belong in this family
+        self._basicFamilies = set()
+        self._morphisms = set()
+
+        # _incoming[A] and _outgoing[A] are the sets of morphisms with codomain A and with domain A
+        self._incoming = {}
+        self._outgoing = {}
+
+        # Variables for caching read only copies of the basic families and morphisms
+        self._basicFamiliesCache = None
+        self._morphismsCache = None
+
+        # Variables for caching the topological order and the levels
+        self._topologicalOrderCacheValid = False
+        self._topologicalOrderCache = []
+        self._levelCache = {}
+
+        # Variables for caching the transitive reduction
+        self._transitiveReductionCacheValid = False
+        self._transitiveReductionCache = frozenset()
+
+        # _computationCache[(key, reverse)] holds the values computed by computeInOrder under the given key
+        self._computationCache = {}
+
+        self.addBasicFamilies(basicFamilies)
+        self.addMorphisms(morphisms)
+
+    def invalidateCaches(self):
+        self._topologicalOrderCacheValid = False
+        self._transitiveReductionCacheValid = False
+        self._computationCache = {}
+
+    # The basic families and morphisms are frozensets; use the methods below to change them, so that the indexes of
+    # incoming and outgoing morphisms and the cached orders stay up to date
+    @property
+    def basicFamilies(self):
+        if self._basicFamiliesCache is None:
+            self._basicFamiliesCache = frozenset(self._basicFamilies)
+        return self._basicFamiliesCache
+
+    @property
+    def morphisms(self):
+        if self._morphismsCache is None:
+            self._morphismsCache = frozenset(self._morphisms)
+        return self._morphismsCache
+
+    def addBasicFamily(self, basicFamily):
+        if basicFamily not in self._basicFamilies:
+            self._basicFamilies.add(basicFamily)
+            self._basicFamiliesCache = None
+            self._incoming[basicFamily] = set()
+            self._outgoing[basicFamily] = set()
+
+            # Possibly need to recompute the order
+            self.invalidateCaches()
+
+    def addBasicFamilies(self, basicFamilies):
+        for basicFamily in basicFamilies:
+            self.addBasicFamily(basicFamily)
+
+    def addMorphism(self, morphism):
+        # Ensure that the morphism actually belongs in this family
+        assert morphism.domain in self._basicFamilies
+        assert morphism.codomain in self._basicFamilies
+
+        if morphism not in self._morphisms:
+            self._morphisms.add(morphism)
+            self._morphismsCache = None
+            self._incoming[morphism.codomain].add(morphism)
+            self._outgoing[morphism.domain].add(morphism)
+
+            # Possibly need to recompute the order and the reduction
+            self.invalidateCaches()
+
+    def addMorphisms(self, morphisms):
         for morphism in morphisms:
-            assert morphism.domain in basicFamilies
-            assert morphism.codomain in basicFamilies
+            self.addMorphism(morphism)
+
+    def removeMorphism(self, morphism):
+        if morphism in self._morphisms:
+            self._morphisms.remove(morphism)
+            self._morphismsCache = None
+            self._incoming[morphism.codomain].remove(morphism)
+            self._outgoing[morphism.domain].remove(morphism)
 
-        self.basicFamilies = basicFamilies
-        self.morphisms = morphisms
+            # Possibly need to recompute the order and the reduction
+            self.invalidateCaches()
+
+    # Returns the frozenset of morphisms whose codomain is the given basic family
+    def getIncomingMorphisms(self, basicFamily):
+        return frozenset(self._incoming[basicFamily])
+
+    # Returns the frozenset of morphisms whose domain is the given basic family
+    def getOutgoingMorphisms(self, basicFamily):
+        return frozenset(self._outgoing[basicFamily])
 
     # Returns the set of ancestors of the given basic family
     def getAncestors(self, basicFamily):
@@ -24,39 +113,350 @@ class Family(object):
         # Type checking
         assert isinstance(basicFamily, BasicFamily)
 
-        # Get the morphisms that map into the given basic family
-        def isIncoming(morphism):
-            return morphism.codomain == basicFamily
-        incomingArrows = filter(isIncoming, self.morphisms)
-
         # Get the set of domains of the morphisms that map into the given basic family
-        return {arrow.domain for arrow in incomingArrows}
+        return {arrow.domain for arrow in self._incoming[basicFamily]}
 
-    # Returns the maximal ancestors of the given basic family
-    def getMaximalAncestors(self, basicFamily):
+    # Returns the set of descendants of the given basic family, i.e., the codomains of morphisms out of it
+    def getDescendants(self, basicFamily):
 
         # Type checking
         assert isinstance(basicFamily, BasicFamily)
 
-        # Get the morphisms that map into the given basic family from a maximal family
-        def isIncoming(morphism):
-            return morphism.codomain == basicFamily
-        incomingArrows = filter(isIncoming, self.maximalCurvesIter())
+        return {arrow.codomain for arrow in self._outgoing[basicFamily]}
 
-        # Get the set of domains of the morphisms that map into the given basic family
-        return {arrow.domain for arrow in incomingArrows}
+    # Returns the maximal ancestors of the given basic family
+    def getMaximalAncestors(self, basicFamily):
+        return {ancestor for ancestor in self.getAncestors(basicFamily) if self.isMaximal(ancestor)}
+
+    # A basic family is not maximal if it's the codomain of some proper morphism
+    def isMaximal(self, basicFamily):
+        return all(morphism.domain == basicFamily for morphism in self._incoming[basicFamily])
 
     # Returns an iterator of all basic families that are not contractions of any other family
     def maximalCurvesIter(self):
+        return filter(self.isMaximal, self.basicFamilies)
+
+    # The basic families ordered so that the domain of every morphism (other than a morphism from a basic family to
+    # itself) comes before its codomain. Basic families of lower level come first. Raises a ValueError if the morphisms
+    # form a cycle.
+    @property
+    def topologicalOrder(self):
+        if not self._topologicalOrderCacheValid:
+            self._computeTopologicalOrder()
+        return self._topologicalOrderCache
+
+    # Returns the level of the given basic family: the number of morphisms on the longest chain of proper morphisms
+    # that ends there. Maximal basic families have level zero, and every proper morphism raises the level, so there are
+    # no morphisms between different basic families of the same level.
+    def getLevel(self, basicFamily):
+        if not self._topologicalOrderCacheValid:
+            self._computeTopologicalOrder()
+        return self._levelCache[basicFamily]
+
+    # Returns a list whose i-th entry is the list of basic families of level i
+    @property
+    def levels(self):
+        levels = []
+        for basicFamily in self.topologicalOrder:
+            level = self._levelCache[basicFamily]
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(basicFamily)
+        return levels
+
+    # Orders the basic families level by level, counting the proper morphisms into each that are not accounted for yet
+    def _computeTopologicalOrder(self):
+        basicFamilies = self.basicFamilies
+        successors = {basicFamily: self._getProperCodomains(basicFamily) for basicFamily in basicFamilies}
+        inDegree = {basicFamily: 0 for basicFamily in basicFamilies}
+        for codomains in successors.values():
+            for codomain in codomains:
+                inDegree[codomain] += 1
+        level = {}
+        currentLevel = [basicFamily for basicFamily in basicFamilies if inDegree[basicFamily] == 0]
+        order = []
+        levelNumber = 0
+        while currentLevel:
+            # A basic family is only reached once all of the chains into it have been followed, so the number of the
+            # round is the length of the longest chain
+            nextLevel = []
+            for basicFamily in currentLevel:
+                level[basicFamily] = levelNumber
+                order.append(basicFamily)
+            for basicFamily in currentLevel:
+                for codomain in successors[basicFamily]:
+                    inDegree[codomain] -= 1
+                    if inDegree[codomain] == 0:
+                        nextLevel.append(codomain)
+            currentLevel = nextLevel
+            levelNumber += 1
+
+        if len(order) != len(basicFamilies):
+            raise ValueError("The morphisms of the family should not form cycles.")
+
+        self._topologicalOrderCache = order
+        self._levelCache = level
+        self._topologicalOrderCacheValid = True
+
+    # Returns the codomains of the morphisms out of the given basic family, other than itself, with one entry for each
+    # morphism
+    def _getProperCodomains(self, basicFamily):
+        return [morphism.codomain for morphism in self._outgoing[basicFamily] if morphism.codomain != basicFamily]
+
+    # Returns a frozenset of morphisms from which every other morphism of the family can be obtained by composition.
+    # The pairs of basic families connected by the subset form the transitive reduction of the graph of the family: a
+    # morphism from A to B is only left out if there is a longer path from A to B, and it is actually the composition
+    # of morphisms of the subset along such a path (see BasicFamilyMorphism.comparisonKey). Morphisms from a basic
+    # family to itself are always kept.
+    def getTransitiveReduction(self):
+        if self._transitiveReductionCacheValid:
+            return self._transitiveReductionCache
+
+        order = self.topologicalOrder
+        position = {basicFamily: i for i, basicFamily in enumerate(order)}
+        successors = {basicFamily: self.getDescendants(basicFamily) - {basicFamily} for basicFamily in order}
+
+        # descendants[A] has bit i set if there is a path from A to order[i]
+        descendants = {}
+        for basicFamily in reversed(order):
+            mask = 0
+            for successor in successors[basicFamily]:
+                mask |= (1 << position[successor]) | descendants[successor]
+            descendants[basicFamily] = mask
+
+        # A pair is in the transitive reduction if its codomain can not be reached through another successor
+        def isReduced(domain, codomain):
+            bit = 1 << position[codomain]
+            return not any(descendants[other] & bit for other in successors[domain] if other != codomain)
+
+        reduction = {morphism for morphism in self.morphisms
+                     if morphism.domain == morphism.codomain or isReduced(morphism.domain, morphism.codomain)}
+
+        outgoing = {basicFamily: [morphism for morphism in self._outgoing[basicFamily]
+                                  if morphism in reduction and morphism.codomain != basicFamily]
+                    for basicFamily in order}
+
+        # Everything else is kept unless it is a composition of morphisms in the reduction
+        for domain in order:
+            candidates = [morphism for morphism in self._outgoing[domain] if morphism not in reduction]
+            if candidates:
+                targets = {morphism.codomain for morphism in candidates}
+                composites = Family._getComposites(domain, targets, order, outgoing, position, descendants)
+                for morphism in candidates:
+                    if morphism.comparisonKey not in composites[morphism.codomain]:
+                        reduction.add(morphism)
+
+        self._transitiveReductionCache = frozenset(reduction)
+        self._transitiveReductionCacheValid = True
+        return self._transitiveReductionCache
+
+    # Composes the morphisms in outgoing along all paths out of domain that can still reach one of the targets.
+    # Returns a dictionary from each target to the comparison keys of the compositions that end there.
+    @staticmethod
+    def _getComposites(domain, targets, order, outgoing, position, descendants):
+        targetMask = 0
+        for target in targets:
+            targetMask |= 1 << position[target]
+
+        def isUseful(basicFamily):
+            return basicFamily in targets or descendants[basicFamily] & targetMask
+
+        # composites[A] maps comparison keys to the distinct compositions from domain to A
+        composites = {}
+        for morphism in outgoing[domain]:
+            if isUseful(morphism.codomain):
+                composites.setdefault(morphism.codomain, {})[morphism.comparisonKey] = morphism
+
+        # Paths are extended in topological order, so all compositions ending at a basic family are known before they
+        # are extended any further
+        for basicFamily in order[position[domain] + 1:]:
+            if basicFamily not in composites:
+                continue
+            for morphism in outgoing[basicFamily]:
+                if isUseful(morphism.codomain):
+                    extended = composites.setdefault(morphism.codomain, {})
+                    for composite in composites[basicFamily].values():
+                        composition = morphism.compose(composite)
+                        extended.setdefault(composition.comparisonKey, composition)
+
+        return {target: set(composites.get(target, {})) for target in targets}
+
+    # Returns the set of morphisms of the transitive reduction whose domain is the given basic family
+    def getReducedOutgoingMorphisms(self, basicFamily):
+        return self.getOutgoingMorphisms(basicFamily) & self.getTransitiveReduction()
+
+    # Computes a value at every basic family, in topological order, and returns a dictionary of the values.
+    #
+    # compute(basicFamily, inputs) is called once the values at the domains of all proper morphisms into the basic
+    # family are known, with inputs the list of pairs (morphism, value at its domain). With reverse set, the values flow
+    # the other way: inputs holds the pairs (morphism, value at its codomain) for the proper morphisms out of the basic
+    # family.
+    #
+    # compute may also return a WorkerTask instead of the value. The basic families of a level do not depend on each
+    # other, so compute is called for all of them first, and then the functions of their tasks are run together: in a
+    # pool of processes if processes is not 1 (None uses one per CPU), and in this process otherwise.
+    #
+    # If key is given, the values are kept under that key until the family changes, and basic families whose value is
+    # already known are not computed again.
+    def computeInOrder(self, compute, key=None, reverse=False, processes=1):
+        if key is None:
+            values = {}
+        else:
+            values = self._computationCache.setdefault((key, reverse), {})
+
+        levels = self.levels
+        if reverse:
+            levels.reverse()
+
+        pool = None
+        try:
+            for level in levels:
+                tasks = {}
+                for basicFamily in level:
+                    if basicFamily in values:
+                        continue
+                    if reverse:
+                        inputs = [(morphism, values[morphism.codomain])
+                                  for morphism in self.getOutgoingMorphisms(basicFamily)
+                                  if morphism.codomain != basicFamily]
+                    else:
+                        inputs = [(morphism, values[morphism.domain])
+                                  for morphism in self.getIncomingMorphisms(basicFamily)
+                                  if morphism.domain != basicFamily]
+                    value = compute(basicFamily, inputs)
+                    if isinstance(value, WorkerTask):
+                        tasks[basicFamily] = value
+                    else:
+                        values[basicFamily] = value
+
+                if not tasks:
+                    continue
+                work = [(task.function, task.payload) for task in tasks.values()]
+                if processes == 1:
+                    results = [_runWorkerTask(item) for item in work]
+                else:
+                    if pool is None:
+                        pool = multiprocessing.Pool(processes)
+                    results = pool.map(_runWorkerTask, work)
+                for (basicFamily, task), result in zip(tasks.items(), results):
+                    values[basicFamily] = task.finish(result)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return dict(values)
+
+    # Generates the family of all stable curves that specialize to one of the given seed curves, i.e., that contract to
+    # one of them, together with a contraction morphism for each one-step specialization that was found. The seeds are
+    # the minimal strata of the family; they are kept unless they are isomorphic to each other.
+    #
+    # The specializations are found as in TropicalModuliSpace.generateSpaceDFS, but starting from every seed. Curves are
+    # identified up to isomorphism by their canonical keys, and when a specialization matches a curve that is already
+    # known, the morphism onto the curve it came from is composed with an isomorphism from that known curve (see
+    # BasicFamily.getIsomorphismTo). Morphisms are built with BasicFamilyMorphism.fromCurveMorphism, so the length of
+    # every edge of the seeds should be its own generator.
+    @staticmethod
+    def generateFromMinimalStrata(seeds):
+        family = Family(set(), set())
+
+        # representatives[key] is the curve of the family with the canonical key key
+        representatives = {}
+        stack = []
+        for seed in seeds:
+            if seed.canonicalKey not in representatives:
+                representatives[seed.canonicalKey] = seed
+                family.addBasicFamily(seed)
+                stack.append(seed)
+
+        # The comparison keys of the morphisms found so far, so that each morphism is only added once
+        morphismKeys = set()
+
+        while stack:
+            curve = stack.pop()
+            for specialization, contractionMap in TropicalModuliSpace.getOneStepSpecializations(curve, True):
+                representative = representatives.get(specialization.canonicalKey)
+                if representative is None:
+                    representative = specialization
+                    representatives[specialization.canonicalKey] = specialization
+                    family.addBasicFamily(specialization)
+                    stack.append(specialization)
+                    curveMorphismDict = contractionMap
+                else:
+                    isomorphism = representative.getIsomorphismTo(specialization)
+                    curveMorphismDict = {x: contractionMap[image] for x, image in isomorphism.items()}
+                    TropicalModuliSpace.discardSpecialization(specialization, curve)
+
+                morphism = BasicFamilyMorphism.fromCurveMorphism(representative, curve, curveMorphismDict,
+                                                                 validate=False)
+                if morphism.comparisonKey not in morphismKeys:
+                    morphismKeys.add(morphism.comparisonKey)
+                    family.addMorphism(morphism)
+
+        return family
+
+    # Generates the family of all contractions of the given maximal curves, together with the contraction morphisms of
+    # single edges. The maximal curves are kept unless they are isomorphic to each other.
+    #
+    # The curves are handled level by level, from the most edges to the fewest: every edge of every curve with n edges
+    # is contracted, and the contractions are reduced by isomorphism, by their canonical keys, against the curves with
+    # n - 1 edges found so far. When a contraction matches a known curve, the contraction morphism is composed with an
+    # isomorphism to that curve (see BasicFamily.getIsomorphismTo). Morphisms are built with
+    # BasicFamilyMorphism.fromCurveMorphism, so the length of every edge of the maximal curves should be its own
+    # generator.
+    @staticmethod
+    def generateFromMaximalStrata(maximalCurves):
+        family = Family(set(), set())
+
+        # levels[n] maps the canonical keys of the curves of the family with n edges to those curves
+        levels = {}
+
+        # Adds the curve to the family unless it is isomorphic to a curve of the family, and returns its representative
+        def addCurve(curve):
+            level = levels.setdefault(curve.numEdges, {})
+            if curve.canonicalKey not in level:
+                level[curve.canonicalKey] = curve
+                family.addBasicFamily(curve)
+            return level[curve.canonicalKey]
+
+        for curve in maximalCurves:
+            addCurve(curve)
+
+        # The comparison keys of the morphisms found so far, so that each morphism is only added once
+        morphismKeys = set()
+
+        for numEdges in range(max(levels, default=0), 0, -1):
+            for curve in list(levels.get(numEdges, {}).values()):
+                for e in curve.edges:
+                    contractionMorphism = curve.getContractionMorphism(e)
+                    contraction = contractionMorphism.codomain
+                    representative = addCurve(contraction)
+                    if representative is contraction:
+                        curveMorphismDict = contractionMorphism.curveMorphismDict
+                    else:
+                        isomorphism = contraction.getIsomorphismTo(representative)
+                        curveMorphismDict = {x: isomorphism[image]
+                                             for x, image in contractionMorphism.curveMorphismDict.items()}
+
+                    morphism = BasicFamilyMorphism.fromCurveMorphism(curve, representative, curveMorphismDict,
+                                                                     validate=False)
+                    if morphism.comparisonKey not in morphismKeys:
+                        morphismKeys.add(morphism.comparisonKey)
+                        family.addMorphism(morphism)
+
+        return family
 
-        def isMaximal(basicFam):
 
-            # A basic family is not maximal if it's the codomain of some proper morphism
-            for morphism in self.morphisms:
-                if morphism.codomain == basicFam and morphism.domain != basicFam:
-                    return False
+# A value for Family.computeInOrder that is computed in a worker process: function(payload) runs in the pool, and
+# finish(result) turns its result into the value in this process. function should be defined at the top level of a
+# module (or be a static method), and payload and the result should be picklable, such as tuples of numpy arrays.
+class WorkerTask(object):
+    def __init__(self, function, payload, finish):
+        self.function = function
+        self.payload = payload
+        self.finish = finish
 
-            # If this code is reached, then no proper morphism maps into basicFam, and so it's maximal.
-            return True
 
-        return filter(isMaximal, self.basicFamilies)
+# Runs the function of a WorkerTask on its payload. This runs in a worker process.
+def _runWorkerTask(work):
+    function, payload = work
+    return function(payload)
@@ -1,4 +1,9 @@
 from ..basic_families.BasicFamily import *
+from ..basic_families.ArrayPiecewiseLinearFunction import ArrayPiecewiseLinearFunction
+from ..basic_families.MesaEnumerator import MesaEnumerator
+import json
+import multiprocessing
+import os
 import re
 
 
@@ -22,6 +27,14 @@ class TropicalModuliSpace(object):
         # See the documentation for more explanation
         self.contractionDict = {}
 
+        # Every curve of the space draws its edge length generators from this registry, so generators are small
+        # integer ids rather than strings, and no two curves of the space share a generator by accident
+        self.registry = GeneratorRegistry()
+
+        # Curve ID numbers, as read from or written to a save file
+        # curveIds[curve]: Int
+        self.curveIds = {}
+
     @property
     def curves(self):
         return self._curves
@@ -36,7 +49,8 @@ class TropicalModuliSpace(object):
 
     # Given input s of type Set[A], returns a list of all partitions of s into two subsets.
     # The return type of this function is List[(Set[A], Set[A]).
-    def getPartitions(self, s):
+    @staticmethod
+    def getPartitions(s):
 
         # An empty set has exactly one partition into two subsets
         if len(s) == 0:
@@ -52,7 +66,7 @@ class TropicalModuliSpace(object):
         # of s - {elem}, and then incorporate elem into these partitions.
         elem = s.pop()
         s.add(elem)
-        p = self.getPartitions(s - {elem})
+        p = TropicalModuliSpace.getPartitions(s - {elem})
 
         partition = []
         for blockPair in p:
@@ -156,46 +170,81 @@ class TropicalModuliSpace(object):
             # Update self.curves
             self.curves = self.curves | {curve}
 
-    # Adds the specializations of curve to self.curves
-    def addSpecializationsDFS(self, curve):
-        newCurves = []
+    # Returns the one-step specializations of curve that keep it stable, where one vertex is either split in two or
+    # loses one genus to a new self loop. Some evidently isomorphic specializations are skipped, but the list is not
+    # reduced by isomorphism.
+    # If returnContractionMaps is True, a list of pairs (specialization, contractionMap) is returned instead, where
+    # contractionMap sends the vertices, edges, and legs of the specialization to those of curve, as the contraction of
+    # the new edge does: the new edge and vertices go to the vertex that was specialized.
+    @staticmethod
+    def getOneStepSpecializations(curve, returnContractionMaps=False):
+        specializations = []
+
+        # Specializes a copy of curve in place at the copy of vert. specializeInPlace is given the copy and copyInfo.
+        def specialize(vert, description, specializeInPlace):
+            c, copyInfo = curve.getFullyShallowCopy(True)
+            c.name = "(Spec. of " + curve.name + " from " + description + " at " + vert.name + ")"
+            specializeInPlace(c, copyInfo)
+
+            if returnContractionMaps:
+                contractionMap = {copyInfo[x]: x for x in curve.edges | curve.legs}
+                contractionMap.update({copyInfo[v]: v for v in curve.vertices if v != vert})
+                for x in c.vertices | c.edges:
+                    contractionMap.setdefault(x, vert)
+                specializations.append((c, contractionMap))
+            else:
+                specializations.append(c)
 
-        # Get the one-step specializations of the given curve
         for vert in curve.vertices:
 
             # If the genus of vert is greater than 1, then we can decrement its genus and add a self loop
-            if vert.genus > 1:
-                genusReducedCurve = self.getGenusReductionSpecialization(curve, vert)
-                newCurves.append(genusReducedCurve)
             # If the genus of vert is exactly 1, we need to make sure that stability is preserved after genus reduction
-            # This case should only occur when g=1 and we process the seed curve
-            elif vert.genus == 1 and curve.degree(vert) > 0:
-                genusReducedCurve = self.getGenusReductionSpecialization(curve, vert)
-                newCurves.append(genusReducedCurve)
+            if vert.genus > 1 or (vert.genus == 1 and curve.degree(vert) > 0):
+                specialize(vert, "genus reducing",
+                           lambda c, copyInfo: TropicalModuliSpace.specializeByReducingGenus(c, copyInfo[vert]))
 
             # We can also split a vertex in two and pass around parts of its genus and endpoints to the new pieces
-            endpointPartitions = self.getPartitions(curve.getEndpointsOfEdges(vert))
+            endpointPartitions = TropicalModuliSpace.getPartitions(curve.getEndpointsOfEdges(vert))
 
             # Anticipate some isomorphic results - (S, T) and (T, S) produce the same splitting specialization
             endpointPartitions = [(S, T) for (S, T) in endpointPartitions if len(S) <= len(T)]
 
             # Iterate over the possible genuses of the split vertices
             for g in range(vert.genus + 1):
-                for p in endpointPartitions:
-                    S, T = p
+                for S, T in endpointPartitions:
                     # Make sure that the splitting specialization will be stable
                     if not ((g == 0 and len(S) < 2) or (g == vert.genus and len(T) < 2)):
-                        vertexSplitCurve = self.getSplittingSpecialization(curve, vert, g, vert.genus - g, S, T)
-                        newCurves.append(vertexSplitCurve)
+                        specialize(vert, "splitting",
+                                   lambda c, copyInfo: TropicalModuliSpace.specializeBySplittingAtVertex(
+                                       c, copyInfo[vert], g, vert.genus - g,
+                                       {(copyInfo[e], n) for (e, n) in S}, {(copyInfo[e], n) for (e, n) in T}))
+
+        return specializations
+
+    # Gives the generators that specialization added to the monoid of curve back to the registry of the monoid, if it
+    # has one. This is for specializations that are thrown away, for example because they duplicate another curve.
+    @staticmethod
+    def discardSpecialization(specialization, curve):
+        registry = specialization.monoid.registry
+        if registry is not None:
+            registry.release(set(specialization.monoid.gens) - set(curve.monoid.gens))
 
-        # Reduce newCurves before we go down a level - produce fewer curves to reduce in the future
-        newCurvesBuffer = self.reduceByIsomorphism(newCurves)
+    # Adds the specializations of curve to self.curves
+    def addSpecializationsDFS(self, curve):
+        specializations = TropicalModuliSpace.getOneStepSpecializations(curve)
+
+        # Reduce the specializations before we go down a level - produce fewer curves to reduce in the future
+        newCurvesBuffer = self.reduceByIsomorphism(specializations)
         newCurves = []
         for c in newCurvesBuffer:
             if not self.containsUpToIsomorphism(c):
                 newCurves.append(c)
                 self.addCurve(c)
 
+        # The generators of the duplicates are given back to the registry
+        for c in set(specializations) - set(newCurves):
+            TropicalModuliSpace.discardSpecialization(c, curve)
+
         #print("Found ", len(newCurves), " new curves")
         #print("Currently have ", len(self.curves), " curves!")
 
@@ -218,7 +267,7 @@ class TropicalModuliSpace(object):
         v = Vertex("v", self._g)
         seedCurve.addVertex(v)
         seedCurve.addLegs({Leg("leg " + str(i), v) for i in range(self._n)})
-        seedCurve.monoid = Monoid()
+        seedCurve.monoid = self.registry.view()
 
         # Let the seed grow!
         self.addCurve(seedCurve)
@@ -257,6 +306,12 @@ class TropicalModuliSpace(object):
             self.contractionDict[curve] = contractionPairs
             it += 1
 
+    # Returns the space as a Family whose morphisms are the contractions in contractionDict, which are only built when
+    # they are needed (see ModuliSpaceFamily). The contraction dictionary should be generated or loaded first.
+    def asFamily(self):
+        from .ModuliSpaceFamily import ModuliSpaceFamily
+        return ModuliSpaceFamily(self)
+
     # Specializes 'curve' at 'vert' as determined by g1, g2, S, and T
     # Specifically, 'vert' is split into two vertices, v1 and v2, of genuses g1 and g2 respectively,
     # where g1+g2 == vert.genus
@@ -288,9 +343,10 @@ class TropicalModuliSpace(object):
             else:
                 e.root = v2
 
-        curve.monoid.addgen("(Edge splitting " + vert.name + ")")
-        newLength = curve.monoid.Element({"(Edge splitting " + vert.name + ")": 1})
-        e = Edge("(Edge splitting " + vert.name + ")", newLength, v1, v2)
+        name = "(Edge splitting " + vert.name + ")"
+        gen = curve.monoid.newgen(name)
+        newLength = curve.monoid.Element({gen: 1})
+        e = Edge(name, newLength, v1, v2)
 
         curve.addEdge(e)
         curve.removeVertex(vert)
@@ -329,9 +385,10 @@ class TropicalModuliSpace(object):
             else:
                 e.root = v
 
-        curve.monoid.addgen("(Genus reduction loop for " + vert.name + ")")
-        newLength = curve.monoid.Element({"(Genus reduction loop for " + vert.name + ")": 1})
-        e = Edge("(Genus reduction loop for " + vert.name + ")", newLength, v, v)
+        name = "(Genus reduction loop for " + vert.name + ")"
+        gen = curve.monoid.newgen(name)
+        newLength = curve.monoid.Element({gen: 1})
+        e = Edge(name, newLength, v, v)
 
         curve.addEdge(e)
         curve.removeVertex(vert)
@@ -368,7 +425,7 @@ class TropicalModuliSpace(object):
                 contractionInfoFinder = re.compile("\(edge\((v\d*), (v\d*)\), curve (\d*)\)")
 
                 c = BasicFamily("")
-                c.monoid = Monoid()
+                c.monoid = self.registry.view()
 
                 vertices = {}
                 for m in vertexInfoFinder.finditer(vertexInfo):
@@ -385,8 +442,8 @@ class TropicalModuliSpace(object):
                         eVert1Name = m.group(1)
                         eVert2Name = m.group(2)
 
-                        c.monoid.addgen(eName)
-                        eLength = c.monoid.Element({eName: 1})
+                        gen = c.monoid.newgen(eName)
+                        eLength = c.monoid.Element({gen: 1})
 
                         e = Edge(eName, eLength, vertices[eVert1Name], vertices[eVert2Name])
                         edges.add(e)
@@ -414,6 +471,7 @@ class TropicalModuliSpace(object):
                 if m:
                     curveId = m.group(1)
                     curveIdDictionary[curveId] = c
+                    self.curveIds[c] = int(curveId)
 
                 edgeContractions = []
                 for m in contractionInfoFinder.finditer(contractionInfo):
@@ -436,7 +494,7 @@ class TropicalModuliSpace(object):
 
         with open(filename, mode='w', encoding=encoding) as f:
             curveStrings = []
-            curveList = sorted(self.curves, key=lambda x: x.numEdges)
+            curveList = sorted(self.curves, key=TropicalModuliSpace.getCurveOrderKey)
             for c in curveList:
                 c.simplifyNames()
                 vertexNames = [("(" + v.name + " with genus " + str(v.genus) + ")") for v in c.vertices]
@@ -446,10 +504,11 @@ class TropicalModuliSpace(object):
                 edgeLine = "Edges: {" + ",".join(edgeNames) + "}"
                 legLine = "Legs: {" + ",".join(legNames) + "}"
                 idLine = "Curve ID Number: " + str(curveList.index(c))
+                self.curveIds[c] = curveList.index(c)
                 contractionLine = "Contraction info: "
                 contractionStrings = []
                 for info in self.contractionDict[c]:
-                    contractionStrings.append("(" + info[1].name + ", curve " + str(curveList.index(info[0])) + ")")
+                    contractionStrings.append("(" + info[0].name + ", curve " + str(curveList.index(info[1])) + ")")
                 contractionLine += ", ".join(contractionStrings)
                 curveStrings.append("\n".join([vertexLine, edgeLine, legLine, idLine, contractionLine]))
             if curveStrings:
@@ -460,3 +519,168 @@ class TropicalModuliSpace(object):
                     currentCurve = curveStrings.pop()
                     f.write("\n" + curveEntryDelimiter + "\n")
                     f.write(currentCurve)
+
+    # The key that curves are sorted by when they are given ID numbers: the number of edges, and then the canonical key,
+    # which tells apart any two curves of a space. Sorting by it gives the same order in every process, unlike the
+    # order of self.curves.
+    @staticmethod
+    def getCurveOrderKey(curve):
+        return curve.numEdges, curve.canonicalKey
+
+    # Returns curveIds after giving an ID number to every curve that does not have one yet. New ID numbers are handed
+    # out in the order of getCurveOrderKey, like saveModuliSpaceToFile does.
+    def getCurveIds(self):
+        nextId = max(self.curveIds.values(), default=-1) + 1
+        for c in sorted(self.curves - set(self.curveIds), key=TropicalModuliSpace.getCurveOrderKey):
+            self.curveIds[c] = nextId
+            nextId += 1
+        return self.curveIds
+
+    # Finds the mesas with slopes between minSlope and maxSlope on every curve of the space (or on the curves for which
+    # curveFilter returns True), using a pool of the given number of processes (all cores by default, no pool if 1).
+    #
+    # The results for each curve are written to outputDirectory as soon as they are available, in the file
+    # "stratum-<curve ID>.npz" (see getCurveIds). Curves whose file already exists are skipped, so an interrupted run is
+    # resumed by calling this again with the same arguments. Each file also records the canonical key of its curve, and
+    # a ValueError is raised if an existing file belongs to a different curve than the one with its ID number. A file
+    # holds the arrays
+    #   vertexGenera (vertices), edgeEnds (edges x 2) and legRoots (legs): the curve, with vertices numbered from 0,
+    #   slopes (k x (edges + legs)) and vertexValues (k x vertices x edges): the functions found, where the value at a
+    #       vertex has one coefficient for the length of each edge,
+    #   isMesa (k): which of the functions are mesas,
+    #   canonicalKey (a string): the repr of the canonical key of the curve.
+    # Only mesas are stored unless allFunctions is set, in which case every function with slopes in the range is (as
+    # normalized by MesaEnumerator.iterFunctions).
+    #
+    # Returns a dictionary from curve ID numbers to the number of mesas on that curve.
+    def classifyMesas(self, outputDirectory, minSlope=-1, maxSlope=1, allFunctions=False, curveFilter=None,
+                      processes=None):
+        os.makedirs(outputDirectory, exist_ok=True)
+
+        # Refuse to mix the results of different runs in one directory
+        settings = {"g": self._g, "n": self._n, "minSlope": minSlope, "maxSlope": maxSlope,
+                    "allFunctions": allFunctions}
+        settingsFile = os.path.join(outputDirectory, "settings.json")
+        if os.path.exists(settingsFile):
+            with open(settingsFile, mode='r', encoding='utf-8') as f:
+                if json.load(f) != settings:
+                    raise ValueError("The output directory holds the results of a run with different settings.")
+        else:
+            with open(settingsFile, mode='w', encoding='utf-8') as f:
+                json.dump(settings, f)
+
+        curveIds = self.getCurveIds()
+        curves = sorted(self.curves, key=lambda x: curveIds[x])
+        if curveFilter is not None:
+            curves = [c for c in curves if curveFilter(c)]
+
+        def resultFile(curveId):
+            return os.path.join(outputDirectory, "stratum-" + str(curveId) + ".npz")
+
+        # The results that are already there should be for the same curves
+        keys = {curveIds[c]: repr(c.canonicalKey) for c in curves}
+        for c in curves:
+            if os.path.exists(resultFile(curveIds[c])):
+                with np.load(resultFile(curveIds[c])) as arrays:
+                    if "canonicalKey" not in arrays or str(arrays["canonicalKey"]) != keys[curveIds[c]]:
+                        raise ValueError("The output directory holds the results for a different curve with ID " +
+                                         str(curveIds[c]) + ".")
+
+        # Curves are sent to the workers as plain descriptions, so no monoid elements need to be pickled
+        tasks = [(curveIds[c], TropicalModuliSpace.getCurveDescription(c), minSlope, maxSlope, allFunctions)
+                 for c in curves if not os.path.exists(resultFile(curveIds[c]))]
+
+        def save(result):
+            curveId, arrays = result
+            arrays["canonicalKey"] = np.array(keys[curveId])
+            # Write to a temporary file first, so that an interrupted write never looks like a finished stratum
+            temporaryFile = resultFile(curveId) + ".partial"
+            with open(temporaryFile, mode='wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temporaryFile, resultFile(curveId))
+
+        if processes == 1:
+            for task in tasks:
+                save(_classifyStratum(task))
+        elif tasks:
+            with multiprocessing.Pool(processes) as pool:
+                for result in pool.imap_unordered(_classifyStratum, tasks):
+                    save(result)
+
+        numMesas = {}
+        for c in curves:
+            with np.load(resultFile(curveIds[c])) as arrays:
+                numMesas[curveIds[c]] = int(arrays["isMesa"].sum())
+        return numMesas
+
+    # Reads the results of classifyMesas back. Returns a dictionary from curve ID numbers to dictionaries of arrays.
+    @staticmethod
+    def loadMesaClassification(outputDirectory):
+        results = {}
+        for name in os.listdir(outputDirectory):
+            m = re.fullmatch("stratum-(\\d*)\\.npz", name)
+            if m:
+                with np.load(os.path.join(outputDirectory, name)) as arrays:
+                    results[int(m.group(1))] = dict(arrays)
+        return results
+
+    # Describes the combinatorial type of a curve with plain lists: the genera of its vertices, the endpoints of its
+    # edges, and the roots of its legs, with vertices referred to by position.
+    @staticmethod
+    def getCurveDescription(curve):
+        vertices = list(curve.vertices)
+        position = {v: i for i, v in enumerate(vertices)}
+        return ([v.genus for v in vertices],
+                [(position[e.vert1], position[e.vert2]) for e in curve.edges],
+                [position[nextLeg.root] for nextLeg in curve.legs])
+
+    # Inverse of getCurveDescription. The edges get independent lengths, generated in order by a new monoid. Returns
+    # the curve along with lists of its vertices, edges, and legs in the order of the description.
+    @staticmethod
+    def buildCurveFromDescription(description):
+        vertexGenera, edgeEnds, legRoots = description
+
+        c = BasicFamily("")
+        c.monoid = GeneratorRegistry().view()
+
+        vertices = [Vertex("v" + str(i), genus) for i, genus in enumerate(vertexGenera)]
+        edges = []
+        for v1, v2 in edgeEnds:
+            eName = "edge(v" + str(v1) + ", v" + str(v2) + ")"
+            gen = c.monoid.newgen(eName)
+            edges.append(Edge(eName, c.monoid.Element({gen: 1}), vertices[v1], vertices[v2]))
+        legs = [Leg("leg(v" + str(root) + ")", vertices[root]) for root in legRoots]
+
+        c.addEdges(edges)
+        c.addLegs(legs)
+        c.addVertices(vertices)
+        return c, vertices, edges, legs
+
+
+# Finds the functions for one curve of TropicalModuliSpace.classifyMesas. This runs in a worker process.
+def _classifyStratum(task):
+    curveId, description, minSlope, maxSlope, allFunctions = task
+    curve, vertices, edges, legs = TropicalModuliSpace.buildCurveFromDescription(description)
+    index = curve.index
+
+    enumerator = MesaEnumerator(curve, minSlope, maxSlope)
+    if allFunctions:
+        slopes, values = enumerator.enumerateFunctions()
+        isMesa = np.array([ArrayPiecewiseLinearFunction.isMesa(curve, s, v) for s, v in zip(slopes, values)],
+                          dtype=bool)
+    else:
+        slopes, values = enumerator.enumerateMesas()
+        isMesa = np.ones(len(slopes), dtype=bool)
+
+    # Reorder the arrays from the order of the index to the order of the description. The columns of the values are
+    # already in order, since the generators of the monoid were created in the order of the edges.
+    slopeOrder = [index.edgeIndex[e] for e in edges] + [index.numEdges + index.legIndex[nextLeg] for nextLeg in legs]
+    vertexOrder = [index.vertexIndex[v] for v in vertices]
+    vertexGenera, edgeEnds, legRoots = description
+
+    return curveId, {"vertexGenera": np.array(vertexGenera, dtype=np.int64),
+                     "edgeEnds": np.array(edgeEnds, dtype=np.int64).reshape(len(edgeEnds), 2),
+                     "legRoots": np.array(legRoots, dtype=np.int64),
+                     "slopes": slopes[:, slopeOrder],
+                     "vertexValues": values[:, vertexOrder],
+                     "isMesa": isMesa}
@@ -0,0 +1,124 @@
+from .Family import *
+import collections.abc
+
+
+# A moduli space (see TropicalModuliSpace) viewed as a Family, whose basic families are the curves of the space and
+# whose morphisms are the contractions of single edges recorded in its contractionDict.
+#
+# The morphisms are only built when they are asked for, from the contraction of the curve by the edge and an
+# isomorphism from that contraction to the curve of the space it was matched with (see BasicFamily.getIsomorphismTo),
+# and are then kept. Everything that only depends on which curves are connected, such as the ancestors, descendants,
+# levels, and maximal curves, is read off of contractionDict without building any morphisms. Since every morphism
+# contracts exactly one edge, none of them is a composition of the others, so the transitive reduction is the set of
+# all morphisms. Both are a ContractionMorphismSet, which builds the morphisms out of one curve at a time as it is
+# iterated over, and PLFFamily checks them curve by curve.
+#
+# The family is read only: basic families and morphisms can not be added or removed.
+class ModuliSpaceFamily(Family):
+    # space should be a TropicalModuliSpace whose contractionDict has been generated or loaded
+    def __init__(self, space):
+        super().__init__(set(), set())
+
+        if set(space.contractionDict) != space.curves:
+            raise ValueError("The contraction dictionary of the moduli space should be generated or loaded first.")
+
+        self.space = space
+        self._basicFamilies = set(space.curves)
+
+        # _contractions[(curve, e)] is the curve of the space that curve / {e} was matched with, and
+        # _incomingContractions[curve] lists the pairs (c, e) such that c / {e} was matched with curve
+        self._contractions = {}
+        self._incomingContractions = {curve: [] for curve in self._basicFamilies}
+        for curve, contractionPairs in space.contractionDict.items():
+            for e, match in contractionPairs:
+                self._contractions[(curve, e)] = match
+                self._incomingContractions[match].append((curve, e))
+
+        # Variables for caching the morphisms that have been built
+        self._contractionMorphismCache = {}
+        self._builtMorphisms = set()
+
+    # A read only set of all morphisms of the family, which only builds them as they are iterated over
+    @property
+    def morphisms(self):
+        return ContractionMorphismSet(self)
+
+    def addBasicFamily(self, basicFamily):
+        raise ValueError("The basic families of a ModuliSpaceFamily are the curves of its moduli space.")
+
+    def addMorphism(self, morphism):
+        raise ValueError("The morphisms of a ModuliSpaceFamily are the contractions of its moduli space.")
+
+    def removeMorphism(self, morphism):
+        raise ValueError("The morphisms of a ModuliSpaceFamily are the contractions of its moduli space.")
+
+    # Returns the morphism from curve to the curve of the space that its contraction by e was matched with, which
+    # collapses e to a vertex: BasicFamily.getContractionMorphism followed by an isomorphism onto the match, with the
+    # monoid morphism of BasicFamilyMorphism.fromCurveMorphism
+    def getContractionMorphism(self, curve, e):
+        key = (curve, e)
+        if key in self._contractionMorphismCache:
+            return self._contractionMorphismCache[key]
+
+        match = self._contractions[key]
+        contractionMorphism = curve.getContractionMorphism(e)
+        isomorphism = contractionMorphism.codomain.getIsomorphismTo(match)
+        assert isomorphism is not None, "The contraction of the curve should be isomorphic to its match."
+        curveMorphismDict = {x: isomorphism[image] for x, image in contractionMorphism.curveMorphismDict.items()}
+
+        morphism = BasicFamilyMorphism.fromCurveMorphism(curve, match, curveMorphismDict, validate=False)
+        self._contractionMorphismCache[key] = morphism
+        self._builtMorphisms.add(morphism)
+        return morphism
+
+    def getIncomingMorphisms(self, basicFamily):
+        return frozenset(self.getContractionMorphism(curve, e)
+                         for curve, e in self._incomingContractions[basicFamily])
+
+    def getOutgoingMorphisms(self, basicFamily):
+        return frozenset(self.getContractionMorphism(basicFamily, e)
+                         for e, _ in self.space.contractionDict[basicFamily])
+
+    def getAncestors(self, basicFamily):
+        return {curve for curve, _ in self._incomingContractions[basicFamily]}
+
+    def getDescendants(self, basicFamily):
+        return {match for _, match in self.space.contractionDict[basicFamily]}
+
+    # A contraction has fewer edges than the curve, so no morphism goes from a curve to itself
+    def isMaximal(self, basicFamily):
+        return not self._incomingContractions[basicFamily]
+
+    def _getProperCodomains(self, basicFamily):
+        return [match for _, match in self.space.contractionDict[basicFamily]]
+
+    def getTransitiveReduction(self):
+        return ContractionMorphismSet(self)
+
+    def getReducedOutgoingMorphisms(self, basicFamily):
+        return self.getOutgoingMorphisms(basicFamily)
+
+
+# The morphisms of a ModuliSpaceFamily as a read only set. Its size and membership are known without building any
+# morphism, and iterating over it builds the morphisms out of one curve of the space at a time, in topological order.
+class ContractionMorphismSet(collections.abc.Set):
+    def __init__(self, family):
+        self.family = family
+
+    def __len__(self):
+        return len(self.family._contractions)
+
+    # Only morphisms that have been built can have been handed out, so the others need not be built to be ruled out
+    def __contains__(self, morphism):
+        return morphism in self.family._builtMorphisms
+
+    # Set operations such as & and | return frozensets
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+    def __iter__(self):
+        family = self.family
+        for curve in family.topologicalOrder:
+            for e, _ in family.space.contractionDict[curve]:
+                yield family.getContractionMorphism(curve, e)
@@ -1,5 +1,8 @@
-from ..basic_families.PiecewiseLinearFunction import *
+from ..basic_families.ArrayPiecewiseLinearFunction import *
 from .Family import *
+import multiprocessing
+import os
+import time
 
 
 class PLFFamily(object):
@@ -26,18 +29,192 @@ class PLFFamily(object):
         if not self.isWellDefined():
             raise ValueError("The given functions are not compatible with each other.")
 
+    # Returns the PLFFamily on domain whose functions on the basic families in functions are given, and whose function
+    # on any other basic family is the pushforward of the function on the domain of one of the morphisms into it. The
+    # functions are pushed forward in topological order (see Family.computeInOrder), level by level, so every maximal
+    # basic family needs a function, and the morphisms should be onto, like contractions. Raises a ValueError if the
+    # resulting functions are not compatible.
+    #
+    # With processes other than 1, the pushforwards of each level are computed from plain arrays in a pool of that many
+    # processes (None uses one per CPU; see ArrayPiecewiseLinearFunction.getPushforwardPayload). Functions whose slopes
+    # or values can not be stored in arrays are pushed forward in this process.
+    @staticmethod
+    def fromMaximalFunctions(domain, functions, processes=1):
+        def pushForward(basicFamily, inputs):
+            if basicFamily in functions:
+                return functions[basicFamily]
+            if not inputs:
+                raise ValueError("functions should assign a function to every maximal basic family.")
+            morphism, function = inputs[0]
+            try:
+                arrayFunction = function.arrayFunction
+            except ValueError:
+                return function.getPushforward(morphism)
+
+            def finish(arrays):
+                return arrayFunction.getPushforwardFromArrays(morphism, arrays).toFunction()
+
+            return WorkerTask(ArrayPiecewiseLinearFunction.getPushforwardArraysFromPayload,
+                              arrayFunction.getPushforwardPayload(morphism), finish)
+
+        return PLFFamily(domain, domain.computeInOrder(pushForward, processes=processes))
+
     def morphismPreservesFunctions(self, morphism):
 
-        assert morphism in self.domain.morphisms, "The given morphism should belong to the domain family."
+        assert morphism.domain in self.domain.basicFamilies and \
+            morphism in self.domain.getOutgoingMorphisms(morphism.domain), \
+            "The given morphism should belong to the domain family."
 
-        domainPLF = self.functions[morphism.domain]
-        pushforwardPLF = domainPLF.getPushforward(morphism)
-        codomainPLF = self.functions[morphism.codomain]
+        return self._morphismsPreserveFunctions(morphism.domain, [morphism])[0]
 
-        return pushforwardPLF == codomainPLF
+    # Pushes the function on each basic family forward along all of the morphisms out of it at once. Only the morphisms
+    # in the transitive reduction of the family are checked, since the others are compositions of those. With processes
+    # other than 1, the check is done by checkWellDefined instead.
+    def isWellDefined(self, processes=1):
+        if processes != 1:
+            return self.checkWellDefined(processes).isWellDefined
 
-    def isWellDefined(self):
-        for morphism in self.domain.morphisms:
-            if not self.morphismPreservesFunctions(morphism):
+        for basicFamily in self.domain.basicFamilies:
+            morphisms = list(self.domain.getReducedOutgoingMorphisms(basicFamily))
+            if morphisms and not all(self._morphismsPreserveFunctions(basicFamily, morphisms)):
                 return False
-        return True
\ No newline at end of file
+        return True
+
+    # Checks whether the pushforward of the function on basicFamily along each of the given morphisms out of it agrees
+    # with the function on the codomain, on the image of the morphism. Returns a list of booleans.
+    def _morphismsPreserveFunctions(self, basicFamily, morphisms):
+        domainPLF = self.functions[basicFamily]
+        codomainPLFs = [self.functions[morphism.codomain] for morphism in morphisms]
+
+        try:
+            return domainPLF.arrayFunction.pushesForwardTo(morphisms, [plf.arrayFunction for plf in codomainPLFs])
+        except ValueError:
+            # Some slope or value can not be stored in an array, so compare the slopes and values one at a time
+            return [PLFFamily._preservesFunctionValues(morphism, domainPLF, codomainPLF)
+                    for morphism, codomainPLF in zip(morphisms, codomainPLFs)]
+
+    # Checks, without arrays, whether every vertex value of domainPLF is mapped to the value of codomainPLF at the image
+    # of the vertex, and every edge or leg that is not collapsed has the slope of its image. Slopes of edges are read
+    # from their first vertex, so they change sign when the morphism reverses an edge.
+    @staticmethod
+    def _preservesFunctionValues(morphism, domainPLF, codomainPLF):
+        for v in morphism.domain.vertices:
+            if not morphism(domainPLF.functionValues[v]) == codomainPLF.functionValues[morphism(v)]:
+                return False
+        for e in morphism.domain.edges:
+            image = morphism(e)
+            if image in morphism.codomain.edges:
+                sign = 1 if morphism(e.vert1) == image.vert1 else -1
+                if sign * domainPLF.functionValues[e] != codomainPLF.functionValues[image]:
+                    return False
+        for nextLeg in morphism.domain.legs:
+            if domainPLF.functionValues[nextLeg] != codomainPLF.functionValues[morphism(nextLeg)]:
+                return False
+        return True
+
+    # Checks the morphisms of the transitive reduction in a pool of processes (processes=None uses one per CPU), and
+    # returns a WellDefinednessReport. The morphisms are sent to the workers in chunks of chunkSize, as plain arrays
+    # (see ArrayPiecewiseLinearFunction), and the remaining work is cancelled as soon as one morphism fails. The
+    # morphisms are taken one basic family at a time (see Family.getReducedOutgoingMorphisms), while the workers check
+    # the chunks that are ready. Functions whose slopes or values can not be stored in arrays are checked in this
+    # process instead.
+    def checkWellDefined(self, processes=None, chunkSize=64):
+        report = WellDefinednessReport()
+
+        try:
+            for function in self.functions.values():
+                function.arrayFunction
+        except ValueError:
+            for basicFamily in self.domain.basicFamilies:
+                for morphism in self.domain.getReducedOutgoingMorphisms(basicFamily):
+                    start = time.perf_counter()
+                    preserved = self._morphismsPreserveFunctions(basicFamily, [morphism])[0]
+                    report.addWork(os.getpid(), 1, time.perf_counter() - start)
+                    if not preserved:
+                        report.failedMorphism = morphism
+                        return report
+            return report
+
+        # morphisms lists the morphisms in the order in which they were handed to the workers
+        morphisms = []
+        tasks = self._getWellDefinednessTasks(morphisms, chunkSize)
+        with multiprocessing.Pool(processes) as pool:
+            for pid, numChecked, seconds, failedPosition in pool.imap_unordered(_checkMorphisms, tasks):
+                report.addWork(pid, numChecked, seconds)
+                if failedPosition is not None:
+                    report.failedMorphism = morphisms[failedPosition]
+                    # Leaving the block terminates the pool, which cancels the chunks that have not been checked yet
+                    break
+
+        return report
+
+    # Generates chunks of plain arrays for _checkMorphisms from the morphisms of the transitive reduction, one basic
+    # family at a time, and appends each morphism to morphisms as it is chunked, so that its position in morphisms is
+    # the one sent to the workers. Every function should be stored in arrays. Morphisms out of the same basic family are
+    # chunked together, so that the arrays of the function on it are sent once per chunk, and the relations of each
+    # codomain monoid are turned into a RelationArray once.
+    def _getWellDefinednessTasks(self, morphisms, chunkSize):
+        codomainArrays = {}
+        for domain in self.domain.basicFamilies:
+            domainFunction = self.functions[domain].arrayFunction
+            entries = []
+            for morphism in self.domain.getReducedOutgoingMorphisms(domain):
+                position = len(morphisms)
+                morphisms.append(morphism)
+                codomain = morphism.codomain
+                if codomain not in codomainArrays:
+                    codomainFunction = self.functions[codomain].arrayFunction
+                    codomainIndex = codomain.index
+                    codomainArrays[codomain] = ((codomainIndex.numVertices, codomainIndex.numEdges,
+                                                 codomainIndex.numLegs),
+                                                codomainFunction.slopes, codomainFunction.vertexValues,
+                                                codomain.monoid.relation_array(codomainIndex.gens))
+                matrix, denom = morphism.valueMatrix
+                entries.append((position, morphism.indexMaps, matrix, denom) + codomainArrays[codomain])
+
+            for i in range(0, len(entries), chunkSize):
+                yield domainFunction.slopes, domainFunction.vertexValues, entries[i:i + chunkSize]
+
+
+# The result of PLFFamily.checkWellDefined: whether the functions are compatible, the first morphism that was found to
+# not preserve them (or None), and how many morphisms each worker process checked in how many seconds
+class WellDefinednessReport(object):
+    def __init__(self):
+        self.failedMorphism = None
+        self.workers = {}
+
+    @property
+    def isWellDefined(self):
+        return self.failedMorphism is None
+
+    def addWork(self, pid, numChecked, seconds):
+        checked, elapsed = self.workers.get(pid, (0, 0.0))
+        self.workers[pid] = (checked + numChecked, elapsed + seconds)
+
+    # The number of morphisms that each worker checked per second, as a dictionary from process IDs
+    @property
+    def throughput(self):
+        return {pid: (checked / elapsed if elapsed > 0 else float("inf"))
+                for pid, (checked, elapsed) in self.workers.items()}
+
+
+# Checks one chunk of morphisms out of the same basic family for PLFFamily.checkWellDefined, stopping at the first one
+# that does not preserve the functions. This runs in a worker process. Returns the process ID, the number of morphisms
+# checked, the time taken, and the position of the failed morphism (or None).
+def _checkMorphisms(task):
+    start = time.perf_counter()
+    slopes, vertexValues, entries = task
+    numChecked = 0
+    failedPosition = None
+    for position, indexMaps, matrix, denom, codomainSizes, codomainSlopes, codomainValues, relations in entries:
+        numChecked += 1
+
+        # The relations stand in for the codomain monoid, which is only needed to compare values
+        payload = (slopes, vertexValues, indexMaps, matrix, denom, codomainSizes, relations)
+        arrays = ArrayPiecewiseLinearFunction.getPushforwardArraysFromPayload(payload)
+        if arrays is None or not ArrayPiecewiseLinearFunction._agreesOnImage(arrays, codomainSlopes, codomainValues,
+                                                                             relations, None):
+            failedPosition = position
+            break
+
+    return os.getpid(), numChecked, time.perf_counter() - start, failedPosition
@@ -1,2 +1,3 @@
 from .Family import *
 from .ModuliSpace import *
+from .ModuliSpaceFamily import *
@@ -0,0 +1,15 @@
+import os
+import sys
+from .ModuliSpace import *
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python3 -m Tropical2020.general_families.classifyModuliSpaceMesas g n outputDirectory")
+    else:
+        g = int(sys.argv[1])
+        n = int(sys.argv[2])
+        m = TropicalModuliSpace(g, n)
+        m.loadModuliSpaceFromFile(os.path.join(os.path.dirname(__file__), "SavedModuliSpaces",
+                                               "M-" + str(g) + "-" + str(n) + ".txt"))
+        numMesas = m.classifyMesas(sys.argv[3])
+        print("Found", sum(numMesas.values()), "mesas on", len(numMesas), "strata")
@@ -30,3 +30,55 @@ P.compute_dual()
 
 
 w = y - x
+
+
+# Batched positivity test against the dual cone
+elements = [ x, y, z, y - x, x - y, x + y, 2 * z - x, P.zero(), (y - x) / 2 ]
+mask = P.isgeqzero_many( elements )
+assert list( mask ) == [ P.isgeqzero( e ) for e in elements ]
+assert list( mask ) == [ True, True, True, False, False, True, True, True, False ]
+
+A, d = P.to_array( elements )
+for e, f in zip( elements, P.from_array( A, d ) ):
+	assert { k : c for k, c in e.coeffs.items() if c } == f.coeffs and e.denom == f.denom
+
+
+# Homomorphisms are stored as integer matrices
+Q = Monoid()
+Q.addgen( "a" )
+Q.addgen( "b" )
+a = Q.Element( { "a" : 1 } )
+b = Q.Element( { "b" : 1 } )
+
+F = MonoidHomomorphism( P, Q, { 1 : 2 * a, 2 : 2 * b, 3 : a + b } )
+assert F.validated
+assert F( x + y ) == 2 * a + 2 * b
+assert F( z ) == a + b
+assert F.apply_many( [ x, y, z, P.zero() ] ) == [ 2 * a, 2 * b, a + b, Q.zero() ]
+
+G = MonoidHomomorphism( Q, Q, np.array( [ [ 1, 1 ], [ 0, 0 ] ] ) )
+assert G( a ) == a and G( b ) == a
+H = G.compose( F )
+assert H.validated
+assert [ H( e ) for e in [ x, y, z ] ] == [ 2 * a, 2 * a, 2 * a ]
+assert H.matrix[ 3 ] == 2 * a
+
+# This is not compatible with the relation x + y = 2z, but it is only noticed once validated
+bad = MonoidHomomorphism( P, Q, { 1 : a, 2 : a, 3 : b }, validate=False )
+assert not bad.validated
+try:
+	bad.validate()
+	assert False
+except AssertionError as error:
+	assert str( error ) == "Not a well-defined function!"
+
+
+# Zero testing of many elements modulo the relations
+A, d = P.to_array( [ x + y - 2 * z, x - y, P.zero(), 2 * x + 2 * y - 4 * z ] )
+assert list( P.iszero_many( A ) ) == [ True, False, True, True ]
+
+# The relations as plain arrays give the same answers, and survive pickling
+import pickle
+R = pickle.loads( pickle.dumps( P.relation_array() ) )
+assert list( R.iszero_many( A ) ) == [ True, False, True, True ]
+assert ( R.reduce_array( A ) == P.reduce_array( A ) ).all()
@@ -1,6 +1,18 @@
 from ..basic_families.BasicFamily import *
 from ..basic_families.PiecewiseLinearFunction import *
+from ..basic_families.ArrayPiecewiseLinearFunction import *
+from ..basic_families.MesaEnumerator import *
+from ..basic_families.MorphismEnumerator import *
 from ..general_families.ModuliSpace import *
+from ..general_families.PLFFamily import *
+import ast
+import contextlib
+import io
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
 import time
 
 
@@ -40,6 +52,16 @@ class CurveTests:
     @staticmethod
     def verifyIsomorphism(curve1, curve2, isIsomorphic=True):
         assert curve1.isIsomorphicTo(curve2) == isIsomorphic
+        assert (curve1.canonicalKey == curve2.canonicalKey) == isIsomorphic
+
+        # The isomorphism found from the canonical forms is a bijection that preserves the structure of the curves
+        isomorphism = curve1.getIsomorphismTo(curve2)
+        assert (isomorphism is not None) == isIsomorphic
+        if isomorphism is not None:
+            assert set(isomorphism.values()) == curve2.vertices | curve2.edges | curve2.legs
+            assert all(isomorphism[v].genus == v.genus for v in curve1.vertices)
+            assert all({isomorphism[v] for v in e.vertices} == isomorphism[e].vertices for e in curve1.edges)
+            assert all(isomorphism[leg.root] == isomorphism[leg].root for leg in curve1.legs)
 
 
 class SPLFTests:
@@ -57,6 +79,127 @@ class SPLFTests:
             assert (func + func).functionValues[vert] == func.functionValues[vert] + func.functionValues[vert]
             assert (func - func).functionValues[vert] == func.functionValues[vert] - func.functionValues[vert]
 
+        combination = PiecewiseLinearFunction.linearCombination([3, -1], [func, func])
+        total = func + func
+        total += func
+        total -= func
+        assert total.isValidated
+        for vert in func.domain.vertices:
+            assert combination.functionValues[vert] == total.functionValues[vert] == \
+                   func.functionValues[vert] + func.functionValues[vert]
+
+
+    @staticmethod
+    def testArrayFunction(func):
+        arrayFunc = ArrayPiecewiseLinearFunction.fromFunction(func)
+        for v in func.domain.vertices:
+            assert arrayFunc.valueAt(v) == func.functionValues[v]
+        assert arrayFunc == ArrayPiecewiseLinearFunction.fromFunction(arrayFunc.toFunction())
+        assert arrayFunc + arrayFunc == ArrayPiecewiseLinearFunction.fromFunction(func + func)
+        assert arrayFunc - arrayFunc == ArrayPiecewiseLinearFunction.fromFunction(func - func)
+        assert arrayFunc + arrayFunc == 2 * arrayFunc
+        assert ArrayPiecewiseLinearFunction.linearCombination([3, -1], [arrayFunc, arrayFunc]) == 2 * arrayFunc
+        total = ArrayPiecewiseLinearFunction(func.domain, arrayFunc.slopes, validate_=False)
+        total += arrayFunc
+        assert not total.isValidated and total.validate().isValidated
+        total -= arrayFunc
+        assert total == ArrayPiecewiseLinearFunction(func.domain, arrayFunc.slopes)
+        assert arrayFunc.getSpecialSupport() == func.getSpecialSupport()
+        assert arrayFunc.mesaTest == func.mesaTest
+
+    # Compares the divisor of a function with summing the outgoing slopes at each vertex one endpoint at a time
+    @staticmethod
+    def verifyDivisor(func):
+        expected = {}
+        for v in func.domain.vertices:
+            expected[v] = sum(func.functionValues[x] if n == 1 else -func.functionValues[x]
+                              for x, n in func.domain.getEndpointsOfEdges(v))
+        assert func.divisor == expected
+
+        # The batch forms agree with the single ones
+        arrayFunc = ArrayPiecewiseLinearFunction.fromFunction(func)
+        assert np.array_equal(arrayFunc.divisor, [expected[v] for v in func.domain.index.vertices])
+        divisors = ArrayPiecewiseLinearFunction.getDivisors([arrayFunc, -arrayFunc, 2 * arrayFunc])
+        assert np.array_equal(divisors, [arrayFunc.divisor, -arrayFunc.divisor, 2 * arrayFunc.divisor])
+        assert PiecewiseLinearFunction.getDivisors([func, func - func]) == [expected, {v: 0 for v in expected}]
+
+    # Compares the contractions of a function with contracting the domain and checking the slopes directly
+    @staticmethod
+    def verifyContractions(func):
+        contractions = func.functionContractions()
+        for e in func.domain.edges:
+            contractedCurve, copyInfo = func.domain.getContraction(e, True)
+            original = {copyInfo[x]: x for x in func.domain.edges}
+            slopes = [func.functionValues[original[x]] for x in contractedCurve.index.edges]
+            assert (e in contractions) == contractedCurve.index.slopesAreWellDefined(slopes)
+            if e in contractions:
+                assert contractions[e].domain.isIsomorphicTo(contractedCurve)
+                ArrayPiecewiseLinearFunction.fromFunction(contractions[e]).assertIsWellDefined()
+
+        # Contracting faces one edge at a time does not depend on the order of the edges
+        arrayFunc = ArrayPiecewiseLinearFunction.fromFunction(func)
+        faces = arrayFunc.getFaceContractions()
+        assert len(faces) == 2 ** func.domain.numEdges
+        for face, contraction in faces.items():
+            reordered = arrayFunc.getContraction(sorted(face, key=lambda x: x.name, reverse=True))
+            assert reordered.isWellDefined == contraction.isWellDefined
+            if contraction.isWellDefined:
+                assert np.array_equal(reordered.vertexValues, contraction.vertexValues)
+                assert contraction.toFunction().domain.genus == func.domain.genus
+            else:
+                assert not any(faces[larger].isWellDefined for larger in faces if face < larger)
+
+    # Compares the mesas found by MesaEnumerator with a brute force search over all slopes and all vertices where the
+    # function could vanish
+    @staticmethod
+    def verifyMesaEnumeration(curve, minSlope=-1, maxSlope=1):
+        index = curve.index
+        expected = set()
+        for slopes in itertools.product(range(minSlope, maxSlope + 1), repeat=index.numEdges + index.numLegs):
+            for v in index.vertices:
+                functionValues = dict(zip(index.edges + index.legs, slopes))
+                functionValues[v] = curve.monoid.zero()
+                try:
+                    func = PiecewiseLinearFunction(curve, functionValues)
+                except AssertionError:
+                    continue
+                # mesaTest explains its failures on stdout
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if func.mesaTest:
+                        arrayFunc = ArrayPiecewiseLinearFunction.fromFunction(func)
+                        expected.add((arrayFunc.slopes.tobytes(), arrayFunc.vertexValues.tobytes()))
+
+        slopes, values = MesaEnumerator(curve, minSlope, maxSlope).enumerateMesas()
+        found = {(s.tobytes(), v.tobytes()) for s, v in zip(slopes, values)}
+        assert len(found) == len(slopes)
+        assert found == expected
+
+    # Compares the canonical keys of all functions with slopes in the range against the smallest description of each
+    # function over every order of the vertices, and checks that they do not depend on the order of the index
+    @staticmethod
+    def verifyCanonicalKeys(curve, minSlope=-1, maxSlope=1):
+        slopes, values = MesaEnumerator(curve, minSlope, maxSlope).enumerateFunctions()
+        keys = set()
+        for s, v in zip(slopes, values):
+            func = ArrayPiecewiseLinearFunction(curve, s, v)
+            form = CanonicalForm(func.canonicalKey[0], [])
+            form.arcs = [{j: labels for j, labels in arcs} for arcs in func.canonicalKey[1]]
+            orders = itertools.permutations(range(curve.numVertices))
+            bruteForce = min(form._describe(list(order))[0] for order in orders)
+            assert bruteForce == func.canonicalKey
+            assert func.toFunction().canonicalKey == func.canonicalKey
+            keys.add(func.canonicalKey)
+
+        # Rebuilding the index changes the order of the vertices, but not the keys
+        copiedCurve, copyInfo = curve.getFullyShallowCopy(True)
+        for s, v in zip(slopes, values):
+            func = ArrayPiecewiseLinearFunction(curve, s, v).toFunction()
+            copiedValues = {copyInfo[x]: func.functionValues[x] for x in curve.edges | curve.legs}
+            for x in curve.vertices:
+                copiedValues[copyInfo[x]] = copiedCurve.monoid.Element(func.functionValues[x].coeffs)
+            assert PiecewiseLinearFunction(copiedCurve, copiedValues).canonicalKey in keys
+        return keys
+
 
 class TreeTests:
     @staticmethod
@@ -106,6 +249,160 @@ class ModuliSpaceTests:
         m22.generateSpaceDFS()
         assert len(m22.curves) == 60
 
+    @staticmethod
+    def verifySharedRegistry(space):
+        # Every generator is an id from the registry of the space, and every edge has its own generator
+        seenGens = set()
+        for curve in space.curves:
+            assert curve.monoid.registry is space.registry
+            assert len(set(curve.monoid.gens)) == len(curve.monoid.gens) == curve.numEdges
+            seenGens.update(curve.monoid.gens)
+            for e in curve.edges:
+                assert set(e.length.coeffs.keys()) <= set(curve.monoid.gens)
+        # The generators of curves that were thrown away as duplicates are given back, so every id that is not
+        # released belongs to some curve
+        assert seenGens == set(range(len(space.registry))) - set(space.registry.released)
+
+        # The monoids are views that share one Element class, and stay free
+        assert all(curve.monoid.Element is space.registry.base.Element for curve in space.curves)
+        view = space.registry.view()
+        try:
+            view.addrel(view.zero())
+            assert False
+        except ValueError:
+            pass
+
+    @staticmethod
+    def verifyFamily(space):
+        family = space.asFamily()
+        assert family.basicFamilies == space.curves
+
+        # The shape of the family is known without building any morphism
+        assert set(family.levels[0]) == set(family.maximalCurvesIter())
+        reduction = family.getTransitiveReduction()
+        assert len(reduction) == len(family.morphisms) == sum(curve.numEdges for curve in space.curves)
+        assert not family._contractionMorphismCache
+
+        # Iterating over the morphisms builds them as they are reached
+        first = next(iter(reduction))
+        assert first in reduction and first in family.morphisms
+        assert len(family._contractionMorphismCache) == 1
+        assert first.codomain.getContractionMorphism(next(iter(first.codomain.edges))) not in reduction
+
+        numMorphisms = 0
+        for curve in family.topologicalOrder:
+            outgoing = family.getOutgoingMorphisms(curve)
+            assert {morphism.codomain for morphism in outgoing} == family.getDescendants(curve)
+            assert all(family.getLevel(morphism.codomain) > family.getLevel(curve) for morphism in outgoing)
+            for morphism in outgoing:
+                assert morphism.validate().isValidated and morphism.monoidMorphism.validate() is None
+                assert morphism.domain is curve and morphism in family.getIncomingMorphisms(morphism.codomain)
+            numMorphisms += len(outgoing)
+        assert family.getTransitiveReduction() == family.morphisms and len(family.morphisms) == numMorphisms
+        assert numMorphisms == sum(curve.numEdges for curve in space.curves)
+        assert family.morphisms & family.getOutgoingMorphisms(first.domain) == family.getOutgoingMorphisms(first.domain)
+
+        # The zero functions are compatible, but a slope on a leg that appears after a contraction is not
+        zero = {curve: PiecewiseLinearFunction(curve, {x: 0 for x in curve.edges | curve.legs})
+                for curve in space.curves}
+        zeroFamily = PLFFamily(family, zero)
+        assert zeroFamily.isWellDefined() and zeroFamily.checkWellDefined(processes=2, chunkSize=2).isWellDefined
+        maximalZero = {curve: zero[curve] for curve in family.maximalCurvesIter()}
+        assert PLFFamily.fromMaximalFunctions(family, maximalZero).functions.keys() == zero.keys()
+        assert PLFFamily.fromMaximalFunctions(family, maximalZero, processes=2).functions == \
+            PLFFamily.fromMaximalFunctions(family, maximalZero).functions
+        curve = next(c for c in family.basicFamilies if not family.isMaximal(c) and c.legs)
+        functions = dict(zero)
+        functions[curve] = PiecewiseLinearFunction(curve, {**{e: 0 for e in curve.edges}, **{l: 1 for l in curve.legs}})
+        try:
+            PLFFamily(family, functions)
+            assert False, "Incompatible functions should be rejected."
+        except ValueError:
+            pass
+        zeroFamily.functions = functions
+        failedMorphism = zeroFamily.checkWellDefined(processes=2, chunkSize=2).failedMorphism
+        assert curve in (failedMorphism.domain, failedMorphism.codomain)
+
+    # Enumerates the contraction morphisms between every pair of curves of the space, which must include the
+    # contractions of single edges
+    @staticmethod
+    def verifyMorphismEnumeration(space):
+        family = space.asFamily()
+        for domain in space.curves:
+            for codomain in space.curves:
+                enumerator = MorphismEnumerator(domain, codomain)
+                morphisms = enumerator.enumerateMorphisms()
+                assert len(morphisms) == enumerator.countMorphisms()
+                assert all(morphism.validate().isValidated for morphism in morphisms)
+
+                keys = {morphism.comparisonKey for morphism in morphisms}
+                assert len(keys) == len(morphisms)
+                for contraction in family.getOutgoingMorphisms(domain):
+                    if contraction.codomain is codomain:
+                        assert contraction.comparisonKey in keys
+                if domain.numEdges == codomain.numEdges:
+                    assert bool(morphisms) == (domain is codomain)
+
+    @staticmethod
+    def verifyMesaClassification(space):
+        expected = {space.getCurveIds()[c]: MesaEnumerator(c).countMesas() for c in space.curves}
+
+        with tempfile.TemporaryDirectory() as directory:
+            assert space.classifyMesas(directory, processes=2) == expected
+
+            # Resuming only recomputes the missing strata
+            os.remove(os.path.join(directory, "stratum-0.npz"))
+            modified = os.path.getmtime(os.path.join(directory, "stratum-1.npz"))
+            assert space.classifyMesas(directory, processes=2) == expected
+            assert os.path.getmtime(os.path.join(directory, "stratum-1.npz")) == modified
+
+            try:
+                space.classifyMesas(directory, maxSlope=2)
+                assert False, "Settings of different runs should not be mixed."
+            except ValueError:
+                pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            assert space.classifyMesas(directory, allFunctions=True, processes=1) == expected
+            results = TropicalModuliSpace.loadMesaClassification(directory)
+            for curveId, arrays in results.items():
+                numEdges = len(arrays["edgeEnds"])
+                assert arrays["slopes"].shape == (len(arrays["isMesa"]), numEdges + len(arrays["legRoots"]))
+                assert arrays["vertexValues"].shape == (len(arrays["isMesa"]), len(arrays["vertexGenera"]), numEdges)
+
+    # Starts a classification of M-g-n here, and resumes it in a fresh process that generates the space again. The
+    # curves get the same ID numbers in both processes, so the results fit together.
+    @staticmethod
+    def verifyResumedMesaClassification(g, n):
+        space = TropicalModuliSpace(g, n)
+        space.generateSpaceDFS()
+        curveIds = space.getCurveIds()
+        expected = {curveIds[c]: MesaEnumerator(c).countMesas() for c in space.curves}
+
+        with tempfile.TemporaryDirectory() as directory:
+            space.classifyMesas(directory, curveFilter=lambda c: curveIds[c] % 2 == 0, processes=1)
+
+            script = ("from Tropical2020.general_families.ModuliSpace import TropicalModuliSpace\n"
+                      "space = TropicalModuliSpace(" + str(g) + ", " + str(n) + ")\n"
+                      "space.generateSpaceDFS()\n"
+                      "print(space.classifyMesas(" + repr(directory) + ", processes=1))\n")
+            root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            output = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True,
+                                    check=True).stdout
+            assert ast.literal_eval(output.splitlines()[-1]) == expected
+
+            keys = {curveIds[c]: repr(c.canonicalKey) for c in space.curves}
+            for curveId, arrays in TropicalModuliSpace.loadMesaClassification(directory).items():
+                assert str(arrays["canonicalKey"]) == keys[curveId]
+
+            # Results filed under the wrong ID number are caught rather than skipped
+            os.replace(os.path.join(directory, "stratum-0.npz"), os.path.join(directory, "stratum-1.npz"))
+            try:
+                space.classifyMesas(directory, processes=1)
+                assert False, "Results of a different curve should not be used."
+            except ValueError:
+                pass
+
 
 
 
@@ -206,6 +503,54 @@ f = PiecewiseLinearFunction(C, nonMesaDict)
 #    contractions[e].printSelf()
 
 SPLFTests.verifyMesa(f, isMesa=False)
+
+# Check several slope assignments at once. The loop e1, e2, e3 goes v1 -> v2 -> v3 -> v1 and e4 is a self loop.
+index = C.index
+slopeBatch = np.zeros((4, index.numEdges), dtype=np.int64)
+slopeBatch[1, index.edgeIndex[e4]] = 1
+for e, slope in [(e1, 1), (e2, 1), (e3, 2)]:
+    slopeBatch[2, index.edgeIndex[e]] = slope
+    slopeBatch[3, index.edgeIndex[e]] = 1
+assert list(index.slopesAreWellDefined(slopeBatch)) == [True, False, True, False]
+assert index.cycleMatrix.shape == (2, 4)
+try:
+    PiecewiseLinearFunction(C, {e1: 1, e2: 1, e3: 1, e4: 0, l: 0})
+    assert False
+except AssertionError as error:
+    assert str(error) == "The slopes do not integrate to zero around every loop."
+unchecked = PiecewiseLinearFunction(C, {e1: 1, e2: 1, e3: 1, e4: 0, l: 0}, validate_=False)
+assert not unchecked.isValidated and not (unchecked + f).isValidated
+try:
+    unchecked.validate()
+    assert False
+except AssertionError as error:
+    assert str(error) == "The slopes do not integrate to zero around every loop."
+
+# Slopes that are not integers are rejected rather than rounded
+try:
+    index.slopesAreWellDefined(slopeBatch[2] / 2)
+    assert False
+except ValueError as error:
+    assert str(error) == "Slopes must be integers."
+
+# Rational edge lengths: e1 and e2 form a loop of lengths a / 2 and a, so slopes 2 and 1 integrate to zero around it
+rationalMonoid = Monoid()
+rationalMonoid.addgen("a")
+u1 = Vertex("u1", 0)
+u2 = Vertex("u2", 0)
+halfEdge = Edge("e1", rationalMonoid.Element({"a": 1}, 2), u1, u2)
+wholeEdge = Edge("e2", rationalMonoid.Element({"a": 1}), u1, u2)
+R = BasicFamily("Rational lengths")
+R.addEdges({halfEdge, wholeEdge})
+R.monoid = rationalMonoid
+assert R.index.scaledLengths[1] == 2
+rational = PiecewiseLinearFunction(R, {halfEdge: 2, wholeEdge: 1, u1: rationalMonoid.zero()})
+assert rational.functionValues[u2] == rationalMonoid.Element({"a": 1})
+try:
+    PiecewiseLinearFunction(R, {halfEdge: 1, wholeEdge: 1})
+    assert False
+except AssertionError as error:
+    assert str(error) == "The slopes do not integrate to zero around every loop."
 try:
     SPLFTests.verifySpecialSupport(f, [{e1, e3, e4}])
 except:
@@ -221,6 +566,8 @@ except:
 
 
 SPLFTests.testSelfArithmetic(f)
+SPLFTests.verifyContractions(f)
+SPLFTests.verifyDivisor(f)
 
 CurveTests.verifyAndTestEndpointsOfEdges(C, v1, {(e1, 1), (e3, 1), (e4, 1), (e4, 2), (l, 1)})
 CurveTests.verifyAndTestEndpointsOfEdges(C, v2, {(e1, 2), (e2, 1)})
@@ -326,6 +673,15 @@ C.addLeg(l)
 CurveTests.testCore(C)
 CurveTests.verifyStructure(C.core, {v1, v3}, {e3, e4}, set())
 
+# A view of the whole curve answers the same questions without copying it
+view = BasicFamilyView(C, edges_=C.edges, legs_=C.legs)
+CurveTests.verifyStructure(view, C.vertices, C.edges, C.legs)
+CurveTests.verifyGenus(view, C.genus)
+CurveTests.verifyDegree(view, v1, C.degree(v1))
+CurveTests.testCore(view)
+CurveTests.verifyStructure(view.core, {v1, v3}, {e3, e4}, set())
+CurveTests.verifyConnectedness(BasicFamilyView(C, {v2, v3}), False)
+
 
 
 
@@ -354,7 +710,32 @@ C.monoid = freeMonoid
 f = PiecewiseLinearFunction(C, {e1: 1, e2: -1, e3: 1, e4: -1, e5: 0, e6: 1, e7: 0, e8: -1,
                                 v1: freeMonoid.zero()})
 
+# Reachability over the index of the chain
+index = C.index
+middle = index.getVertexMask({v4, v5, v6})
+assert list(index.getDistancesFrom(index.getVertexMask({v1}))[[index.vertexIndex[v] for v in [v1, v5, v9]]]) == [0, 4, 8]
+assert not index.getReachableFrom(index.getVertexMask({v1}), ~index.getVertexMask({v3}))[index.vertexIndex[v9]]
+between = index.getVerticesBetween(index.getVertexMask({v1}), index.getVertexMask({v9}), ~middle | index.getVertexMask({v5}))
+assert not between.any()
+assert index.getVert1IsNearer(index.getVertexMask({v1})).all()
+assert not index.getVert1IsNearer(index.getVertexMask({v9})).any()
+
+# On a cycle, vert1 is nearer if it reaches the sources around the cycle without passing vert2, even if vert2 is closer
+pentagon = BasicFamily("Pentagon")
+pentagonVertices = [Vertex("p" + str(i), 0) for i in range(5)]
+pentagonEdges = [Edge("q" + str(i), freeElementA, pentagonVertices[(i + 1) % 5], pentagonVertices[i]) for i in range(5)]
+pentagonLoop = Edge("q5", freeElementA, pentagonVertices[2], pentagonVertices[2])
+pentagon.addEdges(set(pentagonEdges) | {pentagonLoop})
+pentagonIndex = pentagon.index
+pentagonNearer = pentagonIndex.getVert1IsNearer(pentagonIndex.getVertexMask({pentagonVertices[0]}))
+assert [pentagonNearer[pentagonIndex.edgeIndex[e]] for e in pentagonEdges] == [False, True, True, True, True]
+assert not pentagonNearer[pentagonIndex.edgeIndex[pentagonLoop]]
+assert f.floodfillVertices(v2, {v1}, {v9}) and not f.floodfillVertices(v2, {v1}, {v9}, C.vertices - {v5})
+
 s = f.getSpecialSupportPartition()
+SPLFTests.testArrayFunction(f)
+assert {frozenset(view.edges) for view in f.getSpecialSupportComponents()} == {frozenset(block) for block in s}
+assert all(view.isConnected and view.genus == 0 for view in f.getSpecialSupportComponents())
 
 try:
     # Python doesn't allow sets of mutable sets, so we convert these to sets of immutable sets before comparing
@@ -370,6 +751,39 @@ except:
             print(e.name)
 
 
+# Functions on a disconnected domain get values on every component
+C = BasicFamily("Two disjoint chains")
+v1 = Vertex("v1", 0)
+v2 = Vertex("v2", 0)
+v3 = Vertex("v3", 0)
+v4 = Vertex("v4", 0)
+v5 = Vertex("v5", 0)
+e1 = Edge("e1", freeElementA, v1, v2)
+e2 = Edge("e2", freeElementB, v2, v3)
+e3 = Edge("e3", freeElementC, v4, v5)
+C.addEdges({e1, e2, e3})
+C.monoid = freeMonoid
+
+index = C.index
+slopes = np.zeros(3, dtype=np.int64)
+slopes[index.edgeIndex[e1]] = 1
+slopes[index.edgeIndex[e2]] = -2
+slopes[index.edgeIndex[e3]] = 3
+values = index.solveVertexValues(slopes, {index.vertexIndex[v2]: np.zeros(index.numGens), 
+                                          index.vertexIndex[v5]: np.zeros(index.numGens)})
+arrayFunc = ArrayPiecewiseLinearFunction(C, slopes, values)
+assert arrayFunc.valueAt(v1) == -1 * freeElementA
+assert arrayFunc.valueAt(v3) == -2 * freeElementB
+assert arrayFunc.valueAt(v4) == -3 * freeElementC
+assert arrayFunc.valueAt(v2) == arrayFunc.valueAt(v5) == freeMonoid.zero()
+assert index.spanningForest.numComponents == 2
+
+# Many functions at once
+batch = index.solveVertexValues(np.array([slopes, 2 * slopes]))
+assert batch.shape == (2, index.numVertices, index.numGens)
+assert np.array_equal(batch[1], 2 * batch[0])
+
+
 # Example 4.4
 Ex44 = BasicFamily("Example 4.4")
 v1 = Vertex("v1", 0)
@@ -400,6 +814,9 @@ g = PiecewiseLinearFunction(Ex44, {e1: 1, e2: 0, e3: -1, e4: -1, e5: -1, e6: 0,
                                    v1: freeMonoid.zero()})
 
 SPLFTests.verifyMesa(g)
+SPLFTests.testArrayFunction(g)
+SPLFTests.verifyContractions(g)
+SPLFTests.verifyDivisor(g)
 
 
 Ex28May = BasicFamily("28")
@@ -418,6 +835,288 @@ h = PiecewiseLinearFunction(Ex28May, {e1: -1, e2: -1, e3: -1,
                                       v3: freeMonoid.zero()})
 
 SPLFTests.verifyMesa(h)
+assert h.isNonNegative
+assert not (h - h - h).isNonNegative
+SPLFTests.testArrayFunction(h)
+SPLFTests.testSelfArithmetic(h)
+SPLFTests.verifyContractions(h)
+SPLFTests.verifyDivisor(h)
+
+# Mesa enumeration
+SPLFTests.verifyMesaEnumeration(Ex28May)
+slopes, values = MesaEnumerator(Ex28May).enumerateMesas()
+arrayH = ArrayPiecewiseLinearFunction.fromFunction(h)
+assert any(np.array_equal(s, arrayH.slopes) and np.array_equal(v, arrayH.vertexValues) for s, v in zip(slopes, values))
+assert MesaEnumerator(Ex28May).countMesas() == len(slopes)
+slopes, values = MesaEnumerator(Ex28May, 0, 2).enumerateFunctions()
+assert slopes.shape == (27, 3) and values.shape == (27, 4, len(freeMonoid.gens))
+
+C = BasicFamily("Loop with a tail and a leg")
+v1 = Vertex("v1", 0)
+v2 = Vertex("v2", 0)
+v3 = Vertex("v3", 0)
+e1 = Edge("e1", freeElementA, v1, v1)
+e2 = Edge("e2", freeElementB, v1, v2)
+e3 = Edge("e3", freeElementC, v2, v3)
+e4 = Edge("e4", freeElementC, v2, v3)
+l1 = Leg("l1", v3)
+C.addEdges({e1, e2, e3, e4})
+C.addLeg(l1)
+C.monoid = freeMonoid
+
+SPLFTests.verifyMesaEnumeration(C)
+SPLFTests.verifyMesaEnumeration(C, 0, 2)
+assert MesaEnumerator(C).countMesas() == 2
+
+# Only slopes that integrate to zero around the two loops are found: zero on the self loop and equal on e3 and e4
+slopes, values = MesaEnumerator(C).enumerateFunctions()
+assert len(slopes) == 3 * 3 * 3
+assert C.index.slopesAreWellDefined(slopes[:, :C.index.numEdges]).all()
+
+# Canonical keys identify functions that differ by an automorphism of the curve. Reflecting the chain swaps the legs.
+C = BasicFamily("Chain with a leg at each end")
+v1 = Vertex("v1", 0)
+v2 = Vertex("v2", 1)
+v3 = Vertex("v3", 0)
+e1 = Edge("e1", freeElementA, v1, v2)
+e2 = Edge("e2", freeElementB, v2, v3)
+l1 = Leg("l1", v1)
+l2 = Leg("l2", v3)
+C.addEdges({e1, e2})
+C.addLegs({l1, l2})
+C.monoid = freeMonoid
+
+keys = SPLFTests.verifyCanonicalKeys(C)
+f1 = PiecewiseLinearFunction(C, {e1: 1, e2: 0, l1: 0, l2: 1, v1: freeMonoid.zero()})
+f2 = PiecewiseLinearFunction(C, {e1: 0, e2: -1, l1: 1, l2: 0, v3: freeMonoid.zero()})
+f3 = PiecewiseLinearFunction(C, {e1: 0, e2: 1, l1: 1, l2: 0, v3: freeMonoid.zero()})
+assert f1.canonicalKey == f2.canonicalKey != f3.canonicalKey
+SPLFTests.verifyDivisor(f1)
+assert f1.divisor == {v1: 1, v2: -1, v3: 1}
+assert len({C.canonicalKey, Ex28May.canonicalKey, Ex44.canonicalKey}) == 3
+SPLFTests.verifyCanonicalKeys(Ex28May, 0, 1)
+
+
+# A vertex with many pendant banana graphs has many automorphisms, which the canonical key search skips over
+def bananaBouquet(name, numEdgesPerBanana, reverse=False):
+    bouquet = BasicFamily(name)
+    center = Vertex(name + " center", 0)
+    edges = []
+    for i in range(len(numEdgesPerBanana)):
+        inner = Vertex(name + " inner " + str(i), 0)
+        outer = Vertex(name + " outer " + str(i), 0)
+        edges.append(Edge(name + " stem " + str(i), freeElementA, center, inner))
+        edges += [Edge(name + " banana " + str(i) + str(j), freeElementA, outer, inner)
+                  for j in range(numEdgesPerBanana[i])]
+    bouquet.addEdges(set(reversed(edges) if reverse else edges))
+    return bouquet
+
+
+bouquet = bananaBouquet("B1", [3] * 12)
+reversedBouquet = bananaBouquet("B2", [3] * 12, True)
+assert bouquet.canonicalKey == reversedBouquet.canonicalKey
+assert bouquet.canonicalKey != bananaBouquet("B3", [3] * 11 + [2]).canonicalKey
+bouquetIsomorphism = bouquet.getIsomorphismTo(reversedBouquet)
+assert set(bouquetIsomorphism.values()) == reversedBouquet.vertices | reversedBouquet.edges
+assert all({bouquetIsomorphism[v] for v in e.vertices} == bouquetIsomorphism[e].vertices for e in bouquet.edges)
+
+# Pushforwards along contractions
+C = BasicFamily("Pushforward test curve")
+v1 = Vertex("v1", 0)
+v2 = Vertex("v2", 0)
+v3 = Vertex("v3", 1)
+e1 = Edge("e1", freeElementA, v1, v2)
+e2 = Edge("e2", freeElementB, v2, v3)
+e3 = Edge("e3", freeElementC, v1, v1)
+l1 = Leg("l1", v3)
+C.addEdges({e1, e2, e3})
+C.addLeg(l1)
+C.monoid = freeMonoid
+
+f = PiecewiseLinearFunction(C, {e1: 1, e2: -1, e3: 0, l1: 0, v3: freeMonoid.zero()})
+morphisms = [C.getContractionMorphism(e) for e in [e1, e2, e3]]
+pushforwards = [f.getPushforward(morphism) for morphism in morphisms]
+for morphism, pushforward in zip(morphisms, pushforwards):
+    assert pushforward.domain is morphism.codomain
+    assert pushforward.domain.genus == C.genus
+    for x in C.vertices:
+        assert pushforward.functionValues[morphism(x)] == morphism(f.functionValues[x])
+    for x in C.edges | C.legs:
+        if morphism(x) not in morphism.codomain.vertices:
+            assert pushforward.functionValues[morphism(x)] == f.functionValues[x]
+
+# Contraction morphisms are built without validation, and pass it
+for morphism in morphisms:
+    assert not morphism.isValidated and morphism.validate().isValidated
+    assert v1 in morphism.inverseMap[morphism(v1)]
+    for vert in morphism.codomain.vertices:
+        assert morphism.preimage(vert).genus == vert.genus
+        assert morphism.preimage(vert).isConnected and morphism.preimage(vert) is morphism.preimage(vert)
+    assert morphism.image() is morphism.image() and morphism.image().vertices == morphism.codomain.vertices
+    assert morphism.image().edges == morphism.codomain.edges and morphism.image().genus == morphism.codomain.genus
+    BasicFamilyMorphism(C, morphism.codomain, dict(morphism.curveMorphismDict), morphism.monoidMorphism)
+
+# The image and preimages are kept until the morphism changes, which also means it has to be validated again
+image = morphisms[0].image()
+morphisms[0].curveMorphismDict = dict(morphisms[0].curveMorphismDict)
+assert morphisms[0].image() is not image and morphisms[0].image().edges == image.edges
+assert not morphisms[0].isValidated and morphisms[0].validate().isValidated
+assert morphisms[0].imageCurve is morphisms[0].imageCurve
+
+# Cached pushforwards are dropped when the morphism changes
+contraction = morphisms[0].monoidMorphism
+before = f.getPushforward(morphisms[0])
+morphisms[0].monoidMorphism = MonoidHomomorphism(contraction.domain, contraction.codomain, 2 * contraction.array)
+after = f.getPushforward(morphisms[0])
+assert after.functionValues[morphisms[0](v1)] != before.functionValues[morphisms[0](v1)]
+for x in C.vertices:
+    assert after.functionValues[morphisms[0](x)] == morphisms[0](f.functionValues[x])
+morphisms[0].monoidMorphism = contraction
+assert f.getPushforward(morphisms[0]) == before
+
+# Keeping the length of the contracted edge is caught
+identity = MonoidHomomorphism(freeMonoid, morphisms[0].codomain.monoid, np.eye(len(freeMonoid.gens), dtype=np.int64))
+try:
+    BasicFamilyMorphism(C, morphisms[0].codomain, morphisms[0].curveMorphismDict, identity)
+    assert False
+except AssertionError as error:
+    assert str(error) == "curveMorphismDict and monoidMorphism should be compatible on edge lengths."
+
+# So is losing the genus of the contracted self loop
+morphisms[2](v1).genus -= 1
+try:
+    BasicFamilyMorphism(C, morphisms[2].codomain, morphisms[2].curveMorphismDict, morphisms[2].monoidMorphism)
+    assert False
+except AssertionError as error:
+    assert str(error) == "curveMorphismDict should preserve genus."
+morphisms[2](v1).genus += 1
+
+# The pushforwards are cached, and computing them all at once gives the same functions
+arrayF = f.arrayFunction
+assert arrayF.getPushforwards(morphisms) == [arrayF.getPushforward(morphism) for morphism in morphisms]
+assert all(a is b for a, b in zip(arrayF.getPushforwards(morphisms), arrayF.getPushforwards(morphisms)))
+
+family = Family({C} | {morphism.codomain for morphism in morphisms}, set(morphisms))
+plfFamily = PLFFamily(family, {C: f, **{morphism.codomain: p for morphism, p in zip(morphisms, pushforwards)}})
+assert all(plfFamily.morphismPreservesFunctions(morphism) for morphism in morphisms)
+try:
+    PLFFamily(family, {C: f, **{morphism.codomain: PiecewiseLinearFunction.linearCombination([2], [p])
+                                for morphism, p in zip(morphisms, pushforwards)}})
+    assert False, "Incompatible functions should be rejected."
+except ValueError:
+    pass
+
+# Values with denominators can not be stored in arrays, so they are compared without them, including the slopes
+halved = PiecewiseLinearFunction(C, {e1: 1, e2: -1, e3: 0, l1: 0, v3: freeMonoid.Element({"a": 1}, 2)})
+halvedPushforwards = [halved.getPushforward(morphism) for morphism in morphisms]
+assert all(pushforward.domain is morphism.codomain for morphism, pushforward in zip(morphisms, halvedPushforwards))
+PLFFamily(family, {C: halved, **{morphism.codomain: p for morphism, p in zip(morphisms, halvedPushforwards)}})
+try:
+    wrongLeg = PiecewiseLinearFunction(morphisms[0].codomain,
+                                       {**halvedPushforwards[0].functionValues, morphisms[0](l1): 1})
+    PLFFamily(family, {C: halved, morphisms[0].codomain: wrongLeg,
+                       **{morphism.codomain: p for morphism, p in zip(morphisms[1:], halvedPushforwards[1:])}})
+    assert False, "Functions with different leg slopes should be rejected."
+except ValueError:
+    pass
+
+# Without arrays, the slope of an edge whose image runs the other way changes its sign
+Cr = BasicFamily("Pushforward test curve with e1 reversed")
+v1r = Vertex("v1r", 0)
+v2r = Vertex("v2r", 0)
+v3r = Vertex("v3r", 1)
+e1r = Edge("e1r", freeElementA, v2r, v1r)
+e2r = Edge("e2r", freeElementB, v2r, v3r)
+e3r = Edge("e3r", freeElementC, v1r, v1r)
+l1r = Leg("l1r", v3r)
+Cr.addEdges({e1r, e2r, e3r})
+Cr.addLeg(l1r)
+Cr.monoid = freeMonoid
+flip = BasicFamilyMorphism(C, Cr, {v1: v1r, v2: v2r, v3: v3r, e1: e1r, e2: e2r, e3: e3r, l1: l1r},
+                           MonoidHomomorphism(freeMonoid, freeMonoid, np.eye(len(freeMonoid.gens), dtype=np.int64)))
+flipped = halved.getPushforward(flip)
+assert flipped.domain is Cr
+assert flipped.functionValues[e1r] == -1 and flipped.functionValues[e2r] == -1
+assert flipped.functionValues[v1r] == halved.functionValues[v1]
+PLFFamily(Family({C, Cr}, {flip}), {C: halved, Cr: flipped})
+
+# Compositions of contractions, and the transitive reduction of a family that contains them
+C1 = morphisms[0].codomain
+contractSecond = C1.getContractionMorphism(morphisms[0](e2))
+C12 = contractSecond.codomain
+composite = contractSecond.compose(morphisms[0])
+assert composite.domain is C and composite.codomain is C12 and composite.validate().isValidated
+assert composite(e1) == composite(e2) == composite(v3)
+assert f.getPushforward(composite) == f.getPushforward(morphisms[0]).getPushforward(contractSecond)
+
+# The enumerator finds the same contraction, and also the one that collapses e2 instead (C/e1 and C/e2 are isomorphic),
+# but only the identity from C to itself
+enumerated = MorphismEnumerator(C, C1).enumerateMorphisms()
+assert len(enumerated) == 2 and morphisms[0].curveMorphismDict in [m.curveMorphismDict for m in enumerated]
+assert {m(e1) in C1.vertices for m in enumerated} == {m(e2) in C1.vertices for m in enumerated} == {True, False}
+assert all(m.validate().isValidated for m in enumerated)
+assert MorphismEnumerator(C, C).countMorphisms() == 1 and MorphismEnumerator(C1, C).countMorphisms() == 0
+assert next(MorphismEnumerator(C, C12).iterMorphisms()).curveMorphismDict == composite.curveMorphismDict
+
+# A morphism between the same curves that also scales an unused generator is not a composition
+matrix = composite.monoidMorphism.array.copy()
+matrix[freeMonoid.gens.index("d"), freeMonoid.gens.index("d")] = 2
+scaled = BasicFamilyMorphism(C, C12, composite.curveMorphismDict, MonoidHomomorphism(freeMonoid, C12.monoid, matrix))
+assert composite.comparisonKey == contractSecond.compose(morphisms[0]).comparisonKey != scaled.comparisonKey
+
+family = Family({C, C1, C12}, {morphisms[0], contractSecond, composite, scaled})
+assert family.getTransitiveReduction() == {morphisms[0], contractSecond, scaled}
+assert Family({C, C1, C12}, {morphisms[0], composite}).getTransitiveReduction() == {morphisms[0], composite}
+family.removeMorphism(scaled)
+assert family.getTransitiveReduction() == {morphisms[0], contractSecond}
+
+# Queries answered from the indexes of incoming and outgoing morphisms
+assert family.getIncomingMorphisms(C12) == {contractSecond, composite} and family.getOutgoingMorphisms(C12) == set()
+assert family.getAncestors(C12) == {C, C1} and family.getDescendants(C) == {C1, C12}
+assert family.getMaximalAncestors(C12) == {C} and list(family.maximalCurvesIter()) == [C]
+assert family.topologicalOrder == [C, C1, C12] and family.levels == [[C], [C1], [C12]]
+
+# The basic families and morphisms can only be changed through the family, which keeps its indexes up to date
+readOnlySets = [family.basicFamilies, family.morphisms, family.getOutgoingMorphisms(C), family.getTransitiveReduction()]
+assert all(isinstance(readOnly, frozenset) for readOnly in readOnlySets)
+morphismsBefore = family.morphisms
+family.removeMorphism(contractSecond)
+assert contractSecond in morphismsBefore and contractSecond not in family.morphisms | family.getIncomingMorphisms(C12)
+assert family.getLevel(C12) == 1 and [set(level) for level in family.levels] == [{C}, {C1, C12}]
+assert family.getTransitiveReduction() == {morphisms[0], composite}
+family.addMorphism(contractSecond)
+plfFamily = PLFFamily(family, {C: f, C1: pushforwards[0], C12: pushforwards[0].getPushforward(contractSecond)})
+assert plfFamily.morphismPreservesFunctions(composite)
+assert PLFFamily.fromMaximalFunctions(family, {C: f}).functions == plfFamily.functions
+assert PLFFamily.fromMaximalFunctions(family, {C: f}, processes=2).functions == plfFamily.functions
+
+# Values computed in topological order, with the inputs along the morphisms into (or out of) each basic family
+def longestChain(basicFamily, inputs):
+    calls.append(basicFamily)
+    return 1 + max((value for _, value in inputs), default=-1)
+
+calls = []
+assert family.computeInOrder(longestChain, key="level") == {basicFamily: family.getLevel(basicFamily)
+                                                            for basicFamily in family.basicFamilies}
+assert family.computeInOrder(longestChain, key="level") == {C: 0, C1: 1, C12: 2} and len(calls) == 3
+assert family.computeInOrder(longestChain, reverse=True) == {C: 2, C1: 1, C12: 0} and len(calls) == 6
+
+# Work handed out as WorkerTasks is run level by level, in a process pool or in this process
+def longestChainTask(basicFamily, inputs):
+    return WorkerTask(max, [value for _, value in inputs] + [-1], lambda longest: longest + 1)
+
+assert family.computeInOrder(longestChainTask, processes=2) == {C: 0, C1: 1, C12: 2}
+assert family.computeInOrder(longestChainTask, reverse=True) == {C: 2, C1: 1, C12: 0}
+
+# Checking in a process pool reports the failing morphism and the work done by each process
+report = plfFamily.checkWellDefined(processes=2, chunkSize=1)
+assert report.isWellDefined and report.failedMorphism is None
+assert sum(checked for checked, _ in report.workers.values()) == len(family.getTransitiveReduction())
+assert plfFamily.isWellDefined(processes=2) and all(rate > 0 for rate in report.throughput.values())
+plfFamily.functions[C1] += plfFamily.functions[C1]
+report = plfFamily.checkWellDefined(processes=2, chunkSize=1)
+assert not report.isWellDefined and report.failedMorphism is morphisms[0]
+assert not plfFamily.isWellDefined()
 
 
 
@@ -528,5 +1227,48 @@ CurveTests.verifyIsomorphism(C, D)
 # Generate some small, known, moduli spaces
 ModuliSpaceTests.verifyCommonSizes()
 
+m = TropicalModuliSpace(1, 3)
+m.generateSpaceDFS()
+ModuliSpaceTests.verifySharedRegistry(m)
+ModuliSpaceTests.verifyMesaClassification(m)
+ModuliSpaceTests.verifyResumedMesaClassification(1, 3)
+
+# The space as a family, before and after saving it
+m.generateContractionDictionary()
+ModuliSpaceTests.verifyFamily(m)
+ModuliSpaceTests.verifyMorphismEnumeration(m)
+
+# Specializing the minimal stratum (given twice, up to isomorphism) gives the same curves, and a morphism for every pair
+# of curves related by the contraction of an edge
+seed = min(m.curves, key=lambda c: c.numEdges)
+generated = Family.generateFromMinimalStrata([seed, seed.getFullyShallowCopy()])
+assert sorted(c.canonicalKey for c in generated.basicFamilies) == sorted(c.canonicalKey for c in m.curves)
+assert {(morphism.domain.canonicalKey, morphism.codomain.canonicalKey) for morphism in generated.morphisms} == \
+    {(c.canonicalKey, d.canonicalKey) for c in m.curves for _, d in m.contractionDict[c]}
+assert all(morphism.validate().isValidated for morphism in generated.morphisms)
+assert generated.levels[-1] == [seed]
+
+# So does contracting the maximal strata, level by level
+maximalCurves = {c for c in m.curves if c.numEdges == max(curve.numEdges for curve in m.curves)}
+contracted = Family.generateFromMaximalStrata(maximalCurves)
+assert sorted(c.canonicalKey for c in contracted.basicFamilies) == sorted(c.canonicalKey for c in m.curves)
+assert {(morphism.domain.canonicalKey, morphism.codomain.canonicalKey) for morphism in contracted.morphisms} == \
+    {(c.canonicalKey, d.canonicalKey) for c in m.curves for _, d in m.contractionDict[c]}
+assert all(morphism.validate().isValidated for morphism in contracted.morphisms)
+assert set(contracted.maximalCurvesIter()) == maximalCurves
+with tempfile.TemporaryDirectory() as directory:
+    m.saveModuliSpaceToFile(os.path.join(directory, "M-1-3.txt"))
+    loaded = TropicalModuliSpace(1, 3)
+    loaded.loadModuliSpaceFromFile(os.path.join(directory, "M-1-3.txt"))
+ModuliSpaceTests.verifyFamily(loaded)
+
+# Specializing a copy must not add generators to the original
+C = BasicFamily("Copied curve")
+C.monoid = m.registry.view()
+v1 = Vertex("v1", 1)
+C.addLegs({Leg("l1", v1), Leg("l2", v1)})
+D = m.getGenusReductionSpecialization(C, v1)
+assert C.monoid.gens == [] and len(D.monoid.gens) == 1
+
 
 print("If you see this, then all previous assertations were true!")